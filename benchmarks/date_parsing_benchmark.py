@@ -0,0 +1,68 @@
+"""
+Benchmark for parsing the dates in ODK submissions
+
+Parses the SubmissionDate, start, end and visit dates of the demo case
+test data plus timestamps in the other formats ODK Aggregate and Enketo
+send us, with dateutil and with util.datetime_helper.parse, and prints
+the number of dates parsed per second.
+
+Usage:
+    python benchmarks/date_parsing_benchmark.py [--repeat N]
+"""
+import argparse
+import time
+
+from dateutil.parser import parse as dateutil_parse
+
+from meerkat_abacus import util
+from meerkat_abacus.config import config
+from meerkat_abacus.util import datetime_helper
+
+DATE_COLUMNS = ["SubmissionDate", "start", "end", "pt./visit_date"]
+
+OTHER_SAMPLES = [
+    "Jan 17, 2017 12:51:15 AM",
+    "Feb 3, 2017 4:05:09 PM",
+    "Mar 21, 2017",
+    "17-Jan-2017",
+    "17-Jan-2017 18:57:29",
+    "2017-01-17",
+    "2017-01-16T18:57:29.481Z",
+    "2017-01-16T18:57:29.481+03:00",
+]
+
+
+def samples():
+    rows = util.read_csv(config.config_directory +
+                         "demo_case_test_data.csv")
+    dates = []
+    for row in rows:
+        dates.extend(row[column] for column in DATE_COLUMNS if row.get(column))
+    return dates + OTHER_SAMPLES * 20
+
+
+def run(parse, dates, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        for date in dates:
+            parse(date)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    dates = samples()
+    n = len(dates) * args.repeat
+    for name, parse in [
+            ("dateutil", dateutil_parse),
+            ("known formats", datetime_helper.parse_known_format),
+            ("cached", datetime_helper.parse)]:
+        duration = run(parse, dates, args.repeat)
+        print(f"{name:<14} {n} dates: {n / duration:.0f} dates/sec")
+
+
+if __name__ == "__main__":
+    main()
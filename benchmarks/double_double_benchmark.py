@@ -0,0 +1,162 @@
+"""
+Benchmark for the double doubling alerts
+
+Writes one year of synthetic data records with a double alert variable,
+keeps the alert_weekly_counts for them as the write_to_db step does, and
+prints the time per record of double_double, which queries the data
+table, and of double_double_counts, which reads alert_weekly_counts.
+Needs the database in MEERKAT_ABACUS_DB_URL. The benchmark rows are
+deleted again afterwards.
+
+Usage:
+    python benchmarks/double_double_benchmark.py [--clinics N]
+        [--cases-per-day N] [--lookups N]
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine
+
+from meerkat_abacus import model
+from meerkat_abacus.config import config
+from meerkat_abacus.pipeline_worker import alert_weekly_counts
+from meerkat_abacus.pipeline_worker.process_steps.add_multiple_alerts import (
+    double_double, double_double_counts)
+from meerkat_abacus.pipeline_worker.process_steps.write_to_db import copy_rows
+from meerkat_abacus.util.epi_week import get_calendar
+
+VARIABLE = "benchmark_double"
+CHUNK = 1000
+
+
+def data_rows(clinics, cases_per_day, calendar):
+    start = datetime(2017, 1, 1)
+    rows = []
+    for clinic in range(clinics):
+        # Some clinics have a growing number of cases so alerts fire
+        growth = random.random() < 0.2
+        for day in range(365):
+            date = start + timedelta(days=day)
+            n = random.randint(0, cases_per_day)
+            if growth:
+                n += 2 ** (day % 21 // 7)
+            epi_year, epi_week = calendar.epi_week(date)
+            for i in range(n):
+                variables = {"tot_1": 1}
+                if growth or random.random() < 0.3:
+                    variables[VARIABLE] = 1
+                rows.append({
+                    "uuid": f"benchmark-{clinic}-{day}-{i}",
+                    "type": "case",
+                    "date": date,
+                    "epi_year": epi_year,
+                    "epi_week": epi_week,
+                    "clinic": 100000 + clinic,
+                    "variables": variables
+                })
+    return rows
+
+
+def write(engine, rows):
+    """
+    Writes the rows in chunks and returns the time spent on the counts
+    """
+    counts_time = 0
+    conn = engine.connect()
+    for start in range(0, len(rows), CHUNK):
+        chunk = rows[start:start + CHUNK]
+        with conn.begin():
+            copy_rows(conn, model.Data.__table__, chunk)
+            t = time.perf_counter()
+            alert_weekly_counts.add_counts(conn, [VARIABLE], chunk)
+            counts_time += time.perf_counter() - t
+    conn.close()
+    return counts_time
+
+
+def replace(engine, rows):
+    """
+    Returns the time to subtract a chunk of records that are replaced
+    """
+    conn = engine.connect()
+    chunk = rows[:CHUNK]
+    t = time.perf_counter()
+    with conn.begin():
+        alert_weekly_counts.remove_counts(
+            conn, [VARIABLE], {"case": [row["uuid"] for row in chunk]})
+        alert_weekly_counts.add_counts(conn, [VARIABLE], chunk)
+    duration = time.perf_counter() - t
+    conn.close()
+    return duration
+
+
+def lookups(engine, calendar, records):
+    legacy_time = 0
+    counts_time = 0
+    different = 0
+    for record in records:
+        args = (VARIABLE, record["epi_week"], record["epi_year"],
+                record["clinic"], engine)
+        t = time.perf_counter()
+        legacy = double_double(*args)
+        legacy_time += time.perf_counter() - t
+        t = time.perf_counter()
+        new = double_double_counts(*args, calendar)
+        counts_time += time.perf_counter() - t
+        # double_double counts every year as 52 weeks, so it can only
+        # agree away from the ends of the year
+        if 3 <= record["epi_week"] <= 50:
+            if (sorted(sorted(a["uuids"]) for a in legacy) !=
+                    sorted(sorted(a["uuids"]) for a in new)):
+                different += 1
+    return legacy_time, counts_time, different
+
+
+def clean_up(engine):
+    with engine.begin() as conn:
+        conn.execute(model.Data.__table__.delete().where(
+            model.Data.__table__.c.uuid.like("benchmark-%")))
+        table = model.AlertWeeklyCounts.__table__
+        conn.execute(table.delete().where(table.c.variable == VARIABLE))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clinics", type=int, default=50)
+    parser.add_argument("--cases-per-day", type=int, default=10)
+    parser.add_argument("--lookups", type=int, default=1000)
+    args = parser.parse_args()
+    random.seed(1)
+
+    engine = create_engine(config.DATABASE_URL)
+    model.Base.metadata.create_all(engine)
+    calendar = get_calendar(config.country_config["epi_week"],
+                            config.country_config.get("epi_week_53_strategy",
+                                                      "leave_as_is"))
+    clean_up(engine)
+    rows = data_rows(args.clinics, args.cases_per_day, calendar)
+    try:
+        counts_time = write(engine, rows)
+        print(f"{len(rows)} rows, {len(rows) / CHUNK:.0f} chunks: "
+              f"{counts_time / len(rows) * 1e6:.1f} us/row to add the counts")
+        duration = replace(engine, rows)
+        print(f"replacing a chunk of {CHUNK}: {duration * 1000:.1f} ms "
+              f"for the counts")
+        records = random.sample(
+            [row for row in rows if VARIABLE in row["variables"]],
+            args.lookups)
+        legacy_time, counts_time, different = lookups(engine, calendar,
+                                                      records)
+        print(f"double_double:        {legacy_time / len(records) * 1000:.2f} "
+              f"ms/record")
+        print(f"double_double_counts: {counts_time / len(records) * 1000:.2f} "
+              f"ms/record")
+        print(f"records with different alerts: {different}")
+    finally:
+        clean_up(engine)
+
+
+if __name__ == "__main__":
+    main()
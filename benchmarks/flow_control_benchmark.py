@@ -0,0 +1,91 @@
+"""
+Benchmark for the flow control of the initial load
+
+Simulates sending chunks to a number of workers that each take
+task_time seconds per chunk. It compares the old policy, which checked
+the number of tasks and slept 60 seconds when there were more than 15,
+with the FlowController. Times are scaled down by --scale so the
+benchmark runs quickly, and the wall times it prints are in unscaled
+seconds.
+
+Usage:
+    python benchmarks/flow_control_benchmark.py [--chunks N] [--workers N]
+        [--task-time SECONDS] [--scale N]
+"""
+import argparse
+import queue
+import threading
+import time
+from unittest import mock
+
+from meerkat_abacus.consumer import flow_control
+from meerkat_abacus.consumer.flow_control import FlowController
+
+
+class Result:
+    def __init__(self):
+        self.event = threading.Event()
+
+    def ready(self):
+        return self.event.is_set()
+
+
+class FakeApp:
+    """ Celery app with workers that sleep for task_time per task """
+    def __init__(self, workers, task_time):
+        self.tasks = queue.Queue()
+        self.task_time = task_time
+        for i in range(workers):
+            threading.Thread(target=self.work, daemon=True).start()
+
+    def work(self):
+        while True:
+            result = self.tasks.get()
+            time.sleep(self.task_time)
+            result.event.set()
+
+    def send_task(self, name, args):
+        result = Result()
+        self.tasks.put(result)
+        return result
+
+
+def old_policy(app, chunks, scale, n=15):
+    results = []
+    for i in range(chunks):
+        while sum(not result.ready() for result in results) > n:
+            time.sleep(60 / scale)
+        results.append(app.send_task("processing_tasks.process_data", [[]]))
+    while not all(result.ready() for result in results):
+        time.sleep(0.01 / scale)
+
+
+def flow_controller(app, chunks, scale, n=15):
+    flow = FlowController(app, max_in_flight=n, poll_interval=0.2 / scale)
+    with mock.patch.object(flow_control.logger, "info"):
+        for i in range(chunks):
+            flow.send([])
+        flow.join()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--task-time", type=float, default=5)
+    parser.add_argument("--scale", type=float, default=100)
+    args = parser.parse_args()
+
+    for name, policy in [("sleep 60s", old_policy),
+                         ("flow control", flow_controller)]:
+        app = FakeApp(args.workers, args.task_time / args.scale)
+        start = time.perf_counter()
+        policy(app, args.chunks, args.scale)
+        duration = (time.perf_counter() - start) * args.scale
+        print(f"{name:<13} {args.chunks} chunks: {duration:.0f} seconds")
+    ideal = args.chunks * args.task_time / args.workers
+    print(f"{'workers busy':<13} {args.chunks} chunks: {ideal:.0f} seconds")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Benchmark for to_codes.to_code
+
+Codes synthetic demo_case rows with the variables from the demo codes
+files and prints the number of rows coded per second.
+
+Usage:
+    python benchmarks/to_codes_benchmark.py [--rows N] [--sparse FRACTION]
+
+--sparse drops the given fraction of the coded columns from each row to
+mimic ODK submissions where most form fields are empty.
+"""
+import argparse
+import os
+import random
+import time
+from unittest import mock
+
+from meerkat_abacus import model, util
+from meerkat_abacus.config import config
+from meerkat_abacus.codes import to_codes
+
+
+def load_variables():
+    """ Reads the codes files into AggregationVariables rows """
+    rows = []
+    for coding_file_name in config.country_config["coding_list"]:
+        codes_file = config.config_directory + "variable_codes/" + coding_file_name
+        if not os.path.exists(codes_file):
+            continue
+        for row in util.read_csv(codes_file):
+            row.pop("", None)
+            row = util.field_to_list(row, "category")
+            keys = model.AggregationVariables.__table__.columns._data.keys()
+            row = {key: row[key] for key in keys if key in row}
+            rows.append(model.AggregationVariables(**row))
+    for i, row in enumerate(rows):
+        row.id_pk = i + 1
+    session = mock.MagicMock()
+    session.query.return_value = rows
+    return rows, to_codes.get_variables(session, match_on_form="case")
+
+
+def get_locations():
+    locations = {
+        1: model.Locations(name="Demo", id=1),
+        2: model.Locations(name="Region 1", parent_location=1, id=2, level="region"),
+        3: model.Locations(name="District 1", parent_location=2, id=3, level="district"),
+        4: model.Locations(name="Clinic 1", parent_location=3, id=4, level="clinic",
+                           deviceid="1", clinic_type="Primary", case_type=["mh"])
+    }
+    return (locations, {"1": 4}, [], [2], [3], {"1": []})
+
+
+def column_values(rows):
+    """ Possible values for each column read by a case variable """
+    values = {}
+    numeric = set()
+    for row in rows:
+        if row.type != "case" or row.form != "demo_case":
+            continue
+        columns = row.db_column.split(";")
+        conditions = row.condition.split(";")
+        methods = row.method.split(" ")[::2]
+        for column, condition, method in zip(columns, conditions, methods):
+            for c in column.split(","):
+                c = c.strip()
+                if not c:
+                    continue
+                values.setdefault(c, {""})
+                if method in ["match", "sub_match"]:
+                    values[c].update(v.strip() for v in condition.split(","))
+                elif method in ["between", "calc"]:
+                    numeric.add(c)
+                else:
+                    values[c].add("Jan 1, 2017 10:12:03 AM")
+    for c in sorted(numeric):
+        values[c] = {""} | {str(random.randint(1, 100)) for _ in range(10)}
+    return {c: sorted(v) for c, v in values.items()}
+
+
+def make_rows(n, values, sparse):
+    rows = []
+    for i in range(n):
+        form_row = {"deviceid": "1",
+                    "meta/instanceID": "uuid:" + str(i),
+                    "pt./visit_date": "2017-01-02"}
+        for column, possible in values.items():
+            if random.random() >= sparse:
+                form_row[column] = random.choice(possible)
+        rows.append({"original_form": "demo_case", "demo_case": form_row})
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--sparse", type=float, default=0.0)
+    args = parser.parse_args()
+    random.seed(1)
+
+    rows, variables = load_variables()
+    locations = get_locations()
+    data_rows = make_rows(args.rows, column_values(rows), args.sparse)
+    alert_data = config.country_config["alert_data"]
+    kwargs = {}
+    if hasattr(to_codes, "compile_variables"):
+        kwargs["plan"] = to_codes.compile_variables(variables, "case")
+
+    start = time.perf_counter()
+    for row in data_rows:
+        to_codes.to_code(row, variables, locations, "case", alert_data,
+                         set(), "deviceid", **kwargs)
+    duration = time.perf_counter() - start
+    print(f"{len(rows)} variables, {args.rows} rows, sparse={args.sparse}: "
+          f"{args.rows / duration:.0f} rows/sec")
+
+
+if __name__ == "__main__":
+    main()
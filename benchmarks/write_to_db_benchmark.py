@@ -0,0 +1,105 @@
+"""
+Benchmark for the WriteToDb writers
+
+Writes synthetic rows to the data table and to a form table with INSERT
+and with COPY and prints the number of rows written per second. Needs the
+database in MEERKAT_ABACUS_DB_URL. The benchmark rows are deleted again
+afterwards.
+
+Usage:
+    python benchmarks/write_to_db_benchmark.py [--rows N]
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+from geoalchemy2.shape import from_shape
+from shapely.geometry import Point
+from sqlalchemy import create_engine
+
+from meerkat_abacus import model
+from meerkat_abacus.config import config
+from meerkat_abacus.pipeline_worker.process_steps.write_to_db import copy_rows
+
+FORM = config.country_config["tables"][0]
+
+
+def data_rows(n, prefix):
+    start = datetime(2017, 1, 1)
+    rows = []
+    for i in range(n):
+        rows.append({
+            "uuid": f"{prefix}{i}",
+            "type": "case",
+            "type_name": "Case",
+            "date": start + timedelta(days=i % 365),
+            "epi_week": i % 52 + 1,
+            "epi_year": 2017,
+            "submission_date": start + timedelta(days=i % 365),
+            "country": 1,
+            "zone": None,
+            "region": 2,
+            "district": 4,
+            "clinic": 7,
+            "clinic_type": "Primary",
+            "case_type": ["mh"],
+            "device_id": "1",
+            "tags": [],
+            "links": {},
+            "variables": {f"tot_{j}": 1 for j in range(random.randint(5, 40))},
+            "categories": {"gender": "gen_1", "pc": "pc_1"},
+            "geolocation": from_shape(Point(0.1, 0.1)).desc
+        })
+    return rows
+
+
+def form_rows(n, prefix):
+    rows = []
+    for i in range(n):
+        uuid = f"{prefix}{i}"
+        rows.append({
+            "uuid": uuid,
+            "data": {"meta/instanceID": uuid,
+                     "deviceid": "1",
+                     "pt./visit_date": "2017-01-02",
+                     **{f"field_{j}": random.choice(["yes", "no", "", "12"])
+                        for j in range(60)}}
+        })
+    return rows
+
+
+def run(engine, table, rows, writer):
+    conn = engine.connect()
+    start = time.perf_counter()
+    if writer == "copy":
+        with conn.begin():
+            copy_rows(conn, table, rows)
+    else:
+        conn.execute(table.insert(), rows)
+    duration = time.perf_counter() - start
+    conn.execute(table.delete().where(table.c.uuid.like("benchmark-%")))
+    conn.close()
+    return duration
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=20000)
+    args = parser.parse_args()
+    random.seed(1)
+
+    engine = create_engine(config.DATABASE_URL)
+    form_table = model.form_tables(config)[FORM].__table__
+    model.Base.metadata.create_all(engine)
+    for name, table, make_rows in [("data", model.Data.__table__, data_rows),
+                                   (FORM, form_table, form_rows)]:
+        rows = make_rows(args.rows, "benchmark-")
+        for writer in ["insert", "copy"]:
+            duration = run(engine, table, rows, writer)
+            print(f"{name:<12} {writer:<6} {args.rows} rows: "
+                  f"{args.rows / duration:.0f} rows/sec")
+
+
+if __name__ == "__main__":
+    main()
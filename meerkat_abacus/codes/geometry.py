@@ -0,0 +1,143 @@
+"""
+Spatial index for finding the district a gps point is in
+
+"""
+from geoalchemy2.shape import to_shape
+from shapely.geometry import Point
+from shapely.geometry.base import BaseGeometry
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+
+try:
+    from shapely import points as _points
+except ImportError:  # Shapely < 2.0 has no vectorised functions
+    _points = None
+
+
+class DistrictIndex:
+    """
+    Finds the district that contains a point
+
+    The district areas are deserialised and prepared once and kept in an
+    STRtree, so a lookup only tests the few districts whose bounding box
+    contains the point instead of every district.
+
+    If more than one district contains a point we return the first one in
+    the order of the locations dict, as looping over all the locations did.
+
+    Args:
+        locations: dict of id: Locations as returned by
+                   util.all_location_data(session)[0]
+    """
+    def __init__(self, locations):
+        self.district_ids = []
+        self.shapes = []
+        self.prepared = []
+        for loc in locations.values():
+            if loc.level == "district" and loc.area is not None:
+                shape = to_shape(loc.area)
+                self.district_ids.append(loc.id)
+                self.shapes.append(shape)
+                self.prepared.append(prep(shape))
+        self.tree = None
+        if self.shapes:
+            self.tree = STRtree(self.shapes)
+        # Shapely < 2.0 returns the geometries from a query and not indices
+        self._shape_index = {id(shape): i for i, shape in enumerate(self.shapes)}
+        self._preloaded = {}
+
+    def __len__(self):
+        return len(self.district_ids)
+
+    def _candidates(self, point):
+        for candidate in self.tree.query(point):
+            if isinstance(candidate, BaseGeometry):
+                yield self._shape_index[id(candidate)]
+            else:
+                yield int(candidate)
+
+    def find(self, point):
+        """
+        Returns the id of the district containing point
+
+        Args:
+            point: shapely Point
+        Returns:
+            district_id: id of the district or None if not found
+        """
+        if self.tree is None:
+            return None
+        key = (point.x, point.y)
+        if key in self._preloaded:
+            return self._preloaded[key]
+        matches = [i for i in self._candidates(point)
+                   if self.prepared[i].contains(point)]
+        if not matches:
+            return None
+        return self.district_ids[min(matches)]
+
+    def find_many(self, coordinates):
+        """
+        Returns the district for each (x, y) in coordinates
+
+        With Shapely >= 2.0 all the points are looked up in one vectorised
+        query, otherwise we look up the points one by one.
+
+        Args:
+            coordinates: list of (x, y) tuples
+        Returns:
+            district_ids(list): district id or None for each point
+        """
+        if self.tree is None or not coordinates:
+            return [None] * len(coordinates)
+        if _points is None:
+            return [self.find(Point(x, y)) for x, y in coordinates]
+        points = _points(coordinates)
+        point_indices, tree_indices = self.tree.query(points,
+                                                      predicate="within")
+        result = [None] * len(coordinates)
+        best = {}
+        for point_i, tree_i in zip(point_indices.tolist(),
+                                   tree_indices.tolist()):
+            if point_i not in best or tree_i < best[point_i]:
+                best[point_i] = tree_i
+        for point_i, tree_i in best.items():
+            result[point_i] = self.district_ids[tree_i]
+        return result
+
+    def preload(self, coordinates):
+        """
+        Looks up all the coordinates with find_many so that the following
+        calls to find for these points do not need to query the tree.
+
+        Args:
+            coordinates: list of (x, y) tuples
+        """
+        coordinates = list(set(coordinates))
+        self._preloaded = dict(zip(coordinates, self.find_many(coordinates)))
+
+    def clear_preloaded(self):
+        self._preloaded = {}
+
+
+_cache = (None, None)
+
+
+def get_district_index(locations):
+    """
+    Returns a DistrictIndex for locations
+
+    The last index is cached so that calling this for every row with the
+    same locations dict only builds the index once.
+
+    Args:
+        locations: dict of id: Locations
+    Returns:
+        DistrictIndex
+    """
+    global _cache
+    cached_locations, index = _cache
+    if cached_locations is not locations:
+        index = DistrictIndex(locations)
+        _cache = (locations, index)
+    return index
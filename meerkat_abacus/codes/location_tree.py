@@ -0,0 +1,163 @@
+"""
+Location hierarchy with precomputed ancestry for each location
+
+"""
+
+
+class LocationTree:
+    """
+    Holds the locations with everything to_code needs precomputed
+
+    For each location we store an ancestry record with the district,
+    region and zone the location belongs to and the clinic fields that
+    are copied to each row. Coding a row by deviceid is then one lookup in
+    by_deviceid and one in ancestry.
+
+    Each location also gets an interval label (enter, exit) from a depth
+    first walk of the tree, so a location is a descendant of another if
+    its interval is inside the other's interval.
+
+    The zones, regions, districts and locations_by_deviceid are worked out
+    from the locations unless they are given.
+
+    Args:
+        locations: dict of id: Locations
+        locations_by_deviceid: dict of deviceid: location id
+        zones: ids of the zones
+        regions: ids of the regions
+        districts: ids of the districts
+        devices: dict of device_id: tags
+    """
+    def __init__(self, locations, locations_by_deviceid=None, zones=None,
+                 regions=None, districts=None, devices=None):
+        self.locations = locations
+        self.devices = devices if devices is not None else {}
+        if locations_by_deviceid is None:
+            locations_by_deviceid = {}
+            for loc_id, loc in locations.items():
+                if loc.deviceid:
+                    for deviceid in loc.deviceid.split(","):
+                        locations_by_deviceid[deviceid] = loc_id
+        self.by_deviceid = locations_by_deviceid
+        if zones is None:
+            zones = [l for l, loc in locations.items() if loc.level == "zone"]
+        if regions is None:
+            regions = [l for l, loc in locations.items()
+                       if loc.level == "region"]
+        if districts is None:
+            region_set = set(regions)
+            districts = [l for l, loc in locations.items()
+                         if loc.parent_location in region_set and
+                         loc.level == "district"]
+        self.zone_list = list(zones)
+        self.region_list = list(regions)
+        self.district_list = list(districts)
+        self.zones = set(zones)
+        self.regions = set(regions)
+        self.districts = set(districts)
+        self.ancestry = {}
+        for loc_id, loc in locations.items():
+            try:
+                self.ancestry[loc_id] = self._ancestry(loc)
+            except KeyError:
+                # A parent is missing, rows for the location will fail
+                continue
+        self.intervals = self._label(locations)
+
+    def location_data(self):
+        """
+        Returns the locations in the format of util.all_location_data
+        """
+        return (self.locations, self.by_deviceid, self.zone_list,
+                self.region_list, self.district_list, self.devices)
+
+    def clinic_by_deviceid(self, deviceid, prefix=""):
+        """
+        Returns the id of the clinic with deviceid, where deviceid is
+        stored with prefix in front of it
+        """
+        return self.by_deviceid.get(prefix + deviceid)
+
+    def is_child(self, parent, child):
+        """
+        Returns True if child is parent or a descendant of parent
+
+        Returns None if one of the locations is not in the tree.
+        """
+        parent_interval = self.intervals.get(parent)
+        child_interval = self.intervals.get(child)
+        if parent_interval is None or child_interval is None:
+            return None
+        return (parent_interval[0] <= child_interval[0] and
+                child_interval[1] <= parent_interval[1])
+
+    def _ancestry(self, loc):
+        parent = loc.parent_location
+        if parent in self.districts:
+            district = parent
+            region = self.locations[district].parent_location
+            zone = self.locations[region].parent_location
+        elif parent in self.regions:
+            district = None
+            region = parent
+            zone = self.locations[region].parent_location
+        else:
+            district = region = zone = None
+        geolocation = None
+        if loc.point_location is not None:
+            geolocation = loc.point_location.desc
+        return {"clinic_type": loc.clinic_type,
+                "case_type": loc.case_type,
+                "geolocation": geolocation,
+                "district": district,
+                "region": region,
+                "zone": zone,
+                "service_provider": loc.service_provider,
+                "other": loc.other}
+
+    @staticmethod
+    def _label(locations):
+        children = {}
+        roots = []
+        for loc_id, loc in locations.items():
+            if loc.parent_location in locations and loc.parent_location != loc_id:
+                children.setdefault(loc.parent_location, []).append(loc_id)
+            else:
+                roots.append(loc_id)
+        intervals = {}
+        counter = 0
+        for root in roots:
+            stack = [(root, False)]
+            while stack:
+                loc_id, done = stack.pop()
+                if done:
+                    intervals[loc_id] = (intervals[loc_id], counter)
+                    continue
+                if loc_id in intervals:
+                    # A cycle in the parent links
+                    continue
+                counter += 1
+                intervals[loc_id] = counter
+                stack.append((loc_id, True))
+                for child in reversed(children.get(loc_id, [])):
+                    stack.append((child, False))
+        return intervals
+
+
+_cache = (None, None)
+
+
+def get_location_tree(location_data):
+    """
+    Returns a LocationTree for the location data tuple from
+    util.all_location_data
+
+    The last tree is cached so that calling this for every row with the
+    same location data only builds the tree once.
+    """
+    global _cache
+    cached_data, tree = _cache
+    if cached_data is not location_data:
+        tree = LocationTree(*location_data)
+        _cache = (location_data, tree)
+    return tree
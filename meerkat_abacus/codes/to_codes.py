@@ -3,7 +3,9 @@ Functionality to turn raw data into codes
 """
 import meerkat_abacus.model as model
 from meerkat_abacus.codes.variable import Variable
-from geoalchemy2.shape import from_shape, to_shape
+from meerkat_abacus.codes.geometry import get_district_index
+from meerkat_abacus.codes.location_tree import get_location_tree
+from geoalchemy2.shape import from_shape
 from shapely.geometry import Point
 
 def get_variables(session, restrict=None, match_on_type=None, match_on_form=None):
@@ -12,11 +14,15 @@ def get_variables(session, restrict=None, match_on_type=None, match_on_form=None
 
     To speed up the next step of the process we group the variables by calculation_group. 
 
+    We also index the variables by the columns they read, so that to_code
+    only needs to test the variables whose columns are in the row.
+
     Args:
         session: db-session
 
     Returns:
-        dict: dictionary of id:Variable
+        variables(tuple): (variables, variable_forms, variable_tests,
+                           variables_group, match_variables, column_index)
     """
     if restrict:
         result = session.query(model.AggregationVariables).filter(
@@ -67,16 +73,186 @@ def get_variables(session, restrict=None, match_on_type=None, match_on_form=None
             variable_tests[row.id_pk] = variables[row.type][
                 group][row.id_pk].test
 
-
     return (variables, variable_forms, variable_tests,
-            variables_group, match_variables)
+            variables_group, match_variables, get_column_index(variables))
+
+
+def get_column_index(variables):
+    """
+    Index variables by the columns they read
+
+    A variable can only apply to a row if at least one of its columns is
+    in the row. Most variables also need a value other than "" and None
+    in one of their columns. The exceptions are calc variables, which are
+    applicable with empty values, and match variables with an empty
+    condition.
+
+    Args:
+        variables: dict of type: group: id_pk: Variable
+
+    Returns:
+        column_index(tuple): (present_index, filled_index) with
+            column: set of id_pk for the variables that need the column
+            to be present and to have a value respectively
+    """
+    present_index = {}
+    filled_index = {}
+    for groups in variables.values():
+        for group_variables in groups.values():
+            for v, variable in group_variables.items():
+                columns, needs_value = _input_columns(variable)
+                index = filled_index if needs_value else present_index
+                for column in columns:
+                    index.setdefault(column, set())
+                    index[column].add(v)
+    return present_index, filled_index
+
+
+def _input_columns(variable):
+    """
+    Returns the columns read by a Variable and if it needs a value in them
+    """
+    columns = []
+    needs_value = True
+    for test_type, column, condition in zip(variable.test_types,
+                                            variable.columns,
+                                            variable.conditions):
+        if isinstance(column, list):
+            columns += column
+        else:
+            columns.append(column)
+        if test_type == "calc":
+            needs_value = False
+        elif test_type in ["match", "sub_match"] and (
+                "" in condition or None in condition):
+            needs_value = False
+    return columns, needs_value
+
+
+def active_variables(datum, column_index):
+    """
+    Returns the id_pk of all the variables that can apply to datum
+    """
+    present_index, filled_index = column_index
+    active = set()
+    for column in present_index.keys() & datum.keys():
+        active.update(present_index[column])
+    for column in filled_index.keys() & datum.keys():
+        value = datum[column]
+        if value != "" and value is not None:
+            active.update(filled_index[column])
+    return active
 
 
 multiple_method = {"last": -1, "first": 0}
 
 
+def compile_variables(variables, data_type):
+    """
+    Compiles the variables of one data type into a plan for to_code.
+
+    The plan is a tuple (groups, column_index). groups has one
+    (priority_flag, entries) pair per calculation group in the order
+    to_code tests them. Each entry is a flat tuple with what to_code needs
+    to know about a variable:
+
+    (form, v, test, multiple_test, variable_id, categories, alert,
+     disregard, priority)
+
+    v is the id_pk used in the column_index, multiple_test is used instead
+    of test when the form is a link with multiple linked records and alert
+    is True for individual alerts. This way the group priority flags and
+    the variable attributes are worked out once and not for every row.
+
+    Args:
+        variables: variables tuple from get_variables
+        data_type: type of data e.g. case
+
+    Returns:
+        plan(tuple): compiled variables
+    """
+    if len(variables) > 5:
+        column_index = variables[5]
+    else:
+        column_index = get_column_index(variables[0])
+    variables, variable_forms, variable_tests, variables_group = variables[:4]
+    groups = []
+    for group, group_variables in variables.get(data_type, {}).items():
+        # Any variable in the group with priority data will set the flag to True
+        first_variable = next(iter(group_variables.values()), None)
+        priority_flag = getattr(first_variable, "calculation_priority",
+                                None) not in ('', None)
+        entries = []
+        # v is the primary key for the AggregationVariables table, not the
+        # string format id the data table refers the variables with
+        for v in variables_group[group]:
+            if v not in group_variables:
+                # A group with the same name in another data type
+                continue
+            variable = group_variables[v]
+            alert = (bool(variable.variable.alert) and
+                     variable.variable.alert_type == "individual")
+            priority = None
+            if priority_flag:
+                priority = _priority(variable.calculation_priority)
+            entries.append((
+                variable_forms[v],
+                v,
+                variable_tests[v],
+                _multiple_link_test(variable),
+                variable.variable.id,
+                tuple(variable.variable.category or ()),
+                alert,
+                bool(variable.variable.disregard),
+                priority
+            ))
+        groups.append((priority_flag, tuple(entries)))
+    return tuple(groups), column_index
+
+
+def _priority(calculation_priority):
+    try:
+        return int(calculation_priority)
+    except (TypeError, ValueError):
+        return calculation_priority
+
+
+def _multiple_link_test(variable):
+    """
+    Returns the test to use on the list of linked records when the
+    variable's form is a link with multiple records
+    """
+    method = variable.variable.multiple_link
+    test = variable.test
+    if method in multiple_method:
+        index = multiple_method[method]
+        return lambda datum: test(datum[index])
+    elif method == "count":
+        return lambda datum: {"applicable": 1, "value": len(datum)}
+    elif method == "any":
+        def test_any(datum):
+            test_outcome = {"applicable": 0, "value": 0}
+            for d in datum:
+                test_outcome = test(d)
+                if test_outcome:
+                    break
+            return test_outcome
+        return test_any
+    elif method == "all":
+        def test_all(datum):
+            test_outcome = 1
+            for d in datum:
+                if not test(d):
+                    test_outcome = 0
+                    break
+            return test_outcome
+        return test_all
+    return None
+
+
 def to_code(row, variables, locations, data_type,  alert_data,
-            mul_forms, location):
+            mul_forms, location, plan=None, district_index=None,
+            location_tree=None):
     """
     Takes a row and transforms it into a data row
 
@@ -97,12 +273,20 @@ def to_code(row, variables, locations, data_type,  alert_data,
             For each alert we return the value of row[column] as name.
         mul_form: set of links for row
         location: tuple with locations
+        plan: variables compiled with compile_variables, compiled on
+              every call if not given
+        district_index: DistrictIndex for in_geometry locations, the cached
+                        index for locations is used if not given
+        location_tree: LocationTree for locations, the cached tree for
+                       locations is used if not given
     return:
         new_record(model.Data): Data record
         alert(model.Alerts): Alert record if created
     """
     main_form = row["original_form"]
-    locations, locations_by_deviceid, zones, regions, districts, devices = locations
+    if location_tree is None:
+        location_tree = get_location_tree(locations)
+    locations = location_tree.locations
     if "deviceid" in location:
         column = "deviceid"
         prefix = ""
@@ -111,76 +295,61 @@ def to_code(row, variables, locations, data_type,  alert_data,
             column = location.split(":")[1]
             if len(splitted) == 3:
                 prefix = location.split(":")[2]
-        
-        clinic_id = locations_by_deviceid.get(prefix + row[main_form][column],
-                                              None)
+
+        clinic_id = location_tree.clinic_by_deviceid(row[main_form][column],
+                                                     prefix)
         if not clinic_id:
             return (None, None, None, None)
-        clinic_gps = None
-        if locations[clinic_id].point_location is not None:
-            clinic_gps = locations[clinic_id].point_location.desc
+        ancestry = location_tree.ancestry[clinic_id]
         deviceid = row[main_form].get("deviceid")
         ret_location = {
             "clinic": clinic_id,
-            "clinic_type": locations[clinic_id].clinic_type,
-            "case_type": locations[clinic_id].case_type,
-            "tags": devices.get(deviceid),
+            "clinic_type": ancestry["clinic_type"],
+            "case_type": ancestry["case_type"],
+            "tags": location_tree.devices.get(deviceid),
             "country": 1,
             "device_id": deviceid,
-            "geolocation": clinic_gps
+            "geolocation": ancestry["geolocation"],
+            "district": ancestry["district"],
+            "region": ancestry["region"],
+            "zone": ancestry["zone"]
         }
-        if locations[clinic_id].parent_location in districts:
-            ret_location["district"] = locations[clinic_id].parent_location
-            ret_location["region"] = (
-                locations[ret_location["district"]].parent_location)
-            ret_location["zone"] = (
-                 locations[ret_location["region"]].parent_location)
-        elif locations[clinic_id].parent_location in regions:
-            ret_location["district"] = None
-            ret_location["region"] = locations[clinic_id].parent_location
-            ret_location["zone"] = (
-                 locations[ret_location["region"]].parent_location)
-        else:
-            ret_location["district"] = None
-            ret_location["region"] = None
-            ret_location["zone"] = None
-        row[main_form]["clinic_type"] = locations[clinic_id].clinic_type
-        row[main_form]["service_provider"] = locations[clinic_id].service_provider
-        if locations[clinic_id].other:
-            for key in locations[clinic_id].other.keys():
-                row[main_form][key] = locations[clinic_id].other[key]
-            
-        
+        row[main_form]["clinic_type"] = ancestry["clinic_type"]
+        row[main_form]["service_provider"] = ancestry["service_provider"]
+        if ancestry["other"]:
+            for key in ancestry["other"].keys():
+                row[main_form][key] = ancestry["other"][key]
+
     elif "in_geometry" in location:
         fields = location.split("$")[1].split(",")
         try:
             point = Point(float(row[main_form][fields[0]]),
                           float(row[main_form][fields[1]]))
-            found = False
-            for loc in locations.values():
-                if loc.level == "district":
-                    if loc.area is not None and to_shape(loc.area).contains(point):
-                        ret_location = {
-                            "clinic": None,
-                            "clinic_type": None,
-                            "case_type": None, 
-                            "tags": None,
-                            "country": 1,
-                            "district": loc.id,
-                            "region": locations[loc.parent_location].id,
-                            "geolocation": from_shape(point).desc
-                        }
-                        found = True
-                        break
-            if not found:
+            if district_index is None:
+                district_index = get_district_index(locations)
+            district_id = district_index.find(point)
+            if district_id is None:
                 print("Not Found")
                 return (None, None, None, None)
+            loc = locations[district_id]
+            ret_location = {
+                "clinic": None,
+                "clinic_type": None,
+                "case_type": None,
+                "tags": None,
+                "country": 1,
+                "district": loc.id,
+                "region": locations[loc.parent_location].id,
+                "geolocation": from_shape(point).desc
+            }
         except ValueError:
             print("Value Error in point in polygon location")
             return (None, None, None, None)
     else:
         return (None, None, None, None)
-    variables, variable_forms, variable_tests, variables_group, match_variables = variables
+    if plan is None:
+        plan = compile_variables(variables, data_type)
+    match_variables = variables[4]
     variable_json = {}
     categories = {}
     for column in match_variables:
@@ -194,116 +363,72 @@ def to_code(row, variables, locations, data_type,  alert_data,
             variable_json["alert_" + data_var] = row[
                 location_form][alert_data[main_form][data_var]]
     disregard = False
-    for group in variables.get(data_type, {}).keys():
+    groups, column_index = plan
+    # id_pk of the variables that can apply to the row by form
+    active_by_form = {}
+    for priority_flag, entries in groups:
+        # A priority system allows variable values with higher priority order
+        # to overwrite values with lower priority order.
+        intragroup_priority = 0
+        current_group_variable = None
+        for (form, v, test, multiple_test, variable_id, variable_categories,
+             alert, variable_disregard, priority) in entries:
+            datum = row.get(form, None)
+            if not datum:
+                continue
+            if form in mul_forms:
+                test_outcome = multiple_test(datum)
+            else:
+                active = active_by_form.get(form)
+                if active is None:
+                    active = active_variables(datum, column_index)
+                    active_by_form[form] = active
+                if v not in active:
+                    # None of the columns the variable reads are in the row
+                    continue
+                test_outcome = test(datum)
+            if not test_outcome["applicable"]:
+                continue
 
-        # Flag for whether the variable uses a priority system. A priority system allows variable values
-        # with higher priority order to overwrite values with lower priority order.
-        # Any variable in the group with priority data will set the flag to True
-        priority_flag = False
-        for v in variables[data_type][group]:
-            if hasattr(variables[data_type][group][v],"calculation_priority") and \
-               variables[data_type][group][v].calculation_priority not in ('', None):
-                priority_flag = True
-                intragroup_priority = 0  # Initialize the current priority level at zero
-                current_group_variable = None
-                break
+            value = test_outcome["value"]
+            if value == 1:
+                # This is done to allocate an integer into the
+                # variable_json instead of a boolean value
+                value = 1
+            if priority_flag:
+                # This is the initial state
+                if intragroup_priority == 0:
+                    variable_json[variable_id] = value
+                    intragroup_priority = priority
+                    current_group_variable = variable_id
+                # A higher priority order value is encountered
+                elif intragroup_priority > priority:
+                    # remove existing group value of lower priority order
+                    del variable_json[current_group_variable]
+                    variable_json[variable_id] = value
+                    intragroup_priority = priority
+                    current_group_variable = variable_id
+                # Otherwise, do nothing
             else:
+                variable_json[variable_id] = value
+
+            for cat in variable_categories:
+                categories[cat] = variable_id
+            if alert:
+                variable_json["alert"] = 1
+                variable_json["alert_type"] = "individual"
+                variable_json["alert_reason"] = variable_id
+                for data_var in alert_data[row["original_form"]].keys():
+                    variable_json["alert_" + data_var] = row[
+                        main_form].get(alert_data[row["original_form"]][data_var])
+            if variable_disregard:
+                disregard = True
+
+            if not priority_flag:
+                # When handling groups with priority order, loop through every variable.
+                # Otherwise we break out of the current group as all variables
+                # in a group are mutually exclusive
                 break
-        # v is the primary key for the AggregationVariables table, not the string format id the data table refers the variables with
-        for v in variables_group[group]:
-            form = variable_forms[v]
-            datum = row.get(form, None)
-            if datum:
-                if form in mul_forms:
-
-                    method = variables[data_type][group][
-                        v].variable.multiple_link
-                    if method in ["last", "first"]:
-                        data = datum[multiple_method[method]]
-                        test_outcome = variables[data_type][group][
-                            v].test(data)
-                    elif method == "count":
-                        test_outcome = {"applicable": 1,
-                                        "value": len(datum)}
-                    elif method == "any":
-                        test_outcome = {"applicable": 0,
-                                        "value": 0}
-                        for d in datum:
-                            test_outcome = variables[data_type][group][
-                                v].test(d)
-                            if test_outcome:
-                                break
-                    elif method == "all":
-                        test_outcome = 1
-                        for d in datum:
-                            t_o = variables[data_type][group][v].test(d)
-                            if not t_o:
-                                test_outcome = 0
-                                break
-                else:
-                    test_outcome = variable_tests[v](datum)
-
-                #if there is no test outcome but there is another variable in the priority queue, test the variable next in prioritisation
-                #if not test_outcome:
-                #    test_outcome = variable_tests[v_backup](datum)
-
-                if test_outcome["applicable"]:
-                    
-                    if test_outcome["value"] == 1:
-                        # This is done to allocate an integer into the
-                        # test_outcome instead of a boolean value
-                        test_outcome["value"] = 1
-
-                    # fetch the string key for the current variable
-                    variable_string_key = variables[data_type][group][v].variable.id
-
-                    # Check whether the variable group uses a priority system
-                    if priority_flag:
-                        # This is the initial state
-                        if intragroup_priority == 0:
-                            variable_json[variables[data_type][
-                                group][v].variable.id] = test_outcome["value"]  # insert new value
-                            intragroup_priority = int(variables[data_type][
-                                group][v].calculation_priority)  # store current intragroup priority
-                            current_group_variable = variables[data_type][
-                                group][v].variable.id  # store the variable id
-
-                        # A higher priority order value is encountered
-                        elif intragroup_priority > int(variables[data_type][group][v].calculation_priority): 
-                            del variable_json[current_group_variable]  # remove existing group value of lower priority order
-                            variable_json[variables[data_type][
-                                group][v].variable.id] = test_outcome["value"]  # insert new value
-                            intragroup_priority = int(variables[data_type][
-                                group][v].calculation_priority)  # store current intragroup priority
-                            current_group_variable = variables[data_type][
-                                group][v].variable.id  # store the variable id
-
-                        # Otherwise, do nothing
-                    else:
-                        #allocate the test outcome to the json object using the variable string id as key
-                        variable_json[variables[data_type][
-                            group][v].variable.id] = test_outcome["value"]
-
-                    for cat in variables[data_type][
-                            group][v].variable.category:
-                        categories[cat] = variables[data_type][
-                            group][v].variable.id
-                    
-                    if variables[data_type][group][v].variable.alert:
-                        if variables[data_type][group][
-                                v].variable.alert_type == "individual":
-                            variable_json["alert"] = 1
-                            variable_json["alert_type"] = "individual"
-                            variable_json["alert_reason"] = variables[
-                                data_type][group][v].variable.id
-                            for data_var in alert_data[row["original_form"]].keys():
-                                variable_json["alert_" + data_var] = row[
-                                    main_form].get(alert_data[row["original_form"]][data_var])
-                    if variables[data_type][group][v].variable.disregard:
-                        disregard = True
-
-                    if not priority_flag: # When handling groups with priority order, loop through every variable
-                        break  # We break out of the current group as all variables in a group are mutually exclusive
 
     if disregard and variable_json.get("alert_type", None) != "individual":
         disregard = False
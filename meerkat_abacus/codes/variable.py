@@ -3,10 +3,12 @@ Definition of the Variable class
 
 
 """
+import re
 from dateutil.parser import parse
 from functools import partial
 from datetime import datetime, timedelta
 from meerkat_abacus.config import config
+from meerkat_abacus.util.datetime_helper import allowed_formats
 country_config = config.country_config
 
 
@@ -28,7 +30,7 @@ class Variable():
         self.operations = []
         self.test_types = []
         i = 0
-        self.bool_expression = ""
+        bool_expression = ""
         self.bool_variables = []
         bool_trans = {"and": "&", "or": "|"}
         for term in variable.method.split(" "):
@@ -41,17 +43,18 @@ class Variable():
                         "{} has wrong test type".format(variable.id)
                     )
                 var = chr(97 + i)
-                self.bool_expression += 'res_dict["' + var + '"]'
+                bool_expression += var
                 self.bool_variables.append(var)
             else:
                 if term in ["and", "or", "not"]:
                     self.operations.append(term)
-                    self.bool_expression += bool_trans[term]
+                    bool_expression += bool_trans[term]
                 else:
                     raise NameError("Wrong logic type")
             i += 1
-        self.bool_expression = compile(self.bool_expression, "<string>",
-                                       "eval")
+        self.bool_expression = eval(
+            "lambda " + ", ".join(self.bool_variables) + ": " + bool_expression
+        )
         self.conditions = []
         for condition in variable.condition.split(";"):
             if "," in condition:
@@ -87,13 +90,10 @@ class Variable():
         elif "calc" in self.test_types:
             if len(self.test_types) > 1:
                 raise NameError("calc must be only test_type")
-            self.calculation = variable.calculation
             if not isinstance(self.columns[0], list):
                 self.columns[0] = [self.columns[0]]
-            for c in self.columns[0]:
-                self.calculation = self.calculation.replace(
-                    c, 'row["' + c + '"]')
-            self.calculation = compile(self.calculation, "<string>", "eval")
+            self.calculation = compile_expression(variable.calculation,
+                                                  self.columns[0])
             self.test_type = self.test_calc
 
         elif len(self.test_types) == 1:
@@ -107,16 +107,8 @@ class Variable():
             elif tt == "between":
                 if not isinstance(self.columns[0], list):
                     self.columns[0] = [self.columns[0]]
-
-                self.calculation = variable.calculation
-
-                for c in self.columns[0]:
-                    self.calculation = self.calculation.replace(
-                        c, 'row["' + c + '"]'
-                    )
-                self.calculation = compile(
-                    self.calculation, "<string>", "eval"
-                )
+                self.calculation = compile_expression(variable.calculation,
+                                                      self.columns[0])
                 self.test_type = partial(self.test_calc_between,
                                          self.columns[0], self.conditions[0],
                                          self.calculation)
@@ -133,12 +125,10 @@ class Variable():
                     if self.test_types[i] == "between":
                         if not isinstance(self.columns[i], list):
                             self.columns[i] = [self.columns[i]]
-                        for c in self.columns[i]:
-                            calc = calc.replace(
-                                c, 'row["' + c + '"]')
-                        calc = compile(calc, "<string>", "eval")
-                        self.calculation[i] = calc
-
+                        self.calculation[i] = compile_expression(
+                            calc, self.columns[i])
+            self.tests = [self._single_test(i)
+                          for i in range(len(self.test_types))]
             self.test_type = self.test_many
 
         if hasattr(variable, "calculation_priority"):
@@ -172,30 +162,30 @@ class Variable():
         return {"applicable": bool(applicable),
                 "value": value}
 
-    def test_many(self, row):
-
-        res_dict = {}
-        for i in range(len(self.test_types)):
-            tt = self.test_types[i]
-            if tt == "match":
-                res = self.test_match(self.columns[i], self.conditions[i], row)
-            elif tt == "sub_match":
-                res = self.test_sub_match(self.columns[i], self.conditions[i],
-                                          row)
-            elif tt == "between":
-                if not isinstance(self.columns[i], list):
-                    self.columns[i] = [self.columns[i]]
-
-                res = self.test_calc_between(self.columns[i],
-                                             self.conditions[i],
-                                             self.calculation[i], row)
-            elif tt == "not_null":
-                res = self.test_not_null(self.columns[i], row)
+    def _single_test(self, i):
+        """
+        Returns the test function for test number i of a combined test
+        """
+        tt = self.test_types[i]
+        if tt == "match":
+            return partial(self.test_match, self.columns[i], self.conditions[i])
+        elif tt == "sub_match":
+            return partial(self.test_sub_match, self.columns[i],
+                           self.conditions[i])
+        elif tt == "between":
+            if not isinstance(self.columns[i], list):
+                self.columns[i] = [self.columns[i]]
+            calculation = getattr(self, "calculation", None)
+            return partial(self.test_calc_between, self.columns[i],
+                           self.conditions[i],
+                           calculation[i] if calculation else None)
+        elif tt == "not_null":
+            return partial(self.test_not_null, self.columns[i])
+        else:
+            return self.test_functions[tt]
 
-            else:
-                res = self.test_functions[self.test_types[i]](row)
-            res_dict[self.bool_variables[i]] = res
-        return eval(self.bool_expression)
+    def test_many(self, row):
+        return self.bool_expression(*[test(row) for test in self.tests])
 
     def test_match(self, column, condition, row):
         """Test if value is in condition list"""
@@ -252,29 +242,27 @@ class Variable():
                           columns,
                           condition,
                           calc,
-                          old_row):
+                          row):
         """
-        self. calc should be an expression with column names
-        from the row and mathematical expression  understood by python.
-        We then replace all column names with their numerical values
-        and evalualte the resulting expression.
+        calc is a compiled calculation taking the values of the
+        columns as arguments. We pass the numerical values of the columns
+        and check if the result is between the conditions.
 
         """
-
-        row = {}
+        values = []
         for c in columns:
             # Initialise non-existing variables to 0.
-            if c not in old_row or old_row[c] == '' or old_row[c] is None:
+            if c not in row or row[c] == '' or row[c] is None:
                 return 0
 
             # If row[c] is a datestring convert to #seconds.
             try:
-                row[c] = float(old_row[c])
+                values.append(float(row[c]))
             except ValueError:
-                row[c] = old_row[c]
+                values.append(row[c])
 
         try:
-            result = float(eval(calc))
+            result = float(calc(*values))
             greater = float(condition[0]) <= result
             less = float(condition[1]) > result
             return greater & less
@@ -283,38 +271,36 @@ class Variable():
         except ValueError as e:
             print("Value error while testing for code ", self.variable.id)
             raise e
-            
 
-    def test_calc(self, old_row):
+    def test_calc(self, row):
         """
-        self. calc should be an expression with column names from
-        the row and mathematical expression understood by python.
-        We then replace all column names with their numerical values
-        and evalualte the resulting expression.
+        self.calculation is a compiled calculation taking the values of
+        the columns as arguments. We pass the numerical values of the
+        columns and return the result.
 
         If the column value is a date, we replace with the number of
         seconds since epi week start after epoch (e.g the first
         sunday after epoch for Jordan).
 
         """
-        row = {}
+        values = []
         for c in self.columns[0]:
 
             # Initialise non-existing variables to 0.
-            if c not in old_row:
+            if c not in row:
                 return "not_applicable"
 
-            if old_row[c] == '' or old_row[c] is None:
-                row[c] = 0
+            if row[c] == '' or row[c] is None:
+                values.append(0)
             else:
                 try:
-                    row[c] = float(old_row[c])
+                    values.append(float(row[c]))
                 except ValueError:
-                    row[c] = old_row[c]
+                    values.append(row[c])
 
         try:
-            return float(eval(self.calculation))
-        
+            return float(self.calculation(*values))
+
         except ZeroDivisionError:
             return 0
 
@@ -366,20 +352,40 @@ class Variable():
         # If the element didn't conform to a date format, just return element.
         return element
 
-# A list of the valid datestring formats
-allowed_formats = [
-    '%b %d, %Y',
-    '%d-%b-%Y',
-    '%Y-%m-%d',
-    '%d-%b-%Y %I:%M:%S',
-    '%d-%b-%Y %H:%M:%S',
-    '%b %d, %Y %I:%M:%S %p',
-    '%Y-%m-%dT%H:%M:%S.%f',
-    '%Y-%m-%dT%H:%M:%S.%fZ',
-    '%Y-%m-%dT%H:%M:%S'
-]
-
-    
+
+def compile_expression(expression, columns):
+    """
+    Compiles a python expression using column names into a function
+    that takes the value of each column as a positional argument.
+
+    The expression is only parsed once, so calling the function is as
+    cheap as calling a normal python function.
+
+    Args:
+        expression: expression e.g. "weight / (height * height)"
+        columns: list of the column names used in the expression
+
+    Returns:
+        function: function(*column_values)
+    """
+    arguments = {}
+    parameters = []
+    for i, column in enumerate(columns):
+        parameter = "__column_{}__".format(i)
+        parameters.append(parameter)
+        arguments.setdefault(column, parameter)
+    if arguments:
+        # Replace the longest names first and in one pass so that a column
+        # name that is part of another column name is not replaced twice
+        pattern = "|".join(re.escape(c) for c in sorted(arguments, key=len,
+                                                         reverse=True))
+        expression = re.sub(pattern, lambda m: arguments[m.group(0)],
+                            expression)
+    source = "lambda {}: {}".format(", ".join(parameters), expression)
+    return eval(compile(source, "<string>", "eval"), globals())
+
+
+
 months = {
     "Jan": 1,
     "Feb": 2,
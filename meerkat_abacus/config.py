@@ -21,6 +21,104 @@ GET_DATA_FROM_S3: if we should download data from an S3 bucket
 
 START_CELERY: if we want to star the celery hourly tasks
 
+LINK_CACHE: if the add_links step should keep the linked forms in memory
+instead of querying the db for each record (default True)
+
+LINK_CACHE_MAX_ROWS: maximum number of form rows in the link cache
+
+THRESHOLD_COUNTERS: if the add_multiple_alerts step should keep counts of
+the threshold alert variables by clinic, day and epi week in memory instead
+of querying the db for each record (default True)
+
+THRESHOLD_COUNTERS_DAYS: number of days before the newest record the
+threshold counters keep counts for, older records are checked with a db
+query (default 60)
+
+ALERT_WEEKLY_COUNTS: if the write_to_db step should keep the weekly counts of
+the double alert variables in the alert_weekly_counts table and the
+add_multiple_alerts step should read the double alerts from it. This makes
+write_to_db write each chunk in a transaction, also in the delete_insert
+write mode (default False)
+
+DB_WRITER: "insert" or "copy", how the write_to_db step writes rows.
+Overrides db_writer in the country config (default "insert")
+
+DB_WRITE_MODE: "delete_insert" or "upsert", how the write_to_db step
+replaces existing data records. Overrides db_write_mode in the country
+config (default "delete_insert")
+
+UNIQUE_INDEX_MIGRATION: if the database setup should create the unique
+(uuid, type) indexes of data and disregarded_data, needed for the upsert
+write mode, in dbs created before they were added. Duplicate records are
+deleted, keeping the last one written (default False)
+
+CHUNK_TRANSACTION: if the pipeline should process each chunk in one
+db transaction (default False)
+
+STREAMING_PIPELINE: if the pipeline should run each step in its own thread
+with micro-batches passed between the steps over bounded queues
+(default False). Only the db waits of the steps overlap, the python work
+is still limited to one core by the GIL
+
+STREAM_BATCH_SIZE: number of records in each micro-batch (default 100)
+
+STREAM_QUEUE_SIZE: number of micro-batches that can wait in front of each
+step (default 4)
+
+PARALLEL_WORKERS: number of forked processes to run the cpu only steps
+(quality_control, to_data_type and to_codes) in, 0 to run them in the
+worker process (default 0). The processes of the default celery prefork
+pool can not fork, so this needs the celery worker to run with
+--pool solo
+
+DB_POOL_SIZE: number of db connections each pipeline worker process keeps
+open (default 5)
+
+DB_MAX_OVERFLOW: number of connections a worker can open on top of
+DB_POOL_SIZE when they are all in use (default 5)
+
+DB_POOL_RECYCLE: seconds after which a pooled connection is replaced
+(default 1800)
+
+DB_POOL_TIMEOUT: seconds to wait for a free connection (default 30)
+
+MAX_IN_FLIGHT_CHUNKS: number of chunks the consumer keeps queued or in
+processing during the initial load (default 15)
+
+FLOW_CONTROL: how the consumer counts the chunks in flight, "results" to
+count the tasks whose results have not come back or "queue" to read the
+number of messages in the worker queue from the broker
+(default "results")
+
+CLAIM_CHECK: if the consumer should write the chunks to the spool directory
+and only send a reference to the file to the workers (default False)
+
+SPOOL_DIRECTORY: directory shared by the consumer and the workers for the
+chunks sent with CLAIM_CHECK (default DATA_DIRECTORY/spool/)
+
+SPOOL_MAX_AGE: seconds after which a chunk left in the spool, e.g. by a lost
+task or a crashed consumer, is removed when the consumer starts
+(default 86400)
+
+S3_INCREMENTAL: if the S3 data stream should only fetch the bytes appended
+to the CSV files since the last read (default True)
+
+S3_MARKER_FILE: file where we keep how far we have read each CSV file in S3
+(default DATA_DIRECTORY/s3_markers.json)
+
+LOAD_WORKERS: number of forms the consumer reads at the same time in the
+initial load, the order is set by initial_load_dependencies in the country
+config (default 1)
+
+SQS_RECEIVERS: number of threads long polling SQS for the data stream
+(default 4)
+
+SQS_CHUNK_SIZE: number of records from SQS to send to the workers in
+each chunk (default 500)
+
+SQS_MAX_WAIT: seconds a record from SQS can wait for its chunk to fill up
+before it is sent (default 5)
+
 """
 import os
 import importlib.util
@@ -84,6 +182,15 @@ class Config:
         # )
 
         self.consul_enabled = os.environ.get("CONSUL_ENABLED", "False") == "True"
+
+        # Link cache for the add_links step
+        self.link_cache = os.environ.get("LINK_CACHE", "True") == "True"
+        self.link_cache_max_rows = int(os.environ.get("LINK_CACHE_MAX_ROWS", 500000))
+        # Threshold alert counters for the add_multiple_alerts step
+        self.threshold_counters = os.environ.get("THRESHOLD_COUNTERS", "True") == "True"
+        self.threshold_counters_days = int(os.environ.get("THRESHOLD_COUNTERS_DAYS", 60))
+        # Weekly counts table for the double alerts
+        self.alert_weekly_counts = os.environ.get("ALERT_WEEKLY_COUNTS", "False") == "True"
         # Country config
         country_config_file = os.environ.get("COUNTRY_CONFIG", "demo_config.py")
 
@@ -107,6 +214,38 @@ class Config:
 
         self.s3_bucket = country_config_module.s3_bucket
 
+        self.db_writer = os.environ.get(
+            "DB_WRITER", self.country_config.get("db_writer", "insert"))
+        self.db_write_mode = os.environ.get(
+            "DB_WRITE_MODE",
+            self.country_config.get("db_write_mode", "delete_insert"))
+        self.unique_index_migration = os.environ.get(
+            "UNIQUE_INDEX_MIGRATION", "False") == "True"
+        self.chunk_transaction = os.environ.get(
+            "CHUNK_TRANSACTION", "False") == "True"
+        self.streaming_pipeline = os.environ.get(
+            "STREAMING_PIPELINE", "False") == "True"
+        self.stream_batch_size = int(os.environ.get("STREAM_BATCH_SIZE", 100))
+        self.stream_queue_size = int(os.environ.get("STREAM_QUEUE_SIZE", 4))
+        self.parallel_workers = int(os.environ.get("PARALLEL_WORKERS", 0))
+        self.db_pool_size = int(os.environ.get("DB_POOL_SIZE", 5))
+        self.db_max_overflow = int(os.environ.get("DB_MAX_OVERFLOW", 5))
+        self.db_pool_recycle = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+        self.db_pool_timeout = int(os.environ.get("DB_POOL_TIMEOUT", 30))
+        self.max_in_flight_chunks = int(os.environ.get("MAX_IN_FLIGHT_CHUNKS", 15))
+        self.flow_control = os.environ.get("FLOW_CONTROL", "results")
+        self.claim_check = os.environ.get("CLAIM_CHECK", "False") == "True"
+        self.spool_directory = os.environ.get("SPOOL_DIRECTORY",
+                                              self.data_directory + "spool/")
+        self.spool_max_age = int(os.environ.get("SPOOL_MAX_AGE", 86400))
+        self.s3_incremental = os.environ.get("S3_INCREMENTAL", "True") == "True"
+        self.s3_marker_file = os.environ.get(
+            "S3_MARKER_FILE", self.data_directory + "s3_markers.json")
+        self.load_workers = int(os.environ.get("LOAD_WORKERS", 1))
+        self.sqs_receivers = int(os.environ.get("SQS_RECEIVERS", 4))
+        self.sqs_chunk_size = int(os.environ.get("SQS_CHUNK_SIZE", 500))
+        self.sqs_max_wait = float(os.environ.get("SQS_MAX_WAIT", 5))
+
         # Configure data initialisation
         self.initial_data_source = os.environ.get("INITIAL_DATA_SOURCE", "FAKE_DATA")
         self.PERSISTENT_DATABASE_URL = None
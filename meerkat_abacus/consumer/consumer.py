@@ -1,6 +1,5 @@
 import celery
 from celery import Celery
-from celery.task.control import inspect
 import time
 import backoff
 
@@ -52,24 +51,25 @@ elif config.initial_data_source in ["AWS_RDS", "LOCAL_RDS"]:
 else:
     raise AttributeError(f"Invalid source {config.initial_data_source}")
 
-number_by_form = get_data.read_stationary_data(get_function, config, app)
+flow_controller = get_data.get_flow_controller(app, config)
+if config.load_workers > 1:
+    number_by_form = get_data.read_stationary_data_parallel(
+        get_function, config, app, workers=config.load_workers,
+        flow_controller=flow_controller)
+else:
+    number_by_form = get_data.read_stationary_data(
+        get_function, config, app, flow_controller=flow_controller)
 
 
 database_setup.logg_tables(config.country_config["tables"], engine)
 
 # Wait for initial setup to finish
 
-celery_inspect = inspect()
-for i in range(5):
-    celery_queues = celery_inspect.reserved()
-    inspect_result = celery_queues.get("celery@abacus", [])
-    if len(inspect_result) > 0:
-        break
-    logger.info(f"Avaiable celery queues: {inspect_result}")
-    time.sleep(20)
-else:
+if not flow_controller.join(timeout=3600):
     setup_time = round(time.time() - start_time)
     logger.error(f"Failed to wait for message queue after {setup_time} seconds.")
+logger.info(f"Sent {flow_controller.sent} chunks, waited "
+            f"{round(flow_controller.wait_time)} seconds for the workers")
 setup_time = round(time.time() - start_time)
 logger.info(f"Finished setup in {setup_time} seconds")
 
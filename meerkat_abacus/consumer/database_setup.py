@@ -15,6 +15,9 @@ from meerkat_abacus.config import config
 from meerkat_abacus import model
 from meerkat_abacus import util
 from meerkat_abacus import logger
+from meerkat_abacus.util.config_registry import registry
+from meerkat_abacus.pipeline_worker.alert_weekly_counts import (
+    double_alert_variables, rebuild_counts)
 
 
 def create_db(url, drop=False):
@@ -63,29 +66,15 @@ def import_variables(session, param_config):
     session.query(model.AggregationVariables).delete()
     session.commit()
 
-    country_config = param_config.country_config
-    # check if the coding_list parameter exists. If not, use the legacy parameter codes_file instead
-    if 'coding_list' in country_config.keys():
-        for coding_file_name in country_config['coding_list']:
-            codes_file = param_config.config_directory + 'variable_codes/' + coding_file_name
-            for row in util.read_csv(codes_file):
-                if '' in row.keys():
-                    row.pop('')
-                row = util.field_to_list(row, "category")
-                keys = model.AggregationVariables.__table__.columns._data.keys()
-                row = {key: row[key] for key in keys if key in row}
-                session.add(model.AggregationVariables(**row))
-            session.commit()
-    else:
-        codes_file = param_config.config_directory + param_config.country_config['codes_file'] + '.csv'
-        for row in util.read_csv(codes_file):
-            if '' in row.keys():
-                row.pop('')
-            row = util.field_to_list(row, "category")
-            keys = model.AggregationVariables.__table__.columns._data.keys()
-            row = {key: row[key] for key in keys if key in row}
-            session.add(model.AggregationVariables(**row))
-        session.commit()
+    keys = model.AggregationVariables.__table__.columns._data.keys()
+    for row in registry.codes(param_config=param_config):
+        row = dict(row)
+        if '' in row.keys():
+            row.pop('')
+        row = util.field_to_list(row, "category")
+        row = {key: row[key] for key in keys if key in row}
+        session.add(model.AggregationVariables(**row))
+    session.commit()
 
 
 def import_clinics(csv_file, session, country_id, param_config,
@@ -402,11 +391,19 @@ def set_up_database(leave_if_data, drop_db, param_config):
             session = Session()
             if len(session.query(model.Data).all()) > 0:
                 set_up = False
+                if param_config.unique_index_migration:
+                    add_unique_indexes(engine)
+                rebuild_alert_weekly_counts(engine, session, param_config)
     if set_up:
         logger.info("Create DB")
         create_db(param_config.DATABASE_URL, drop=drop_db)
         if param_config.db_dump:
             import_dump(param_config.db_dump)
+            engine = create_engine(param_config.DATABASE_URL)
+            if param_config.unique_index_migration:
+                add_unique_indexes(engine)
+            Session = sessionmaker(bind=engine)
+            rebuild_alert_weekly_counts(engine, Session(), param_config)
             return set_up
         engine = create_engine(param_config.DATABASE_URL)
         Session = sessionmaker(bind=engine)
@@ -441,6 +438,57 @@ def set_up_database(leave_if_data, drop_db, param_config):
     return session, engine
 
 
+def add_unique_indexes(engine):
+    """
+    Creates the unique (uuid, type) indexes of data and disregarded_data
+    in dbs created before they were added to the model, they are needed
+    for DB_WRITE_MODE=upsert
+
+    Only run when UNIQUE_INDEX_MIGRATION is set, as duplicate records are
+    deleted first, keeping the last one written.
+    """
+    for table in [model.Data.__table__, model.DisregardedData.__table__]:
+        index = model.unique_index(table)
+        with engine.begin() as connection:
+            exists = connection.execute(
+                "SELECT 1 FROM pg_indexes WHERE tablename = %s "
+                "AND indexname = %s", (table.name, index.name)).scalar()
+            if exists:
+                continue
+            deleted = connection.execute(
+                f"DELETE FROM {table.name} a USING {table.name} b "
+                "WHERE a.uuid = b.uuid AND a.type = b.type AND a.id < b.id"
+            ).rowcount
+            if deleted:
+                logger.warning(
+                    f"Deleted {deleted} duplicate records from {table.name}")
+            logger.info(f"Creating index {index.name}")
+            index.create(connection)
+
+
+def rebuild_alert_weekly_counts(engine, session, param_config):
+    """
+    Calculates the alert_weekly_counts from the data table if the table
+    was just created or is empty, for databases with data that was not
+    written by the pipeline
+
+    The pipeline does not keep the counts when ALERT_WEEKLY_COUNTS is off,
+    so we then empty the table to have the counts rebuilt when it is
+    turned on again.
+    """
+    table = model.AlertWeeklyCounts.__table__
+    if not param_config.alert_weekly_counts:
+        if table.exists(engine):
+            engine.execute(table.delete())
+        return
+    table.create(engine, checkfirst=True)
+    if engine.execute(table.select().limit(1)).first() is not None:
+        return
+    logger.info("Calculating the alert_weekly_counts")
+    with engine.begin() as connection:
+        rebuild_counts(connection, double_alert_variables(session))
+
+
 def unlogg_tables(form_tables, engine):
     for table in ["data", "disregarded_data"] + form_tables:
         engine.execute(f"ALTER TABLE {table} SET UNLOGGED;")
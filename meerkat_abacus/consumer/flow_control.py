@@ -0,0 +1,123 @@
+"""
+Flow control for sending chunks of data to the pipeline workers
+
+"""
+import collections
+import time
+
+from meerkat_abacus import logger
+from meerkat_abacus.util import spool
+
+
+class FlowController:
+    """
+    Keeps at most max_in_flight chunks waiting for or in the workers
+
+    Chunks are sent as process_data tasks. Before sending we wait until
+    fewer than max_in_flight chunks are in flight, checking every
+    poll_interval seconds, so the next chunk goes out as soon as one
+    finishes and the workers always have the next chunks ready.
+
+    There are two ways to count the chunks in flight:
+
+    "results": the tasks we have sent whose results have not come back.
+                This counts both the queued chunks and the ones the
+                workers are processing, and needs a result backend.
+    "queue": the number of messages in the worker queue, read from the
+             broker with a passive queue declare. This only counts the
+             queued chunks, not the ones the workers have taken.
+
+    If spool_directory is given the chunks are written to the spool and
+    the tasks only get a reference to the file, see util.spool. Files
+    older than spool_max_age seconds are removed from the spool when the
+    FlowController is created.
+
+    Args:
+        celery_app: celery app to send the tasks with
+        max_in_flight: number of chunks to keep in flight
+        method: "results" or "queue"
+        queue: name of the worker queue, for the "queue" method
+        poll_interval: seconds between checks when max_in_flight is reached
+        spool_directory: path to the spool for the chunks
+        spool_max_age: seconds after which a file in the spool is left over
+    """
+    def __init__(self, celery_app, max_in_flight=15, method="results",
+                 queue="abacus", poll_interval=0.2, spool_directory=None,
+                 spool_max_age=86400):
+        if method not in ("results", "queue"):
+            raise ValueError(f"Unknown flow control method {method}")
+        self.celery_app = celery_app
+        self.max_in_flight = max_in_flight
+        self.method = method
+        self.queue = queue
+        self.poll_interval = poll_interval
+        self.spool_directory = spool_directory
+        if spool_directory is not None:
+            removed = spool.sweep(spool_directory, spool_max_age)
+            if removed:
+                logger.warning(f"Removed {removed} old files from the spool")
+        self.results = collections.deque()
+        self.sent = 0
+        self.wait_time = 0
+
+    def send(self, data):
+        """
+        Sends a chunk to the workers once there is room for it
+        """
+        start = time.perf_counter()
+        logged = False
+        while self.in_flight() >= self.max_in_flight:
+            if not logged:
+                logger.info(f"{self.max_in_flight} chunks in flight, waiting")
+                logged = True
+            time.sleep(self.poll_interval)
+        self.wait_time += time.perf_counter() - start
+        logger.info("Sending data")
+        if self.spool_directory is not None:
+            data = spool.write_chunk(data, self.spool_directory)
+        result = self.celery_app.send_task("processing_tasks.process_data",
+                                           [data])
+        self.sent += 1
+        if self.method == "results":
+            self.results.append(result)
+
+    def join(self, timeout=None):
+        """
+        Waits until all the chunks that were sent are processed
+
+        With the "queue" method this waits until the queue is empty, the
+        workers can still be processing the last chunks.
+
+        Returns:
+            True if everything was processed before the timeout
+        """
+        start = time.perf_counter()
+        while self.in_flight() > 0:
+            if timeout is not None and time.perf_counter() - start > timeout:
+                return False
+            time.sleep(self.poll_interval)
+        return True
+
+    def in_flight(self):
+        """
+        Returns the number of chunks in flight
+        """
+        if self.method == "queue":
+            return self.queue_depth()
+        results = self.results
+        # The results mostly come back in the order we sent the tasks
+        while results and results[0].ready():
+            results.popleft()
+        if len(results) >= self.max_in_flight:
+            self.results = results = collections.deque(
+                result for result in results if not result.ready())
+        return len(results)
+
+    def queue_depth(self):
+        """
+        Returns the number of messages waiting in the worker queue
+        """
+        with self.celery_app.connection_or_acquire() as connection:
+            declared = connection.default_channel.queue_declare(
+                queue=self.queue, passive=True)
+        return declared.message_count
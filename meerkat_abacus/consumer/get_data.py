@@ -1,67 +1,181 @@
 import boto3
+import queue
+import threading
 import time
 import json
-from celery.task.control import inspect
 
+from meerkat_abacus.consumer.flow_control import FlowController
+from meerkat_abacus.consumer.s3_tail import S3Tail
+from meerkat_abacus.consumer.sqs_ingest import SQSIngestor
 from meerkat_abacus.util import create_fake_data
 from meerkat_abacus import util, logger
 
 
 def read_stationary_data(get_function, param_config, celery_app, N_send_to_task=15000,
-                         previous_number_by_form={}):
+                         previous_number_by_form={}, flow_controller=None):
     """
     Read stationary data using the get_function to determine the source
+
+    The chunks are sent to the workers through flow_controller, by
+    default a FlowController with the settings in param_config.
+
+    previous_number_by_form has the index of the last record that was
+    sent for each form, the records up to it are skipped.
+
+    Returns:
+        number_by_form: index of the last record for each form
     """
-    celery_inspect = inspect()
+    if flow_controller is None:
+        flow_controller = get_flow_controller(celery_app, param_config)
 
     number_by_form = {}
     for form_name in param_config.country_config["tables"]:
 
-        start = previous_number_by_form.get(form_name, 0)
+        start = previous_number_by_form.get(form_name, -1) + 1
         logger.info(f"Start processing data for form {form_name}")
         data = []
+        i = -1
         for i, element in enumerate(get_function(form_name, param_config=param_config)):
             if i < start:
-                next
+                continue
             data.append({"form": form_name,
                          "data": dict(element)})
             if i % N_send_to_task == 0:
                 logger.info(f"Processed {i} records")
-                send_task(data, celery_app, celery_inspect)
+                flow_controller.send(data)
                 data = []
         if data:
-            send_task(data, celery_app, celery_inspect)
+            flow_controller.send(data)
         logger.info("Finished processing data.")
         logger.info(f"Processed {i} records")
         number_by_form[form_name] = i
     return number_by_form
 
 
-def get_N_tasks(inspect, name):
-    try: 
-        registered = len(inspect.registered()[name])
-        reserved = len(inspect.reserved()[name])
-    except:
-        registered = 0
-        reserved = 0
-    logger.info(f"registered {registered}, reserved {reserved}")
-    return reserved + registered
+def read_stationary_data_parallel(get_function, param_config, celery_app,
+                                  N_send_to_task=15000, workers=4,
+                                  dependencies=None, flow_controller=None,
+                                  send_queue_size=8):
+    """
+    Reads the forms in parallel and sends the chunks from one queue
+
+    Each form is read in its own thread, at most workers at a time. The
+    readers put the chunks on a bounded queue and the chunks are sent
+    from this thread, so a reader waits when the workers can not keep up.
 
+    A form is only read once the forms it depends on have all their
+    chunks on the queue, so their chunks are sent first. dependencies is
+    a dict of form: list of forms to load before it, by default
+    initial_load_dependencies in the country config.
 
-def send_task(data, celery_app, inspect, N=15):
+    Returns:
+        number_by_form: index of the last record for each form
     """
-    Sends data to process queue if the the are less than N tasks waiting
+    forms = param_config.country_config["tables"]
+    if dependencies is None:
+        dependencies = param_config.country_config.get(
+            "initial_load_dependencies", {})
+    dependencies = {form: [d for d in dependencies.get(form, []) if d in forms]
+                    for form in forms}
+    check_dependencies(dependencies)
+    if flow_controller is None:
+        flow_controller = get_flow_controller(celery_app, param_config)
 
+    chunks = queue.Queue(maxsize=send_queue_size)
+    loaded = {form: threading.Event() for form in forms}
+    slots = threading.Semaphore(workers)
+    stop = threading.Event()
 
+    def read_form(form_name):
+        try:
+            for dependency in dependencies[form_name]:
+                loaded[dependency].wait()
+            with slots:
+                logger.info(f"Start processing data for form {form_name}")
+                data = []
+                i = -1
+                for i, element in enumerate(get_function(form_name,
+                                                         param_config=param_config)):
+                    if stop.is_set():
+                        return
+                    if type(element) is not dict:
+                        element = dict(element)
+                    data.append({"form": form_name, "data": element})
+                    if len(data) == N_send_to_task:
+                        chunks.put((form_name, data))
+                        data = []
+                if data:
+                    chunks.put((form_name, data))
+                logger.info(f"Processed {i + 1} records for form {form_name}")
+                chunks.put((form_name, i))
+        except Exception as exception:
+            chunks.put((form_name, exception))
+        finally:
+            loaded[form_name].set()
+
+    threads = [threading.Thread(target=read_form, args=(form,), daemon=True,
+                                name=f"load-{form}")
+               for form in forms]
+    for thread in threads:
+        thread.start()
+    number_by_form = {}
+    try:
+        while len(number_by_form) < len(forms):
+            form_name, item = chunks.get()
+            if isinstance(item, list):
+                flow_controller.send(item)
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                number_by_form[form_name] = item
+    finally:
+        stop.set()
+        # Unblock the readers waiting on a full queue
+        while any(thread.is_alive() for thread in threads):
+            try:
+                chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+    return number_by_form
+
+
+def check_dependencies(dependencies):
     """
-    while get_N_tasks(inspect, "celery@abacus") > N:
-        logger.info("There were too many reserved tasks so waiting 5 seconds")
-        time.sleep(60)
+    Raises a ValueError if the forms depend on each other in a cycle
+    """
+    done = set()
+    for form in dependencies:
+        path = []
+        stack = [form]
+        while stack:
+            current = stack.pop()
+            if current is None:
+                done.add(path.pop())
+                continue
+            if current in done:
+                continue
+            if current in path:
+                raise ValueError("Circular initial load dependencies: " +
+                                 " -> ".join(path + [current]))
+            path.append(current)
+            stack.append(None)
+            stack.extend(dependencies.get(current, []))
+
+
+def get_flow_controller(celery_app, param_config):
+    """
+    Returns a FlowController with the settings in param_config
+    """
+    spool_directory = None
+    if param_config.claim_check:
+        spool_directory = param_config.spool_directory
+    return FlowController(celery_app,
+                          max_in_flight=param_config.max_in_flight_chunks,
+                          method=param_config.flow_control,
+                          spool_directory=spool_directory,
+                          spool_max_age=param_config.spool_max_age)
 
-    logger.info("Sending data")
-    celery_app.send_task("processing_tasks.process_data", [data])
 
-        
 def download_data_from_s3(config):
     """
     Get csv-files with data from s3 bucket
@@ -81,13 +195,75 @@ def download_data_from_s3(config):
         
 # Real time
 
+s3_tail = None
+
+
 def real_time_s3(app, config, session, number_by_form={}):
-    """ Downloads data from S3 and adds new data from the CSV files"""
+    """
+    Adds new data from the CSV files in S3
+
+    With s3_incremental only the rows appended to the files since the
+    last read are fetched, see read_s3_tail. Otherwise the files are
+    downloaded again and the rows after the ones in number_by_form are
+    sent.
+    """
     logger.info("Starting read from S3")
-    download_data_from_s3(config)
-    read_stationary_data(util.read_csv_file, config, previous_number_by_form=number_by_form)
+    if config.s3_incremental:
+        number_by_form = read_s3_tail(app, config, number_by_form)
+    else:
+        download_data_from_s3(config)
+        number_by_form = read_stationary_data(
+            util.read_csv_file, config, app,
+            previous_number_by_form=number_by_form)
     logger.info("Finishing read from S3")
-    time.sleep(config.data_stream_interval)
+    time.sleep(int(config.s3_data_stream_interval))
+    return number_by_form
+
+
+def read_s3_tail(app, config, number_by_form={}, N_send_to_task=15000):
+    """
+    Sends the rows appended to the CSV files in S3 since the last read
+
+    The byte offset of each file is kept in the marker file, see S3Tail.
+    The marker of a form is only moved once all its new rows are sent, if
+    sending fails the markers are read from the file again so the rows are
+    sent next time. The first time we read a file the rows that were sent
+    by the initial load, up to the index in number_by_form, are skipped.
+
+    Returns:
+        number_by_form: index of the last record for each form
+    """
+    global s3_tail
+    if s3_tail is None:
+        s3_tail = S3Tail(boto3.client("s3"), config.s3_bucket,
+                         config.s3_marker_file)
+    flow_controller = get_flow_controller(app, config)
+    number_by_form = dict(number_by_form)
+    for form_name in config.country_config["tables"]:
+        skip = 0
+        if form_name not in s3_tail.markers:
+            skip = number_by_form.get(form_name, -1) + 1
+        data = []
+        n_new = 0
+        try:
+            for row in s3_tail.new_rows(form_name):
+                if skip:
+                    skip -= 1
+                    continue
+                data.append({"form": form_name, "data": dict(row)})
+                n_new += 1
+                if len(data) >= N_send_to_task:
+                    flow_controller.send(data)
+                    data = []
+            if data:
+                flow_controller.send(data)
+        except Exception:
+            s3_tail.reload()
+            raise
+        s3_tail.commit(form_name)
+        s3_tail.save()
+        number_by_form[form_name] = s3_tail.markers[form_name]["rows"] - 1
+        logger.info(f"Sent {n_new} new records for form {form_name}")
     return number_by_form
     
 
@@ -121,15 +297,19 @@ def real_time_fake(app, config, session, *args):
     time.sleep(config.fake_data_interval)
 
 
-sqs_client = None
-sqs_queue_url = None
+sqs_ingestor = None
 
 
 def real_time_sqs(app, config, *args):
-    """ Reads data from AWS SQS"""
-    global sqs_client
-    global sqs_queue_url
-    if sqs_client is None:
+    """
+    Reads data from AWS SQS
+
+    The first call subscribes to the queue and starts the receivers of
+    an SQSIngestor, each call then sends the chunks that are due for
+    about as long as one long poll.
+    """
+    global sqs_ingestor
+    if sqs_ingestor is None:
         try:
             logger.info(f"Subscribing to SQS endpoint: {config.SQS_ENDPOINT}.")
             logger.info(f"Subscribing to SQS queue: {config.sqs_queue.lower()}.")
@@ -138,28 +318,12 @@ def real_time_sqs(app, config, *args):
         except Exception as e:
             logger.exception("Error in reading message", exc_info=True)
             return
-    try:
-        logger.info("Getting messages from queue " + str(sqs_queue_url))
-        messages = sqs_client.receive_message(QueueUrl=sqs_queue_url,
-                                              WaitTimeSeconds=19,
-                                              MaxNumberOfMessages=10)
-    except Exception as e:
-        logger.error(str(e) + ", retrying...")
-        return
-    if "Messages" in messages:
-        messages_to_send = []
-        for message in messages["Messages"]:
-            logger.info("Message %s", message)
-            receipt_handle = message["ReceiptHandle"]
-            logger.debug("Deleting message %s", receipt_handle)
-
-            try:
-                message_body = json.loads(message["Body"])
-                form = message_body["formId"]
-                form_data = message_body["data"]
-                messages_to_send.append({"form": form, "data": form_data})
-                sqs_client.delete_message(QueueUrl=sqs_queue_url,
-                                          ReceiptHandle=receipt_handle)
-            except Exception as e:
-                logger.exception("Error in reading message", exc_info=True)
-        app.send_task("processing_tasks.process_data", [messages_to_send])
+        sqs_ingestor = SQSIngestor(sqs_client, sqs_queue_url,
+                                   get_flow_controller(app, config),
+                                   receivers=config.sqs_receivers,
+                                   chunk_size=config.sqs_chunk_size,
+                                   max_wait=config.sqs_max_wait)
+        sqs_ingestor.start()
+    logger.info("Getting messages from queue " + str(sqs_ingestor.queue_url))
+    sent = sqs_ingestor.dispatch(timeout=20)
+    logger.info(f"Sent {sent} records from SQS")
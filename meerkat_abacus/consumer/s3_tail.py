@@ -0,0 +1,178 @@
+"""
+Incremental reading of the form CSV files in S3
+
+"""
+import base64
+import csv
+import io
+import json
+import os
+
+from meerkat_abacus import logger
+
+# Number of bytes before the offset we keep to check that a file was
+# only appended to
+CHECK_BYTES = 256
+
+
+class S3Tail:
+    """
+    Reads the rows appended to the form CSV files since the last read
+
+    For each form we keep a marker with the byte offset and number of
+    rows read so far, the ETag and size of the object, the CSV header and
+    the last CHECK_BYTES bytes before the offset. On each read we compare
+    the ETag and size from a HEAD request with the marker and, if the file
+    has grown, only GET the bytes after the offset with a range request.
+
+    If the bytes before the offset have changed the file was rewritten
+    and not just appended to, so we read the whole file again.
+
+    Only complete records are read. The offset is moved to the end of the
+    last record that ends with a newline outside of quotes, so a record
+    that is cut off is read again next time.
+
+    The rows are read with a copy of the marker. Call commit once the
+    rows have been handed on, which makes the copy the marker of the form,
+    and save to write the markers. If handing on the rows fails the marker
+    is not moved and the rows are read again next time, reload drops what
+    was not committed and reads the markers from the file again.
+
+    The markers are kept in a JSON file, written atomically, so the tail
+    continues where it left off after a restart.
+
+    Args:
+        s3_client: boto3 S3 client
+        bucket: name of the bucket
+        marker_path: path of the marker file
+        prefix: prefix of the keys of the CSV files
+        read_size: number of bytes to read from the body at a time
+    """
+    def __init__(self, s3_client, bucket, marker_path, prefix="data/",
+                 read_size=1024 * 1024):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.marker_path = marker_path
+        self.prefix = prefix
+        self.read_size = read_size
+        self.reload()
+
+    def reload(self):
+        """
+        Reads the markers from the marker file and drops the ones that
+        were not committed
+        """
+        self.markers = {}
+        self.pending = {}
+        if os.path.exists(self.marker_path):
+            with open(self.marker_path) as f:
+                self.markers = json.load(f)
+
+    def key(self, form_name):
+        return self.prefix + form_name + ".csv"
+
+    def new_rows(self, form_name):
+        """
+        Yields the rows appended to the CSV file of the form since the
+        last committed read
+
+        A copy of the marker is updated as the rows are read, call commit
+        once the rows have been handed on.
+        """
+        key = self.key(form_name)
+        head = self.s3_client.head_object(Bucket=self.bucket, Key=key)
+        size = head["ContentLength"]
+        etag = head["ETag"]
+        marker = self.markers.get(form_name)
+        if marker is not None:
+            if marker["etag"] == etag and marker["size"] == size:
+                return
+            if not self._is_appended(key, marker, size):
+                logger.warning(f"{key} has been rewritten, reading it again")
+                marker = None
+        if marker is None:
+            marker = {"offset": 0, "rows": 0, "header": None, "check": ""}
+        marker = dict(marker, etag=etag, size=size)
+        self.pending[form_name] = marker
+        if marker["offset"] >= size:
+            return
+        response = self.s3_client.get_object(
+            Bucket=self.bucket, Key=key, Range=f"bytes={marker['offset']}-")
+        yield from self._read(response["Body"], marker)
+
+    def commit(self, form_name):
+        """
+        Moves the marker of the form past the rows that have been read
+        """
+        marker = self.pending.pop(form_name, None)
+        if marker is not None:
+            self.markers[form_name] = marker
+
+    def save(self):
+        """
+        Writes the markers to the marker file
+        """
+        directory = os.path.dirname(self.marker_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.marker_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.markers, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.marker_path)
+
+    def _is_appended(self, key, marker, size):
+        """
+        Returns True if the bytes before the offset are as we read them
+        """
+        if size < marker["offset"]:
+            return False
+        check = base64.b64decode(marker["check"])
+        if not check:
+            return True
+        start = marker["offset"] - len(check)
+        response = self.s3_client.get_object(
+            Bucket=self.bucket, Key=key,
+            Range=f"bytes={start}-{marker['offset'] - 1}")
+        return response["Body"].read() == check
+
+    def _read(self, body, marker):
+        buffer = b""
+        while True:
+            chunk = body.read(self.read_size)
+            if not chunk:
+                break
+            buffer += chunk
+            end = complete_records_end(buffer)
+            if end == 0:
+                continue
+            yield from self._parse(buffer[:end], marker)
+            buffer = buffer[end:]
+
+    def _parse(self, data, marker):
+        # Read the same way as util.read_csv
+        text = data.decode("utf-8", errors="replace")
+        reader = csv.DictReader(io.StringIO(text, newline=None),
+                                fieldnames=marker["header"])
+        for row in reader:
+            marker["rows"] += 1
+            yield row
+        if marker["header"] is None:
+            marker["header"] = reader.fieldnames
+        marker["offset"] += len(data)
+        check = (base64.b64decode(marker["check"]) + data)[-CHECK_BYTES:]
+        marker["check"] = base64.b64encode(check).decode("ascii")
+
+
+def complete_records_end(data):
+    """
+    Returns the position after the last newline in data that ends a CSV
+    record, i.e. that is not inside a quoted field, or 0 if there is none
+    """
+    end = data.rfind(b"\n")
+    while end >= 0:
+        if data.count(b'"', 0, end) % 2 == 0:
+            return end + 1
+        end = data.rfind(b"\n", 0, end)
+    return 0
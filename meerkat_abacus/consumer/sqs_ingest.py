@@ -0,0 +1,205 @@
+"""
+Concurrent reading of the data stream from SQS
+
+"""
+from concurrent.futures import ThreadPoolExecutor
+import json
+import threading
+import time
+
+from meerkat_abacus import logger
+
+# Most messages SQS returns or deletes in one call
+SQS_BATCH = 10
+
+
+class SQSIngestor:
+    """
+    Reads messages from SQS with several long polling receivers and sends
+    them to the workers in chunks
+
+    Each receiver runs in its own thread and adds the records of the
+    messages it gets to a shared accumulator. dispatch sends the records
+    as one chunk once there are chunk_size of them or the oldest has
+    waited max_wait seconds, and only then deletes the messages from the
+    queue with delete_message_batch. If the consumer dies before a chunk
+    is sent, its messages become visible again and are read again.
+
+    The delete_message_batch calls of a chunk are spread over as many
+    threads as there are receivers.
+
+    The receivers wait when max_buffered records are waiting to be sent,
+    so messages do not pile up here while the workers are busy. max_wait
+    should be well below the visibility timeout of the queue.
+
+    Messages that can not be read are logged and left in the queue, so
+    a redrive policy can move them to a dead letter queue.
+
+    Args:
+        sqs_client: boto3 SQS client, these are thread safe
+        queue_url: url of the queue
+        flow_controller: FlowController to send the chunks with
+        receivers: number of receiver threads
+        chunk_size: number of records to send in each chunk
+        max_wait: seconds a record can wait before its chunk is sent
+        max_buffered: number of records at which the receivers wait,
+            by default twice the chunk_size
+        wait_time_seconds: long polling wait for each receive
+    """
+    def __init__(self, sqs_client, queue_url, flow_controller, receivers=4,
+                 chunk_size=500, max_wait=5.0, max_buffered=None,
+                 wait_time_seconds=19):
+        self.sqs_client = sqs_client
+        self.queue_url = queue_url
+        self.flow_controller = flow_controller
+        self.receivers = receivers
+        self.chunk_size = chunk_size
+        self.max_wait = max_wait
+        self.max_buffered = max_buffered or 2 * chunk_size
+        self.wait_time_seconds = wait_time_seconds
+        self.condition = threading.Condition()
+        self.records = []
+        self.receipt_handles = []
+        self.oldest = None
+        self.stopped = threading.Event()
+        self.threads = []
+        self.delete_executor = ThreadPoolExecutor(
+            max_workers=receivers, thread_name_prefix="sqs-delete")
+        self.received = 0
+        self.sent = 0
+
+    def start(self):
+        """ Starts the receiver threads """
+        self.stopped.clear()
+        self.threads = [
+            threading.Thread(target=self._receive, name=f"sqs-receiver-{i}",
+                             daemon=True)
+            for i in range(self.receivers)]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        """
+        Stops the receivers and sends the records that are waiting
+        """
+        self.stopped.set()
+        with self.condition:
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        while self.records:
+            self._send(*self._take())
+
+    def dispatch(self, timeout):
+        """
+        Sends the chunks that are due for up to timeout seconds
+
+        Returns:
+            number of records sent
+        """
+        end = time.monotonic() + timeout
+        sent = 0
+        while True:
+            with self.condition:
+                while not self._due():
+                    remaining = end - time.monotonic()
+                    if remaining <= 0:
+                        return sent
+                    wait = remaining
+                    if self.oldest is not None:
+                        wait = min(wait,
+                                   self.oldest + self.max_wait - time.monotonic())
+                    self.condition.wait(max(wait, 0))
+                records, receipt_handles = self._take()
+            sent += self._send(records, receipt_handles)
+
+    def _due(self):
+        if len(self.records) >= self.chunk_size:
+            return True
+        return (self.oldest is not None and
+                time.monotonic() - self.oldest >= self.max_wait)
+
+    def _take(self):
+        """
+        Takes up to chunk_size records off the accumulator, call with
+        the condition held or after the receivers have stopped
+
+        The records left keep the time of the oldest record, so they are
+        sent early rather than late.
+        """
+        records = self.records[:self.chunk_size]
+        receipt_handles = self.receipt_handles[:self.chunk_size]
+        self.records = self.records[self.chunk_size:]
+        self.receipt_handles = self.receipt_handles[self.chunk_size:]
+        if not self.records:
+            self.oldest = None
+        self.condition.notify_all()
+        return records, receipt_handles
+
+    def _send(self, records, receipt_handles):
+        if not records:
+            return 0
+        self.flow_controller.send(records)
+        self.sent += len(records)
+        self.delete(receipt_handles)
+        return len(records)
+
+    def delete(self, receipt_handles):
+        """
+        Deletes the messages with delete_message_batch
+        """
+        batches = [receipt_handles[start:start + SQS_BATCH]
+                   for start in range(0, len(receipt_handles), SQS_BATCH)]
+        list(self.delete_executor.map(self._delete_batch, batches))
+
+    def _delete_batch(self, receipt_handles):
+        entries = [{"Id": str(i), "ReceiptHandle": receipt_handle}
+                   for i, receipt_handle in enumerate(receipt_handles)]
+        try:
+            response = self.sqs_client.delete_message_batch(
+                QueueUrl=self.queue_url, Entries=entries)
+        except Exception:
+            logger.exception("Could not delete the messages", exc_info=True)
+            return
+        for failed in response.get("Failed", []):
+            logger.error(f"Could not delete message: {failed}")
+
+    def _receive(self):
+        while not self.stopped.is_set():
+            with self.condition:
+                while (len(self.records) >= self.max_buffered and
+                       not self.stopped.is_set()):
+                    self.condition.wait()
+            if self.stopped.is_set():
+                return
+            try:
+                response = self.sqs_client.receive_message(
+                    QueueUrl=self.queue_url,
+                    WaitTimeSeconds=self.wait_time_seconds,
+                    MaxNumberOfMessages=SQS_BATCH)
+            except Exception as e:
+                logger.error(str(e) + ", retrying...")
+                self.stopped.wait(1)
+                continue
+            records = []
+            receipt_handles = []
+            for message in response.get("Messages", []):
+                try:
+                    message_body = json.loads(message["Body"])
+                    records.append({"form": message_body["formId"],
+                                    "data": message_body["data"]})
+                except Exception:
+                    logger.exception("Error in reading message",
+                                     exc_info=True)
+                    continue
+                receipt_handles.append(message["ReceiptHandle"])
+            if not records:
+                continue
+            with self.condition:
+                if self.oldest is None:
+                    self.oldest = time.monotonic()
+                self.records.extend(records)
+                self.receipt_handles.extend(receipt_handles)
+                self.received += len(records)
+                self.condition.notify_all()
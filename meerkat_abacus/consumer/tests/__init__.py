@@ -5,10 +5,21 @@ Unit tests Meerkat Abacus
 """
 
 from unittest import mock
+import collections
+import io
+import json
+import os
 import random
+import tempfile
+import threading
+import time
 import unittest
 from meerkat_abacus.consumer import get_data
+from meerkat_abacus.consumer.flow_control import FlowController
+from meerkat_abacus.consumer.s3_tail import S3Tail
+from meerkat_abacus.consumer.sqs_ingest import SQSIngestor
 from meerkat_abacus.config import config as param_config
+from meerkat_abacus.util import spool
 
 
 class TestConsumer(unittest.TestCase):
@@ -19,16 +30,12 @@ class TestConsumer(unittest.TestCase):
     def tearDown(self):
         pass
 
-    @mock.patch('meerkat_abacus.consumer.get_data.inspect')
-    def test_read_data(self, inspect_mock):
+    def test_read_data(self):
         """
         Tests that read_stationary_data gets data from
         a get function and sends apropriate process_data.delay calls
 
         """
-        inspect_mock_rv = mock.MagicMock()
-        inspect_mock_rv.reserved = mock.MagicMock(return_value={"celery@abacus": []})
-        inspect_mock.return_value = inspect_mock_rv
         param_config.country_config["tables"] = ["table1", "table2"]
         celery_app_mock = mock.MagicMock()
         numbers = get_data.read_stationary_data(yield_data_function,
@@ -38,8 +45,355 @@ class TestConsumer(unittest.TestCase):
         celery_app_mock.send_task.assert_called()
         self.assertEqual(celery_app_mock.send_task.call_count, 24)
         # 24 = 2 * 12. We get 11 normal calls and one extra for the last record
-        
+
+    def test_read_data_previous_number(self):
+        param_config.country_config["tables"] = ["table1"]
+        celery_app_mock = mock.MagicMock()
+        numbers = get_data.read_stationary_data(
+            yield_data_function, param_config, celery_app_mock,
+            N_send_to_task=1000, previous_number_by_form={"table1": 89})
+        self.assertEqual(numbers["table1"], 99)
+        sent = celery_app_mock.send_task.call_args[0][1][0]
+        self.assertEqual(len(sent), 10)
+
+    def test_read_data_parallel(self):
+        param_config.country_config["tables"] = ["table1", "table2", "table3"]
+        celery_app_mock = mock.MagicMock()
+
+        def slow_data_function(form, param_config=None):
+            for row in yield_data_function(form, param_config=param_config):
+                if form == "table1":
+                    time.sleep(0.001)
+                yield row
+        numbers = get_data.read_stationary_data_parallel(
+            slow_data_function, param_config, celery_app_mock,
+            N_send_to_task=30, workers=2, send_queue_size=2,
+            dependencies={"table2": ["table1"], "table1": ["other_form"]})
+        self.assertEqual(numbers, {"table1": 99, "table2": 99, "table3": 99})
+        sent = [c[0][1][0] for c in celery_app_mock.send_task.call_args_list]
+        self.assertEqual(len(sent), 12)
+        forms = [chunk[0]["form"] for chunk in sent]
+        self.assertLess(max(i for i, f in enumerate(forms) if f == "table1"),
+                        min(i for i, f in enumerate(forms) if f == "table2"))
+        self.assertEqual(sorted(len(chunk) for chunk in sent),
+                         [10] * 3 + [30] * 9)
+
+    def test_read_data_parallel_errors(self):
+        param_config.country_config["tables"] = ["table1", "table2"]
+        with self.assertRaises(ValueError):
+            get_data.read_stationary_data_parallel(
+                yield_data_function, param_config, mock.MagicMock(),
+                dependencies={"table1": ["table2"], "table2": ["table1"]})
+
+        def failing_function(form, param_config=None):
+            yield {"a": 1}
+            raise KeyError(form)
+        with self.assertRaises(KeyError):
+            get_data.read_stationary_data_parallel(
+                failing_function, param_config, mock.MagicMock(),
+                N_send_to_task=1, send_queue_size=1)
+
+    def test_flow_control(self):
+        """
+        Tests that the FlowController keeps at most max_in_flight chunks
+        in flight and sends the next one when a chunk is done
+        """
+        celery_app_mock = mock.MagicMock()
+        results = []
+
+        def send_task(name, args):
+            result = mock.MagicMock()
+            result.ready.return_value = False
+            results.append(result)
+            return result
+        celery_app_mock.send_task.side_effect = send_task
+        flow = FlowController(celery_app_mock, max_in_flight=3,
+                              poll_interval=0.001)
+        sleeps = []
+
+        def sleep(seconds):
+            # A worker finishes the oldest chunk that is still running
+            sleeps.append(seconds)
+            next(r for r in results if not r.ready()).ready.return_value = True
+
+        with mock.patch("meerkat_abacus.consumer.flow_control.time.sleep",
+                        side_effect=sleep):
+            for i in range(5):
+                flow.send([i])
+            self.assertEqual(len(sleeps), 2)
+            self.assertEqual(flow.in_flight(), 3)
+            self.assertTrue(flow.join())
+        self.assertEqual(flow.sent, 5)
+        self.assertEqual(celery_app_mock.send_task.call_args[0],
+                         ("processing_tasks.process_data", [[4]]))
+
+    def test_flow_control_queue(self):
+        celery_app_mock = mock.MagicMock()
+        channel = celery_app_mock.connection_or_acquire.return_value. \
+            __enter__.return_value.default_channel
+        channel.queue_declare.return_value = mock.MagicMock(message_count=2)
+        flow = FlowController(celery_app_mock, max_in_flight=3,
+                              method="queue", queue="abacus")
+        flow.send([1])
+        self.assertEqual(flow.in_flight(), 2)
+        channel.queue_declare.assert_called_with(queue="abacus", passive=True)
+        self.assertFalse(flow.results)
+
+    def test_flow_control_claim_check(self):
+        celery_app_mock = mock.MagicMock()
+        with tempfile.TemporaryDirectory() as directory:
+            flow = FlowController(celery_app_mock, spool_directory=directory)
+            data = [{"form": "table1", "data": {"a": i}} for i in range(10)]
+            flow.send(data)
+            reference = celery_app_mock.send_task.call_args[0][1][0]
+            self.assertEqual(reference["records"], 10)
+            self.assertEqual(spool.read_chunk(reference, directory), data)
+
            
+class S3TailTest(unittest.TestCase):
+    """
+    Tests reading the rows appended to a CSV file in S3
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.marker_path = os.path.join(self.directory.name, "markers.json")
+        self.s3 = FakeS3()
+        self.s3.objects["data/demo_case.csv"] = (
+            b'a,b\r\n1,"x"\r\n2,"multi\r\nline"\r\n')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def tail(self):
+        return S3Tail(self.s3, "bucket", self.marker_path, read_size=5)
+
+    def test_new_rows(self):
+        tail = self.tail()
+        rows = list(tail.new_rows("demo_case"))
+        self.assertEqual(rows, [{"a": "1", "b": "x"},
+                                {"a": "2", "b": "multi\nline"}])
+        tail.commit("demo_case")
+        tail.save()
+        self.assertEqual(list(tail.new_rows("demo_case")), [])
+        self.assertEqual(self.s3.ranges, ["bytes=0-"])
+
+        # A new process continues from the marker file, the last record
+        # is not complete yet
+        self.s3.objects["data/demo_case.csv"] += b'3,y\r\n4,"cut\r\n'
+        tail = self.tail()
+        self.assertEqual(list(tail.new_rows("demo_case")),
+                         [{"a": "3", "b": "y"}])
+        tail.commit("demo_case")
+        tail.save()
+        self.s3.objects["data/demo_case.csv"] += b'off"\r\n'
+        self.assertEqual(list(tail.new_rows("demo_case")),
+                         [{"a": "4", "b": "cut\noff"}])
+        tail.commit("demo_case")
+        self.assertEqual(tail.markers["demo_case"]["rows"], 4)
+        self.assertEqual(self.s3.ranges[-1], "bytes=34-")
+        self.assertEqual(tail.markers["demo_case"]["offset"],
+                         len(self.s3.objects["data/demo_case.csv"]))
+
+    def test_rewritten_file(self):
+        tail = self.tail()
+        list(tail.new_rows("demo_case"))
+        tail.commit("demo_case")
+        self.s3.objects["data/demo_case.csv"] = b"a,b\n5,z\n6,w\n7,v\n8,u\n"
+        self.assertEqual([row["a"] for row in tail.new_rows("demo_case")],
+                         ["5", "6", "7", "8"])
+
+    @mock.patch("meerkat_abacus.consumer.get_data.boto3")
+    def test_read_s3_tail(self, boto3_mock):
+        boto3_mock.client.return_value = self.s3
+        param_config.country_config["tables"] = ["demo_case"]
+        param_config.s3_marker_file = self.marker_path
+        param_config.claim_check = False
+        celery_app_mock = mock.MagicMock()
+        get_data.s3_tail = None
+        try:
+            numbers = get_data.read_s3_tail(celery_app_mock, param_config,
+                                            {"demo_case": 0})
+            self.assertEqual(numbers, {"demo_case": 1})
+            sent = celery_app_mock.send_task.call_args[0][1][0]
+            self.assertEqual([r["data"]["a"] for r in sent], ["2"])
+            self.s3.objects["data/demo_case.csv"] += b"3,y\n"
+            get_data.read_s3_tail(celery_app_mock, param_config, numbers)
+            sent = celery_app_mock.send_task.call_args[0][1][0]
+            self.assertEqual([r["data"]["a"] for r in sent], ["3"])
+            self.assertTrue(os.path.exists(self.marker_path))
+        finally:
+            get_data.s3_tail = None
+
+    def test_uncommitted_rows(self):
+        tail = self.tail()
+        self.assertEqual(len(list(tail.new_rows("demo_case"))), 2)
+        tail.commit("demo_case")
+        tail.save()
+        self.s3.objects["data/demo_case.csv"] += b"3,y\n4,z\n"
+        rows = tail.new_rows("demo_case")
+        next(rows)
+        # Sending the rows failed, they are read again
+        tail.reload()
+        self.assertEqual([row["a"] for row in tail.new_rows("demo_case")],
+                         ["3", "4"])
+
+    @mock.patch("meerkat_abacus.consumer.get_data.boto3")
+    def test_read_s3_tail_send_fails(self, boto3_mock):
+        boto3_mock.client.return_value = self.s3
+        param_config.country_config["tables"] = ["demo_case"]
+        param_config.s3_marker_file = self.marker_path
+        param_config.claim_check = False
+        self.s3.objects["data/demo_case.csv"] = b"a,b\n" + b"".join(
+            b"%d,x\n" % i for i in range(100))
+        celery_app_mock = mock.MagicMock()
+        celery_app_mock.send_task.side_effect = [mock.MagicMock(),
+                                                 ValueError("Broker down")]
+        get_data.s3_tail = None
+        try:
+            with self.assertRaises(ValueError):
+                get_data.read_s3_tail(celery_app_mock, param_config, {},
+                                      N_send_to_task=30)
+            celery_app_mock.send_task.side_effect = None
+            celery_app_mock.send_task.reset_mock()
+            get_data.read_s3_tail(celery_app_mock, param_config, {},
+                                  N_send_to_task=30)
+            sent = [r["data"]["a"] for c in celery_app_mock.send_task.call_args_list
+                    for r in c[0][1][0]]
+            self.assertEqual(sent, [str(i) for i in range(100)])
+        finally:
+            get_data.s3_tail = None
+
+
+class SQSIngestorTest(unittest.TestCase):
+    """
+    Tests reading from SQS with several receivers
+    """
+
+    def setUp(self):
+        self.sqs = FakeSQS()
+        for i in range(95):
+            self.sqs.send_message(
+                QueueUrl="queue",
+                MessageBody=json.dumps({"formId": "demo_case",
+                                        "data": {"index": i}}))
+        self.sqs.send_message(QueueUrl="queue", MessageBody="not json")
+        self.flow_controller = mock.MagicMock()
+
+    def ingestor(self, **kwargs):
+        return SQSIngestor(self.sqs, "queue", self.flow_controller,
+                           receivers=3, wait_time_seconds=0.05, **kwargs)
+
+    def sent_chunks(self):
+        return [c[0][0] for c in self.flow_controller.send.call_args_list]
+
+    def test_dispatch(self):
+        ingestor = self.ingestor(chunk_size=20, max_wait=0.2)
+        ingestor.start()
+        try:
+            sent = 0
+            while sent < 95:
+                sent += ingestor.dispatch(timeout=1)
+        finally:
+            ingestor.stop()
+        chunks = self.sent_chunks()
+        self.assertTrue(all(len(chunk) <= 20 for chunk in chunks))
+        self.assertEqual(sorted(r["data"]["index"] for c in chunks for r in c),
+                         list(range(95)))
+        self.assertEqual(ingestor.sent, 95)
+        # Only the message we could not read is left
+        self.assertEqual([m["Body"] for m in self.sqs.messages.values()],
+                         ["not json"])
+        self.assertTrue(all(n <= 10 for n in self.sqs.delete_batch_sizes))
+
+    def test_max_wait(self):
+        # The chunks are sent before they are full
+        ingestor = self.ingestor(chunk_size=1000, max_wait=0.1)
+        ingestor.start()
+        try:
+            self.assertEqual(ingestor.dispatch(timeout=1), 95)
+        finally:
+            ingestor.stop()
+        self.assertEqual(ingestor.received, 95)
+        self.assertEqual(sum(len(chunk) for chunk in self.sent_chunks()), 95)
+
+    def test_delete_after_send(self):
+        self.flow_controller.send.side_effect = OSError("Broker down")
+        ingestor = self.ingestor(chunk_size=10, max_wait=0.1)
+        ingestor.start()
+        try:
+            with self.assertRaises(OSError):
+                ingestor.dispatch(timeout=1)
+        finally:
+            ingestor.stopped.set()
+        self.assertEqual(self.sqs.delete_batch_sizes, [])
+        self.assertEqual(len(self.sqs.messages), 96)
+
+
+class FakeSQS:
+    """
+    SQS client with the queue in memory, like ElasticMQ
+
+    Received messages are invisible until they are deleted, we never make
+    them visible again.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.messages = collections.OrderedDict()
+        self.visible = collections.deque()
+        self.delete_batch_sizes = []
+        self.next_id = 0
+
+    def send_message(self, QueueUrl, MessageBody):
+        with self.condition:
+            receipt_handle = f"handle-{self.next_id}"
+            self.next_id += 1
+            self.messages[receipt_handle] = {"ReceiptHandle": receipt_handle,
+                                             "Body": MessageBody}
+            self.visible.append(receipt_handle)
+            self.condition.notify_all()
+
+    def receive_message(self, QueueUrl, WaitTimeSeconds,
+                        MaxNumberOfMessages):
+        with self.condition:
+            self.condition.wait_for(lambda: self.visible,
+                                    timeout=WaitTimeSeconds)
+            messages = []
+            while self.visible and len(messages) < MaxNumberOfMessages:
+                messages.append(self.messages[self.visible.popleft()])
+        if not messages:
+            return {}
+        return {"Messages": messages}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        if len(Entries) > 10:
+            raise ValueError("Too many entries")
+        with self.condition:
+            self.delete_batch_sizes.append(len(Entries))
+            for entry in Entries:
+                del self.messages[entry["ReceiptHandle"]]
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries]}
+
+
+class FakeS3:
+    """ S3 client with the objects in memory """
+    def __init__(self):
+        self.objects = {}
+        self.ranges = []
+
+    def head_object(self, Bucket, Key):
+        body = self.objects[Key]
+        return {"ContentLength": len(body),
+                "ETag": '"%x"' % hash(body)}
+
+    def get_object(self, Bucket, Key, Range):
+        self.ranges.append(Range)
+        start, end = Range[len("bytes="):].split("-")
+        body = self.objects[Key]
+        end = int(end) + 1 if end else len(body)
+        return {"Body": io.BytesIO(body[int(start):end])}
+
+
 def yield_data_function(form, param_config=None, N=100):
     for i in range(N):
         yield {"a": random.random(),
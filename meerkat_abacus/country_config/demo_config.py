@@ -29,6 +29,8 @@ country_config = {
 
     },
     "require_case_report": ["demo_case", "demo_register"],
+    # Forms to send before each form in the initial load
+    "initial_load_dependencies": {"demo_alert": ["demo_case"]},
     "codes_file": "demo_codes",
     "coding_list": [
         "demo_codes.csv",
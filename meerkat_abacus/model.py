@@ -1,7 +1,7 @@
 """
 Database model definition
 """
-from sqlalchemy import Column, Integer, String, DateTime, DDL, Float, Text
+from sqlalchemy import Column, Integer, String, DateTime, DDL, Float, Text, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.dialects.postgresql import JSONB, ARRAY
 from sqlalchemy.orm import validates
@@ -34,6 +34,16 @@ def form_tables(param_config):
     return existing_form_tables
 
 
+def unique_index(table):
+    """
+    Returns the unique Index on (uuid, type) of table, or None
+    """
+    for index in table.indexes:
+        if index.unique and [c.name for c in index.columns] == ["uuid", "type"]:
+            return index
+    return None
+
+
 class DownloadDataFiles(Base):
     __tablename__ = 'download_data_files'
 
@@ -96,6 +106,8 @@ class StepMonitoring(Base):
 
 class Data(Base):
     __tablename__ = 'data'
+    # Needed for upserts in WriteToDb
+    __table_args__ = (Index("data_uuid_type", "uuid", "type", unique=True), )
 
     id = Column(Integer, primary_key=True)
     uuid = Column(String, index=True)
@@ -128,8 +140,28 @@ create_index2 = DDL("CREATE INDEX categories_gin ON data USING gin(categories);"
 listen(Data.__table__, 'after_create', create_index2)
 
 
+class AlertWeeklyCounts(Base):
+    """
+    Number of data records with each double alert variable by clinic and
+    epi week, kept up to date by the write_to_db step
+    """
+    __tablename__ = 'alert_weekly_counts'
+    __table_args__ = (
+        Index("alert_weekly_counts_key", "variable", "clinic", "epi_year",
+              "epi_week", unique=True), )
+
+    id = Column(Integer, primary_key=True)
+    variable = Column(String)
+    clinic = Column(Integer)
+    epi_year = Column(Integer)
+    epi_week = Column(Integer)
+    count = Column(Integer)
+
+
 class DisregardedData(Base):
     __tablename__ = 'disregarded_data'
+    __table_args__ = (
+        Index("disregarded_data_uuid_type", "uuid", "type", unique=True), )
 
     id = Column(Integer, primary_key=True)
     uuid = Column(String, index=True)
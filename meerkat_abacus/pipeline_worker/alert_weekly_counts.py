@@ -0,0 +1,149 @@
+"""
+Maintenance and lookup of the alert_weekly_counts table
+
+"""
+from collections import Counter
+from datetime import timedelta
+
+from sqlalchemy import tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.sql import text
+
+from meerkat_abacus import model
+
+REMOVE_COUNTS = text(
+    "UPDATE alert_weekly_counts AS c SET count = c.count - d.n "
+    "FROM (SELECT v.variable, data.clinic, data.epi_year, data.epi_week, "
+    "count(*) AS n FROM data "
+    "JOIN unnest(CAST(:variables AS text[])) AS v(variable) "
+    "ON data.variables ? v.variable "
+    "WHERE data.type = :type AND data.uuid = ANY(:uuids) "
+    "AND data.clinic IS NOT NULL AND data.epi_year IS NOT NULL "
+    "AND data.epi_week IS NOT NULL "
+    "GROUP BY 1, 2, 3, 4) AS d "
+    "WHERE c.variable = d.variable AND c.clinic = d.clinic "
+    "AND c.epi_year = d.epi_year AND c.epi_week = d.epi_week")
+
+REBUILD_COUNTS = text(
+    "INSERT INTO alert_weekly_counts (variable, clinic, epi_year, epi_week, count) "
+    "SELECT v.variable, data.clinic, data.epi_year, data.epi_week, count(*) "
+    "FROM data JOIN unnest(CAST(:variables AS text[])) AS v(variable) "
+    "ON data.variables ? v.variable "
+    "WHERE data.clinic IS NOT NULL AND data.epi_year IS NOT NULL "
+    "AND data.epi_week IS NOT NULL "
+    "GROUP BY 1, 2, 3, 4")
+
+
+def double_alert_variables(session):
+    """
+    Returns the ids of the variables with a double alert
+    """
+    alerts = session.query(model.AggregationVariables).filter(
+        model.AggregationVariables.alert == 1).all()
+    return sorted(a.id for a in alerts
+                  if a.alert_type and a.alert_type.split(":")[0] == "double")
+
+
+def remove_counts(conn, variables, records):
+    """
+    Subtracts the data records that are about to be deleted or replaced
+    from the counts. Call in the same transaction as the delete.
+
+    Args:
+        conn: db connection
+        variables: ids of the variables we count
+        records: dict of type: list of uuids
+    """
+    if not variables:
+        return
+    for type_, uuids in records.items():
+        conn.execute(REMOVE_COUNTS, variables=list(variables), type=type_,
+                     uuids=list(uuids))
+
+
+def add_counts(conn, variables, rows):
+    """
+    Adds the data rows that were written to the counts
+
+    Args:
+        conn: db connection
+        variables: ids of the variables we count
+        rows: list of data dicts
+    """
+    counts = Counter()
+    variables = set(variables)
+    for row in rows:
+        key = (row.get("clinic"), row.get("epi_year"), row.get("epi_week"))
+        if None in key or not row.get("variables"):
+            continue
+        for variable in variables.intersection(row["variables"]):
+            counts[(variable,) + key] += 1
+    if not counts:
+        return
+    table = model.AlertWeeklyCounts.__table__
+    # Sorted so concurrent writers lock the rows in the same order
+    values = [{"variable": variable, "clinic": clinic, "epi_year": epi_year,
+               "epi_week": epi_week, "count": n}
+              for (variable, clinic, epi_year, epi_week), n in sorted(counts.items())]
+    statement = insert(table).values(values)
+    conn.execute(statement.on_conflict_do_update(
+        index_elements=["variable", "clinic", "epi_year", "epi_week"],
+        set_={"count": table.c.count + statement.excluded.count}))
+
+
+def rebuild_counts(conn, variables):
+    """
+    Recalculates the whole table from the data table
+    """
+    conn.execute(model.AlertWeeklyCounts.__table__.delete())
+    if variables:
+        conn.execute(REBUILD_COUNTS, variables=list(variables))
+
+
+def weekly_counts(conn, variable, clinic, weeks):
+    """
+    Returns a dict of (epi_year, epi_week): count for the weeks
+    """
+    table = model.AlertWeeklyCounts.__table__
+    query = table.select().with_only_columns(
+        [table.c.epi_year, table.c.epi_week, table.c.count]).where(
+            table.c.variable == variable).where(
+                table.c.clinic == clinic).where(
+                    tuple_(table.c.epi_year, table.c.epi_week).in_(weeks))
+    return {(row[0], row[1]): row[2] for row in conn.execute(query)}
+
+
+def neighbour_weeks(calendar, epi_year, epi_week, n=2):
+    """
+    Returns the n epi weeks before and after an epi week, and the week
+    itself, in order
+
+    The weeks are found by stepping through the dates of the calendar, so
+    years with 53 weeks and custom year start dates are handled.
+
+    Args:
+        calendar: EpiWeekCalendar
+        epi_year: epi year
+        epi_week: epi week
+        n: number of weeks on each side
+    Returns:
+        list of (epi_year, epi_week)
+    """
+    start = calendar.year_start(epi_year) + timedelta(weeks=epi_week - 1)
+    week = (epi_year, epi_week)
+    before = []
+    after = []
+    for weeks, step in [(before, -7), (after, 7)]:
+        date = start
+        previous = week
+        # Days may be merged into a neighbouring week by the week 53
+        # strategy, so we step until we reach a new week
+        for _ in range(2 * n + 2):
+            if len(weeks) == n:
+                break
+            date += timedelta(days=step)
+            current = calendar.epi_week(date)
+            if current != previous and current != week:
+                weeks.append(current)
+                previous = current
+    return list(reversed(before)) + [week] + after
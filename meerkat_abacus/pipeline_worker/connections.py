@@ -0,0 +1,135 @@
+"""
+Db connection pool for the pipeline worker processes
+
+"""
+from contextlib import contextmanager
+import os
+import threading
+import time
+
+from sqlalchemy import create_engine, event, exc
+
+from meerkat_abacus import logger
+
+
+class ConnectionManager:
+    """
+    Keeps one engine and connection pool for each worker process
+
+    The engine is created the first time it is used in a process. The
+    pooled connections are checked with a ping before they are used and
+    replaced after pool_recycle seconds, so a worker survives a restart of
+    the db or connections dropped by the network.
+
+    A forked process must not use the connections it inherits, as the
+    parent uses the same sockets. reset is called from celery's
+    worker_process_init signal and creates a new engine in the child. The
+    inherited engine is kept and never disposed, disposing it would close
+    the connections of the parent. As a last guard a connection opened in
+    another process is refused on checkout with a DisconnectionError, as
+    in the pid check recipe of the SQLAlchemy pooling docs, and the pool
+    replaces it.
+
+    connect times how long it takes to get a connection from the pool, see
+    metrics.
+
+    Args:
+        url: db url
+        pool_size: number of connections to keep open
+        max_overflow: number of connections to open on top of pool_size
+        pool_recycle: seconds after which a connection is replaced
+        pool_timeout: seconds to wait for a free connection
+    """
+    def __init__(self, url, pool_size=5, max_overflow=5, pool_recycle=1800,
+                 pool_timeout=30):
+        self.url = url
+        self.engine_args = {"pool_pre_ping": True,
+                            "pool_size": pool_size,
+                            "max_overflow": max_overflow,
+                            "pool_recycle": pool_recycle,
+                            "pool_timeout": pool_timeout}
+        self._engine = None
+        self._pid = None
+        self._inherited_engines = []
+        self._lock = threading.Lock()
+        self.reset_metrics()
+
+    @property
+    def engine(self):
+        """ The engine of this process """
+        if self._engine is None or self._pid != os.getpid():
+            with self._lock:
+                if self._engine is None or self._pid != os.getpid():
+                    self._create_engine()
+        return self._engine
+
+    def reset(self):
+        """
+        Replaces an engine inherited from the parent process
+        """
+        with self._lock:
+            if self._engine is not None and self._pid != os.getpid():
+                self._create_engine()
+        self.reset_metrics()
+
+    def _create_engine(self):
+        if self._engine is not None:
+            self._inherited_engines.append(self._engine)
+        engine = create_engine(self.url, **self.engine_args)
+        event.listen(engine, "connect", _record_pid)
+        event.listen(engine, "checkout", _check_pid)
+        self._engine = engine
+        self._pid = os.getpid()
+        logger.info(f"Created db engine in process {self._pid}")
+
+    @contextmanager
+    def connect(self):
+        """
+        Checks out a connection from the pool for the block
+
+        The time it takes to get the connection is added to the metrics.
+        """
+        start = time.perf_counter()
+        connection = self.engine.connect()
+        self._record_acquisition(time.perf_counter() - start)
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def _record_acquisition(self, duration):
+        self.acquisitions += 1
+        self.total_acquisition_time += duration
+        self.max_acquisition_time = max(self.max_acquisition_time, duration)
+
+    def reset_metrics(self):
+        self.acquisitions = 0
+        self.total_acquisition_time = 0
+        self.max_acquisition_time = 0
+
+    def metrics(self):
+        """
+        Returns the number of connections checked out with connect, the
+        mean and maximum seconds it took to get them and the status of the
+        pool
+        """
+        mean = 0
+        if self.acquisitions:
+            mean = self.total_acquisition_time / self.acquisitions
+        pool = self._engine.pool.status() if self._engine is not None else None
+        return {"acquisitions": self.acquisitions,
+                "mean_acquisition_time": mean,
+                "max_acquisition_time": self.max_acquisition_time,
+                "pool": pool}
+
+
+def _record_pid(dbapi_connection, connection_record):
+    connection_record.info["pid"] = os.getpid()
+
+
+def _check_pid(dbapi_connection, connection_record, connection_proxy):
+    pid = os.getpid()
+    if connection_record.info.get("pid", pid) != pid:
+        raise exc.DisconnectionError(
+            f"Connection opened in process {connection_record.info['pid']} "
+            f"used in process {pid}")
@@ -0,0 +1,432 @@
+"""
+In-memory index of the form rows used to create links
+
+"""
+from collections import OrderedDict
+import json
+import time
+
+from sqlalchemy import or_
+
+from meerkat_abacus import logger
+
+
+class IdTracker:
+    """
+    Keeps track of the ids of a table we have read, so a refresh only
+    reads the rows we have not seen
+
+    Ids are given out when a row is inserted, but the row can only be
+    read once its transaction commits, so a row can appear below the
+    highest id we have read. We keep the ids we skipped below the highest
+    id as gaps and read them again on each refresh until the row appears
+    or gap_timeout seconds have passed, as the ids of rolled back inserts
+    and of deleted rows never appear. At most max_gaps gaps are kept.
+
+    Args:
+        gap_timeout: seconds to keep looking for a skipped id
+        max_gaps: maximum number of skipped ids to look for
+    """
+    def __init__(self, gap_timeout=300, max_gaps=10000):
+        self.gap_timeout = gap_timeout
+        self.max_gaps = max_gaps
+        self.high_water = 0
+        self.gaps = OrderedDict()
+
+    def condition(self, id_column, gaps=True):
+        """
+        Returns the filter for the rows we have not read
+
+        Args:
+            id_column: the id column of the table
+            gaps: also look for the skipped ids
+        """
+        condition = id_column > self.high_water
+        if gaps and self.gaps:
+            condition = or_(condition, id_column.in_(list(self.gaps)))
+        return condition
+
+    def add(self, row_id):
+        """
+        Records that we have read a row
+
+        Returns:
+            False if we had already read the row
+        """
+        if row_id > self.high_water:
+            now = time.monotonic()
+            start = max(self.high_water + 1, row_id - self.max_gaps)
+            for gap in range(start, row_id):
+                self.gaps[gap] = now
+            self.high_water = row_id
+            return True
+        if row_id in self.gaps:
+            del self.gaps[row_id]
+            return True
+        return False
+
+    def expire(self):
+        """
+        Stops looking for the gaps that are too old or too many
+        """
+        now = time.monotonic()
+        # The gaps are in the order we found them
+        while self.gaps:
+            gap, found = next(iter(self.gaps.items()))
+            if (len(self.gaps) <= self.max_gaps and
+                    now - found < self.gap_timeout):
+                break
+            del self.gaps[gap]
+
+
+def as_text(value):
+    """
+    Returns the value as text in the same way as the ->> operator in
+    postgres does for a JSONB field
+    """
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return json.dumps(value)
+
+
+class LinkCache:
+    """
+    Keeps the form rows needed to create links in memory, indexed by the
+    values the links match on.
+
+    For each link we keep two indexes:
+
+    ("to", name): rows of the to_form, used when looking for the forms
+                  a record links to
+    ("from", name): rows of the from_form, used when a new to_form record
+                    links back to existing records
+
+    Each index maps a key tuple with one normalised value per link column
+    to the data of the rows by uuid. The normalisation is the same as in
+    the SQL queries in AddLinks, so a lookup returns the same rows as the
+    query would. Keeping the rows by uuid means a row that is both put
+    back by fill and read by a later refresh is only kept once.
+
+    The cache holds at most max_rows rows. When it is full we evict the
+    least recently used keys. A lookup of an evicted key returns None and
+    the caller has to query the db instead, it can put the rows it gets
+    back into the cache with fill. A lookup of a key that was never in
+    the index returns no rows. We remember at most max_rows evicted keys,
+    when there are more the indexes with evicted keys are marked as
+    incomplete: all the keys that are not in the cache then go to the db
+    and new rows are only added to the keys in the cache.
+
+    New rows are loaded by refresh, which only reads the rows we have not
+    seen, see IdTracker. Form rows are only ever inserted, so this keeps
+    the cache in sync with the db, including rows inserted by WriteToDb
+    in other workers.
+
+    When the rows are read in a transaction that can be rolled back, call
+    begin before and commit or rollback after it. rollback undoes the
+    changes made since begin, so rows that were never committed do not
+    stay in the cache.
+
+    Args:
+        links: list of link definitions
+        form_tables: dict of form name: table
+        alert_id_length: length of alert ids
+        max_rows: maximum number of rows to keep
+        gap_timeout: seconds to keep looking for rows that committed out
+            of order
+    """
+    def __init__(self, links, form_tables, alert_id_length,
+                 max_rows=500000, gap_timeout=300):
+        self.form_tables = form_tables
+        self.alert_id_length = alert_id_length
+        self.max_rows = max_rows
+        self.gap_timeout = gap_timeout
+        self.entries = OrderedDict()
+        self.size = 0
+        self.complete = set()
+        self.evicted = set()
+        self.trackers = {}
+        self._journal = None
+        self.indexes_by_form = {}
+        for link in links:
+            self.indexes_by_form.setdefault(link["to_form"], []).append(
+                (("to", link["name"]), link))
+            self.indexes_by_form.setdefault(link["from_form"], []).append(
+                (("from", link["name"]), link))
+
+    def __len__(self):
+        return self.size
+
+    def begin(self):
+        """
+        Starts recording the changes to the cache so they can be undone
+        """
+        self._journal = {
+            "entries": {},
+            "complete": set(self.complete),
+            "trackers": {form: (tracker.high_water, OrderedDict(tracker.gaps))
+                         for form, tracker in self.trackers.items()}}
+
+    def commit(self):
+        """
+        Keeps the changes since begin
+        """
+        self._journal = None
+
+    def rollback(self):
+        """
+        Undoes the changes since begin
+        """
+        journal = self._journal
+        if journal is None:
+            return
+        self._journal = None
+        for entry, (rows, evicted) in journal["entries"].items():
+            current = self.entries.pop(entry, None)
+            if current is not None:
+                self.size -= len(current)
+            if rows is not None:
+                self.entries[entry] = rows
+                self.size += len(rows)
+            if evicted:
+                self.evicted.add(entry)
+            else:
+                self.evicted.discard(entry)
+        self.complete = journal["complete"]
+        for form in list(self.trackers):
+            if form not in journal["trackers"]:
+                del self.trackers[form]
+                continue
+            tracker = self.trackers[form]
+            tracker.high_water, tracker.gaps = journal["trackers"][form]
+
+    def _save(self, entry):
+        # Records the state of an (index, key) before its first change
+        if self._journal is None or entry in self._journal["entries"]:
+            return
+        rows = self.entries.get(entry)
+        self._journal["entries"][entry] = (
+            dict(rows) if rows is not None else None, entry in self.evicted)
+
+    def refresh(self, session, gaps=True):
+        """
+        Loads the form rows that are not yet in the cache from the db
+
+        Args:
+            session: db session
+            gaps: also look for the rows that committed out of order, with
+                False we only read the rows above the highest id we have
+                read, which is a cheap range scan
+        """
+        for form, indexes in self.indexes_by_form.items():
+            table = self.form_tables[form]
+            tracker = self.trackers.get(form)
+            if tracker is None:
+                # First load, the indexes start out complete
+                self.complete.update(index for index, link in indexes)
+                tracker = self.trackers[form] = IdTracker(self.gap_timeout)
+            query = session.query(table.id, table.uuid, table.data).filter(
+                tracker.condition(table.id, gaps)).order_by(table.id).yield_per(10000)
+            n = 0
+            for row_id, uuid, data in query:
+                if not tracker.add(row_id):
+                    continue
+                n += 1
+                if data:
+                    self.add(form, uuid, data)
+            if gaps:
+                tracker.expire()
+            if n:
+                logger.info(f"Link cache: loaded {n} rows from {form}")
+
+    def add(self, form, uuid, data):
+        """
+        Adds a form row to all the indexes for the form
+
+        Args:
+            form: form name
+            uuid: uuid of the row
+            data: data of the row
+        """
+        for index, link in self.indexes_by_form.get(form, []):
+            if index[0] == "to":
+                key = self._to_row_key(link, data)
+            else:
+                key = self._from_row_key(link, data)
+            if key is None:
+                continue
+            rows = self.entries.get((index, key))
+            if rows is None:
+                if index not in self.complete or (index, key) in self.evicted:
+                    # We do not have the other rows of the key
+                    continue
+                self._save((index, key))
+                rows = self.entries[(index, key)] = {}
+            else:
+                self._save((index, key))
+            if uuid not in rows:
+                self.size += 1
+            rows[uuid] = data
+        if self.size > self.max_rows:
+            self._evict()
+
+    def fill(self, index, key, rows):
+        """
+        Puts the rows of a key that is not in the cache, read from the db,
+        into the cache if it was evicted or its index is incomplete
+
+        Args:
+            index: ("to" or "from", link name)
+            key: key tuple
+            rows: list of (uuid, data) of all the rows of the key
+        """
+        if (index, key) in self.entries:
+            return
+        if (index, key) not in self.evicted and index in self.complete:
+            return
+        self._save((index, key))
+        self.evicted.discard((index, key))
+        rows = self.entries[(index, key)] = dict(rows)
+        self.size += len(rows)
+        if self.size > self.max_rows:
+            self._evict()
+
+    def get_to_links(self, link, raw_data):
+        """
+        Returns the (uuid, data) of the to_form rows that raw_data links to
+
+        Returns None if the cache can not answer and the db has to be
+        queried instead.
+        """
+        key = to_links_key(link, raw_data, self.alert_id_length)
+        if key is None:
+            return None
+        return self._get(("to", link["name"]), key)
+
+    def get_from_links(self, link, link_data):
+        """
+        Returns the (uuid, data) of the from_form rows that link to link_data
+
+        Returns None if the cache can not answer and the db has to be
+        queried instead.
+        """
+        key = from_links_key(link, link_data)
+        if key is None:
+            return None
+        return self._get(("from", link["name"]), key)
+
+    def _get(self, index, key):
+        rows = self.entries.get((index, key))
+        if rows is not None:
+            self.entries.move_to_end((index, key))
+            # Later steps add fields to the linked data
+            return [(uuid, dict(data)) for uuid, data in rows.items()]
+        if index in self.complete and (index, key) not in self.evicted:
+            return []
+        return None
+
+    def _evict(self):
+        target = int(self.max_rows * 0.9)
+        while self.size > target and self.entries:
+            self._save(next(iter(self.entries)))
+            (index, key), rows = self.entries.popitem(last=False)
+            self.size -= len(rows)
+            if index in self.complete:
+                self.evicted.add((index, key))
+        if len(self.evicted) > self.max_rows:
+            # Forget the evicted keys, their indexes can no longer tell a
+            # key that is not in the db from one that was evicted
+            self.complete.difference_update(
+                index for index, key in self.evicted)
+            for entry in self.evicted:
+                self._save(entry)
+            self.evicted.clear()
+            logger.info("Link cache: too many evicted keys, indexes marked "
+                        "as incomplete")
+        logger.info("Link cache full, evicted keys")
+
+    def _to_row_key(self, link, data):
+        if link.get("to_condition"):
+            column, expected = link["to_condition"].split(":")
+            if as_text(data.get(column)) != expected:
+                return None
+        key = []
+        for from_column, to_column, method in link_columns(link):
+            text = as_text(data.get(to_column))
+            if text is None or text == "":
+                return None
+            if method in ("match", "alert_match"):
+                key.append(text)
+            elif method == "lower_match":
+                key.append(text.lower().replace("-", "_"))
+            else:
+                key.append(None)
+        return tuple(key)
+
+    def _from_row_key(self, link, data):
+        key = []
+        for from_column, to_column, method in link_columns(link):
+            text = as_text(data.get(from_column))
+            if text is None or text == "":
+                return None
+            if method == "match":
+                key.append(text)
+            elif method == "lower_match":
+                key.append(text.lower().replace("-", "_"))
+            elif method == "alert_match":
+                # substring(text, 42 - alert_id_length, alert_id_length)
+                key.append(text[max(0, 41 - self.alert_id_length):41])
+            else:
+                key.append(None)
+        return tuple(key)
+
+
+def to_links_key(link, raw_data, alert_id_length):
+    """
+    Returns the key of the to_form rows that raw_data links to
+
+    Returns None if raw_data is missing one of the link columns, the
+    query in AddLinks then leaves out the condition for that column.
+    """
+    key = []
+    for from_column, to_column, method in link_columns(link):
+        if from_column not in raw_data:
+            return None
+        value = str(raw_data[from_column])
+        if method == "match":
+            key.append(value)
+        elif method == "lower_match":
+            key.append(value.lower().replace("-", "_"))
+        elif method == "alert_match":
+            key.append(value[-alert_id_length:])
+        else:
+            key.append(None)
+    return tuple(key)
+
+
+def from_links_key(link, link_data):
+    """
+    Returns the key of the from_form rows that link to link_data
+
+    Returns None if the key can not be compared as text.
+    """
+    key = []
+    for from_column, to_column, method in link_columns(link):
+        value = link_data.get(to_column)
+        if method in ("match", "alert_match"):
+            if value is not None and not isinstance(value, str):
+                return None
+            # None matches no rows as the row keys never contain None
+            key.append(value)
+        elif method == "lower_match":
+            key.append(str(value).lower().replace("-", "_"))
+        else:
+            key.append(None)
+    return tuple(key)
+
+
+def link_columns(link):
+    return zip(link["from_column"].split(";"),
+               link["to_column"].split(";"),
+               link["method"].split(";"))
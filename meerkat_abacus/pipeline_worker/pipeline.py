@@ -3,8 +3,16 @@ Main pipeline for abacus
 
 """
 import datetime
+import multiprocessing
+import queue
+import random
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
 
 from meerkat_abacus import model
+from meerkat_abacus import util
 from meerkat_abacus.pipeline_worker.process_steps.quality_control import QualityControl
 from meerkat_abacus.pipeline_worker.process_steps.write_to_db import WriteToDb
 from meerkat_abacus.pipeline_worker.process_steps.add_links import AddLinks
@@ -16,6 +24,11 @@ from meerkat_abacus.pipeline_worker.process_steps.initial_visit_control import I
 from meerkat_abacus.pipeline_worker.process_steps import DoNothing
 from meerkat_abacus import logger
 
+# Marks the end of the chunk in the stage queues
+_END = object()
+
+# The Pipeline the forked worker processes run the cpu only steps of
+_forked_pipeline = None
 
 
 class Pipeline:
@@ -28,6 +41,10 @@ class Pipeline:
         pipeline_spec = param_config.country_config["pipeline"]
         pipeline = []
         step_args = (param_config, session)
+        # The steps that need the locations share one tree
+        location_tree = None
+        if {"to_codes", "send_alerts", "add_multiple_alerts"} & set(pipeline_spec):
+            location_tree = util.get_location_tree(session)
         for step_name in pipeline_spec:
             if step_name == "do_nothing":
                 step_ = DoNothing(session)
@@ -45,11 +62,12 @@ class Pipeline:
                 step_ = AddLinks(*step_args)
                 step_.engine = engine
             elif step_name == "to_codes":
-                step_ = ToCodes(*step_args)
+                step_ = ToCodes(*step_args, location_tree=location_tree)
             elif step_name == "send_alerts":
-                step_ = SendAlerts(*step_args)
+                step_ = SendAlerts(*step_args, location_tree=location_tree)
             elif step_name == "add_multiple_alerts":
-                step_ = AddMultipleAlerts(*step_args)
+                step_ = AddMultipleAlerts(*step_args,
+                                          location_tree=location_tree)
                 step_.engine = engine
             else:
                 raise NotImplementedError(f"Step '{step_name}' is not implemented")
@@ -59,54 +77,500 @@ class Pipeline:
         self.param_config = param_config
         self.pipeline = pipeline
         self.param_config = param_config
+        self.failure_buffer = None
+        self.failure_sink = None
+        self.queue_depths = []
+        self.pool = None
+        self.parallel_workers = param_config.parallel_workers
+        if self.parallel_workers > 1:
+            check_can_fork()
+
+    def _start_pool(self, workers):
+        """
+        Forks the processes that run the cpu only steps
 
-    def process_chunk(self, input_data):
+        The pool is started when the first chunk needs it, so the workers
+        share the variables, locations and links with this process
+        (copy-on-write) instead of loading them again. The workers never
+        use the db session or engine they inherit.
+        """
+        global _forked_pipeline
+        check_can_fork()
+        _forked_pipeline = self
+        self.pool = multiprocessing.get_context("fork").Pool(
+            workers, initializer=_init_forked_worker)
+        self.parallel_workers = workers
+
+    def close(self):
+        """ Stops the worker processes, called when the celery worker stops """
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def process_chunk(self, input_data, connection=None):
         """
         Processing a chunk of data from the internal buffer
 
 
         Each step in this pipeline should take a single record and return
-        data = input_data
-     
+        a list of new records. Steps that implement run_batch get the whole
+        chunk at once. In both cases a record that raises an exception is
+        written to the step_failures table and the rest of the chunk
+        continues.
+
+        If chunk_transaction is set in the config the whole chunk is
+        processed in one db transaction, see _process_chunk_in_transaction.
+        Otherwise if streaming_pipeline is set the steps run concurrently,
+        see _process_chunk_streaming.
+
+        If a connection is given the steps that use the engine directly
+        share it for the chunk instead of each getting connections from
+        the pool. In chunk_transaction mode it is also used for the
+        transaction. The streaming steps run in their own threads and
+        always get their connections from the engine.
+
+        Args:
+            input_data: list of records
+            connection: db connection to use for the chunk
         """
-        data = input_data
+        if self.param_config.chunk_transaction:
+            return self._process_chunk_in_transaction(input_data, connection)
+        if self.param_config.streaming_pipeline:
+            return self._process_chunk_streaming(input_data)
+        if connection is None:
+            return self._process_steps(input_data)
+        engines = self._set_step_engines(connection)
+        try:
+            return self._process_steps(input_data)
+        finally:
+            self._restore_step_engines(engines)
+
+    def _set_step_engines(self, engine):
+        """
+        Sets the engine of the steps that use one
+
+        Returns:
+            list of (step, engine) to give to _restore_step_engines
+        """
+        engines = []
         for step in self.pipeline:
-            step.start_step()
-            n = len(data)
-            new_data = []
-            for d in data:
-                data_field = d["data"]
-                form = d["form"]
+            step_engine = getattr(step, "engine", None)
+            if step_engine is not None:
+                engines.append((step, step_engine))
+                step.engine = engine
+        return engines
+
+    @staticmethod
+    def _restore_step_engines(engines):
+        for step, engine in engines:
+            step.engine = engine
+
+    def _process_chunk_streaming(self, input_data):
+        """
+        Processes a chunk with each step running in its own thread
+
+        The chunk is split into micro-batches of stream_batch_size records
+        that are passed from step to step over bounded queues, so that a
+        step waiting for the db overlaps with the work of the other steps.
+        The threads share the GIL, so the python work of the steps does
+        not run in parallel, only the db waits overlap with it. When a
+        queue is full the step in front of it waits, and in the end so
+        does process_chunk and the consumer calling it.
+
+        Each step gets its own db session while the chunk runs.
+        start_chunk and end_chunk are called once per chunk and start_step
+        and end_step for each micro-batch. After the chunk
+        self.queue_depths holds the maximum and mean number of
+        micro-batches that were waiting in front of each step, it is
+        logged so the queue sizes can be tuned.
+
+        If a step raises outside of the per record error handling the
+        remaining micro-batches are dropped and the exception is raised
+        once all the threads have stopped.
+        """
+        batch_size = self.param_config.stream_batch_size
+        queues = [queue.Queue(maxsize=self.param_config.stream_queue_size)
+                  for step in self.pipeline]
+        output = queue.Queue()
+        errors = []
+        depths = [[] for step in self.pipeline]
+        saved_sessions = []
+        threads = []
+        for i, step in enumerate(self.pipeline):
+            session = Session(bind=self.engine)
+            saved_sessions.append((step, step.session, session))
+            step.session = session
+            out_queue = queues[i + 1] if i + 1 < len(queues) else output
+            thread = threading.Thread(
+                target=self._run_stage,
+                args=(step, session, queues[i], out_queue, depths[i], errors),
+                name=f"pipeline-{i}-{step.step_name}",
+                daemon=True)
+            threads.append(thread)
+        try:
+            for thread in threads:
+                thread.start()
+            for start in range(0, len(input_data), batch_size):
+                queues[0].put(input_data[start:start + batch_size])
+            queues[0].put(_END)
+            data = []
+            while True:
+                batch = output.get()
+                if batch is _END:
+                    break
+                data.extend(batch)
+            for thread in threads:
+                thread.join()
+        finally:
+            for step, step_session, session in saved_sessions:
+                step.session = step_session
+                session.close()
+        self.queue_depths = [
+            {"step": step.step_name,
+             "max": max(depth, default=0),
+             "mean": sum(depth) / len(depth) if depth else 0}
+            for step, depth in zip(self.pipeline, depths)]
+        logger.info(f"Pipeline queue depths: {self.queue_depths}")
+        if errors:
+            raise errors[0]
+        return data
+
+    def _run_stage(self, step, session, in_queue, out_queue, depths, errors):
+        """
+        Runs one step of the streaming pipeline until the end of the chunk
+
+        Args:
+            step: the step to run
+            session: db session for the step
+            in_queue: queue of micro-batches for the step
+            out_queue: queue for the records returned by the step
+            depths: list to record the queue depth in
+            errors: list shared by all stages for unhandled exceptions
+        """
+        try:
+            step.start_chunk()
+        except Exception as exception:
+            logger.exception(f"Step {step} failed in the streaming pipeline",
+                             exc_info=True)
+            errors.append(exception)
+        while True:
+            batch = in_queue.get()
+            if batch is _END:
                 try:
-                    new_data += step.run(form, data_field)
+                    step.end_chunk()
                 except Exception as exception:
-                    self.handle_exception(d, exception, step)
-                    n = n - 1
-            step.end_step(n)
-            data = new_data
-            if not new_data:
+                    logger.exception(f"Step {step} failed in the streaming pipeline",
+                                     exc_info=True)
+                    errors.append(exception)
+                out_queue.put(_END)
+                return
+            depths.append(in_queue.qsize() + 1)
+            if errors:
+                # Another stage failed, drop the rest of the chunk
+                continue
+            try:
+                step.start_step()
+                if has_run_batch(step):
+                    new_data, n = self._run_batch(step, batch, session=session)
+                else:
+                    new_data, n = self._run(step, batch, session=session)
+                step.end_step(n)
+            except Exception as exception:
+                logger.exception(f"Step {step} failed in the streaming pipeline",
+                                 exc_info=True)
+                errors.append(exception)
+                continue
+            if new_data:
+                out_queue.put(new_data)
+
+    def _process_chunk_in_transaction(self, input_data, connection=None):
+        """
+        Processes a chunk in one transaction on one connection
+
+        All steps use a session and engine bound to the same connection.
+        Each step runs in a savepoint, so when a step rolls back after an
+        error it only loses its own work since its last commit. Monitoring
+        rows and step failures are buffered and written at the end, and the
+        chunk is committed at once. If a step fails the whole chunk is
+        rolled back, so nothing from a half processed chunk is written.
+        The steps' in-memory caches are rolled back with it, as they can
+        have read the chunk's own rows on the chunk's connection.
+
+        Args:
+            input_data: list of records
+            connection: connection to use, by default we get one from the
+                engine
+        """
+        own_connection = connection is None
+        if own_connection:
+            connection = self.engine.connect()
+        transaction = connection.begin()
+        session = Session(bind=connection)
+        session.begin_nested()
+
+        @event.listens_for(session, "after_transaction_end")
+        def restart_savepoint(session_, transaction_):
+            if transaction_.nested and not transaction_._parent.nested:
+                session_.expire_all()
+                session_.begin_nested()
+
+        monitoring_buffer = []
+        saved = (self.session, self.failure_buffer)
+        saved_sessions = []
+        for step in self.pipeline:
+            saved_sessions.append((step, step.session))
+            step.session = session
+            step.monitoring_buffer = monitoring_buffer
+        engines = self._set_step_engines(connection)
+        self.session = session
+        self.failure_buffer = []
+        try:
+            for step in self.pipeline:
+                step.start_transaction()
+            data = self._process_steps(input_data, savepoints=True)
+            session.add_all(self.failure_buffer + monitoring_buffer)
+            session.commit()
+            transaction.commit()
+        except Exception:
+            transaction.rollback()
+            for step in self.pipeline:
+                step.rollback_transaction()
+            raise
+        else:
+            for step in self.pipeline:
+                step.commit_transaction()
+        finally:
+            for step, step_session in saved_sessions:
+                step.session = step_session
+                step.monitoring_buffer = None
+            self._restore_step_engines(engines)
+            self.session, self.failure_buffer = saved
+            session.close()
+            if own_connection:
+                connection.close()
+        return data
+
+    def _process_steps(self, input_data, savepoints=False):
+        """
+        Runs the data through the steps
+
+        Args:
+            input_data: list of records
+            savepoints: start a new savepoint before each step
+        """
+        data = input_data
+        i = 0
+        while i < len(self.pipeline):
+            step = self.pipeline[i]
+            if savepoints:
+                # Releases the savepoint of the previous step and starts a new one
+                self.session.commit()
+            if (self.parallel_workers > 1 and step.cpu_only and not savepoints
+                    and len(data) >= self.parallel_workers):
+                if self.pool is None:
+                    self._start_pool(self.parallel_workers)
+                end = i
+                while end < len(self.pipeline) and self.pipeline[end].cpu_only:
+                    end += 1
+                data = self._run_parallel(i, end, data)
+                i = end
+            else:
+                step.start_step()
+                if has_run_batch(step):
+                    new_data, n = self._run_batch(step, data)
+                else:
+                    new_data, n = self._run(step, data)
+                step.end_step(n)
+                data = new_data
+                i += 1
+            if not data:
                 break
         return data
 
-    def handle_exception(self, data, exception, step):
+    def _run_parallel(self, start, end, data):
+        """
+        Runs the cpu only steps start to end in the worker processes
+
+        The records are split into one contiguous slice per worker and
+        the results are merged in the order of the records, so the next
+        steps get the same records in the same order as when running in
+        this process. Failures are returned by the workers and written
+        here.
+
+        Returns:
+            new_data: records returned by the last of the steps
+        """
+        steps = self.pipeline[start:end]
+        for step in steps:
+            step.start_step()
+        size = -(-len(data) // self.parallel_workers)
+        slices = [(start, end, data[i:i + size])
+                  for i in range(0, len(data), size)]
+        new_data = []
+        failures = [[] for step in steps]
+        counts = [None] * len(steps)
+        for records, slice_failures, slice_counts in self.pool.map(
+                _run_forked_steps, slices):
+            new_data.extend(records)
+            for k, n in enumerate(slice_counts):
+                failures[k].extend(slice_failures[k])
+                if n is not None:
+                    counts[k] = (counts[k] or 0) + n
+        # Written step by step, as they would be when running here
+        for step_failures in failures:
+            for record, step_name, error_str in step_failures:
+                self._add_failure(record, step_name, error_str, self.session)
+        for step, n in zip(steps, counts):
+            if n is not None:
+                step.end_step(n)
+        return new_data
+
+    def _run(self, step, data, session=None):
+        """
+        Runs step.run record by record
+
+        Args:
+            step: the step to run
+            data: list of records
+            session: session to write failures with, self.session if None
+        Returns:
+            (new_data, n): new records and the number of records that
+            did not fail
+        """
+        n = len(data)
+        new_data = []
+        for d in data:
+            try:
+                new_data.extend(step.run(d["form"], d["data"]))
+            except Exception as exception:
+                self.handle_exception(d, exception, step, session=session)
+                n = n - 1
+        return new_data, n
+
+    def _run_batch(self, step, data, session=None):
+        """
+        Runs step.run_batch on the whole chunk
+
+        If the batch call itself fails we fall back to running
+        the records one by one.
+
+        Args:
+            step: the step to run
+            data: list of records
+            session: session to write failures with, self.session if None
+        Returns:
+            (new_data, n): new records and the number of records that
+            did not fail
+        """
+        try:
+            results = step.run_batch(data)
+        except Exception:
+            logger.exception(f"Batch run failed in step {step}, running records one by one",
+                             exc_info=True)
+            return self._run(step, data, session=session)
+        n = len(data)
+        new_data = []
+        for d, result in zip(data, results):
+            if isinstance(result, Exception):
+                self.handle_exception(d, result, step, session=session)
+                n = n - 1
+            else:
+                new_data.extend(result)
+        return new_data, n
+
+    def handle_exception(self, data, exception, step, session=None):
         """
         Handles an exeption in the step.run method by writing the data
         to a log table and logging the exception
         """
+        if session is None:
+            session = self.session
+        logger.exception(f"There was an error in step {step}", exc_info=exception)
+        error_str = type(exception).__name__ + ": " + str(exception)
+        if self.failure_sink is not None:
+            self.failure_sink.append((data, str(step), error_str))
+            return
+        session.rollback()
+        self._add_failure(data, str(step), error_str, session)
+
+    def _add_failure(self, data, step_name, error_str, session):
+        """
+        Writes a record that failed in a step to the step_failures table
+        """
         form_data = data["data"]
         form = data["form"]
-        logger.exception(f"There was an error in step {step}", exc_info=True)
-        self.session.rollback()
-        error_str = type(exception).__name__ + ": " + str(exception)
-        self.session.add(
-            model.StepFailiure(
-                data=fix_json(form_data),
-                form=form,
-                step_name=str(step),
-                error=error_str
-                )
-            )
-        self.session.commit()
+        failure = model.StepFailiure(
+            data=fix_json(form_data),
+            form=form,
+            step_name=step_name,
+            error=error_str
+        )
+        if self.failure_buffer is not None:
+            self.failure_buffer.append(failure)
+            return
+        session.add(failure)
+        session.commit()
+
+
+def check_can_fork():
+    """
+    Raises a ValueError if this process can not start the worker
+    processes for PARALLEL_WORKERS
+
+    The processes of the default celery prefork pool are daemonic, and
+    daemonic processes are not allowed to have children.
+    """
+    if multiprocessing.current_process().daemon:
+        raise ValueError(
+            "PARALLEL_WORKERS > 1 can not be used in a daemonic process, "
+            "e.g. a celery prefork worker. Run the celery worker with "
+            "--pool solo or set PARALLEL_WORKERS to 0")
+
+
+def _init_forked_worker():
+    # The workers inherit the state of the random module, reseed so they
+    # do not all draw the same numbers
+    random.seed()
+
+
+def _run_forked_steps(args):
+    """
+    Runs steps start to end on records in a forked worker process
+
+    Args:
+        args: (start, end, records)
+    Returns:
+        (records, failures, counts): the records returned by the last
+        step and for each step a list of (record, step, error) of the
+        failed records and the number of records that did not fail,
+        None for steps that got no records
+    """
+    start, end, data = args
+    pipeline = _forked_pipeline
+    failures = [[] for index in range(start, end)]
+    counts = [None] * (end - start)
+    for index in range(start, end):
+        if not data:
+            break
+        step = pipeline.pipeline[index]
+        pipeline.failure_sink = failures[index - start]
+        if has_run_batch(step):
+            data, counts[index - start] = pipeline._run_batch(step, data)
+        else:
+            data, counts[index - start] = pipeline._run(step, data)
+    pipeline.failure_sink = None
+    return data, failures, counts
+
+
+def has_run_batch(step):
+    """
+    Returns True if the step implements run_batch
+
+    We look at the class and not the instance so that mocked
+    steps are run record by record.
+    """
+    return getattr(type(step), "run_batch", None) is not None
 
 
 def fix_json(row):
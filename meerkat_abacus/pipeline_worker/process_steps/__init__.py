@@ -10,7 +10,22 @@ class ProcessingStep(object):
     """
     Base class for all ProcessingSteps
 
+    Steps implement run(form, data) for a single record. Steps that can
+    process a whole chunk more efficiently, e.g. with one query instead of
+    one per record, can in addition implement run_batch(records). The
+    Pipeline uses run_batch when a step provides it and run otherwise.
+
     """
+    # Optional, set to a method taking a list of {"form", "data"} records
+    # and returning one entry per record: either the list of new records
+    # or the exception raised for that record. See run_each.
+    run_batch = None
+    # Set by the Pipeline to a list to buffer the monitoring rows instead
+    # of committing them after each step
+    monitoring_buffer = None
+    # True for steps that only use memory and cpu in run, without the db
+    # or other services. The Pipeline can run these in forked processes.
+    cpu_only = False
 
     def __init__(self):
         self.step_name = "processing_step"
@@ -31,6 +46,61 @@ class ProcessingStep(object):
     def run(self, form, data):
         pass
 
+    def run_each(self, records):
+        """
+        Runs self.run on each record and isolates errors per record
+
+        Helper for run_batch implementations that do their bulk work
+        up front and then process the records one by one.
+
+        Args:
+            records: list of {"form": form, "data": data} dicts
+        Returns:
+            results(list): for each record either the list returned by
+                run or the exception raised by it
+        """
+        results = []
+        for record in records:
+            try:
+                results.append(self.run(record["form"], record["data"]))
+            except Exception as exception:
+                results.append(exception)
+        return results
+
+    def start_chunk(self):
+        """
+        Called once per chunk by the streaming pipeline, before the
+        first micro-batch, for work that is only needed once per chunk
+        """
+        pass
+
+    def end_chunk(self):
+        """
+        Called once per chunk by the streaming pipeline, after the last
+        micro-batch
+        """
+        pass
+
+    def start_transaction(self):
+        """
+        Called by the pipeline when a chunk starts in one transaction, so
+        in-memory state read in the transaction can be undone if it
+        rolls back
+        """
+        pass
+
+    def commit_transaction(self):
+        """
+        Called after the chunk's transaction has committed
+        """
+        pass
+
+    def rollback_transaction(self):
+        """
+        Called after the chunk's transaction has rolled back
+        """
+        pass
+
     def start_step(self):
         self.start = datetime.datetime.now()
         # self.profiler = cProfile.Profile()
@@ -53,11 +123,16 @@ class ProcessingStep(object):
             start=self.start,
             duration=self.duration.total_seconds(),
             n=n)
+        if self.monitoring_buffer is not None:
+            self.monitoring_buffer.append(monitoring)
+            return
         self.session.add(monitoring)
         self.session.commit()
 
 
 class DoNothing(ProcessingStep):
+    cpu_only = True
+
     def __init__(self, session):
         super().__init__()
         self.step_name = "do_nothing"
@@ -1,8 +1,10 @@
-from sqlalchemy import func
-from dateutil.parser import parse
+from sqlalchemy import func, tuple_
 
 from meerkat_abacus.pipeline_worker.process_steps import ProcessingStep
+from meerkat_abacus.pipeline_worker.link_cache import (
+    LinkCache, to_links_key, from_links_key, link_columns)
 from meerkat_abacus import model, util
+from meerkat_abacus.util.datetime_helper import parse
 from meerkat_abacus import logger
 
 
@@ -16,6 +18,17 @@ class AddLinks(ProcessingStep):
         links_file_ = param_config.config_directory \
                       + param_config.country_config["links_file"]
         self.links_by_type, self.links_by_name = util.get_links(links_file_)
+        self.link_cache = None
+        if param_config.link_cache:
+            self.link_cache = LinkCache(
+                list(self.links_by_name.values()),
+                model.form_tables(param_config=param_config),
+                param_config.country_config["alert_id_length"],
+                max_rows=param_config.link_cache_max_rows
+            )
+        self._use_cache = False
+        self._prefetched = {}
+        self._chunk_refreshed = False
 
     @property
     def engine(self):
@@ -25,6 +38,28 @@ class AddLinks(ProcessingStep):
     def engine(self, new_engine):
         self._engine = new_engine
 
+    def run_batch(self, records):
+        """
+        Creates the links for a chunk of records
+
+        If the link cache is enabled we load the new form rows into it
+        and look up the links in the cache instead of the db. The links
+        the cache can not answer are looked up with one query per link
+        for the whole chunk. In the streaming pipeline the full refresh is
+        done once per chunk in start_chunk and each micro-batch only reads
+        the rows written since.
+        """
+        if self.link_cache is not None:
+            self.link_cache.refresh(self.session,
+                                    gaps=not self._chunk_refreshed)
+            self._use_cache = True
+        try:
+            self._prefetched = self._prefetch_links(records)
+            return self.run_each(records)
+        finally:
+            self._use_cache = False
+            self._prefetched = {}
+
     def run(self, form, data):
         """
         Creates all the links for a given data row
@@ -42,6 +77,26 @@ class AddLinks(ProcessingStep):
         } for data in new_data]
         return return_data
 
+    def start_chunk(self):
+        if self.link_cache is not None:
+            self.link_cache.refresh(self.session)
+            self._chunk_refreshed = True
+
+    def end_chunk(self):
+        self._chunk_refreshed = False
+
+    def start_transaction(self):
+        if self.link_cache is not None:
+            self.link_cache.begin()
+
+    def commit_transaction(self):
+        if self.link_cache is not None:
+            self.link_cache.commit()
+
+    def rollback_transaction(self):
+        if self.link_cache is not None:
+            self.link_cache.rollback()
+
     def _get_from_links(self, data):
         assert len(data["link_data"].keys()) == 1
 
@@ -54,7 +109,23 @@ class AddLinks(ProcessingStep):
                 return []
         # aggregate_condition = link['aggregate_condition'] TODO
         from_form_name_ = link["from_form"]
-        from_form = model.form_tables(param_config=self.config)[from_form_name_]
+        link_query = self._lookup_links("from", link, link_data)
+        if link_query is None:
+            link_query = self._query_from_links(link, link_data)
+
+        return_data = [{
+            "type": data["type"],
+            "original_form": from_form_name_,
+            "raw_data": base_form_value[1],
+            "link_data": {link["name"]: link_data}
+        } for base_form_value in link_query]
+        return return_data
+
+    def _query_from_links(self, link, link_data):
+        """
+        Queries the db for the from_form rows that link to link_data
+        """
+        from_form = model.form_tables(param_config=self.config)[link["from_form"]]
         # link_names.append(link["name"])
 
         columns = [from_form.uuid, from_form.data]
@@ -87,58 +158,18 @@ class AddLinks(ProcessingStep):
             logger.exception("Failed to execute query. Retrying after rollback.")
             self.session.rollback()
             link_query = self.session.query(*columns).filter(*conditions).all()
-
-        return_data = [{
-            "type": data["type"],
-            "original_form": from_form_name_,
-            "raw_data": base_form_value[1],
-            "link_data": {link["name"]: link_data}
-        } for base_form_value in link_query]
-        return return_data
+        return link_query
 
     def _get_to_links(self, data):
         link_data = {}
         for link in self.links_by_type.get(data["type"], []):
-            to_form = model.form_tables(
-                param_config=self.config)[link["to_form"]]
             if link.get("from_condition"):
                 column, expected = link["from_condition"].split(":")
                 if data.get(column) != expected:
                     continue
-            columns = [to_form.uuid, to_form.data]
-            conditions = []
-            from_columns = link["from_column"].split(";")
-            to_columns = link["to_column"].split(";")
-            methods = link["method"].split(";")
-            for from_column, to_column, method in zip(from_columns, to_columns, methods):
-                try:
-                    expected = str(data["raw_data"][from_column])
-                    to_column_text = to_form.data[to_column].astext
-                except Exception:
-                    logger.error(f'ERROR: {data["raw_data"]}')
-                    continue
-                if method == "match":
-                    conditions.append(to_column_text == expected)
-                elif method == "lower_match":
-                    left = func.replace(func.lower(to_column_text), "-", "_")
-                    right = str(expected).lower().replace("-", "_")
-                    conditions.append(left == right)
-                elif method == "alert_match":
-                    alert_id_ = expected[-self.config.country_config["alert_id_length"]:]
-                    conditions.append(to_column_text == alert_id_)
-                conditions.append(to_column_text != '')
-
-            # handle the filter condition
-            if link.get("to_condition"):
-                column, expected = link["to_condition"].split(":")
-                condition = to_form.data[column].astext == expected
-                conditions.append(condition)
-            try:
-                link_query = self.session.query(*columns).filter(*conditions).all()
-            except Exception:
-                logger.exception("Failed to execute query. Retrying after rollback.")
-                self.session.rollback()
-                link_query = self.session.query(*columns).filter(*conditions).all()
+            link_query = self._lookup_links("to", link, data["raw_data"])
+            if link_query is None:
+                link_query = self._query_to_links(link, data)
 
             if link["name"] in data.get("link_data", {}):
                 link_query.append((None, data["link_data"][link["name"]]))
@@ -155,3 +186,213 @@ class AddLinks(ProcessingStep):
 
         data["link_data"] = link_data
         return data
+
+    def _query_to_links(self, link, data):
+        """
+        Queries the db for the to_form rows that data links to
+        """
+        to_form = model.form_tables(
+            param_config=self.config)[link["to_form"]]
+        columns = [to_form.uuid, to_form.data]
+        conditions = []
+        from_columns = link["from_column"].split(";")
+        to_columns = link["to_column"].split(";")
+        methods = link["method"].split(";")
+        for from_column, to_column, method in zip(from_columns, to_columns, methods):
+            try:
+                expected = str(data["raw_data"][from_column])
+                to_column_text = to_form.data[to_column].astext
+            except Exception:
+                logger.error(f'ERROR: {data["raw_data"]}')
+                continue
+            if method == "match":
+                conditions.append(to_column_text == expected)
+            elif method == "lower_match":
+                left = func.replace(func.lower(to_column_text), "-", "_")
+                right = str(expected).lower().replace("-", "_")
+                conditions.append(left == right)
+            elif method == "alert_match":
+                alert_id_ = expected[-self.config.country_config["alert_id_length"]:]
+                conditions.append(to_column_text == alert_id_)
+            conditions.append(to_column_text != '')
+
+        # handle the filter condition
+        if link.get("to_condition"):
+            column, expected = link["to_condition"].split(":")
+            condition = to_form.data[column].astext == expected
+            conditions.append(condition)
+        try:
+            link_query = self.session.query(*columns).filter(*conditions).all()
+        except Exception:
+            logger.exception("Failed to execute query. Retrying after rollback.")
+            self.session.rollback()
+            link_query = self.session.query(*columns).filter(*conditions).all()
+        return link_query
+
+    def _lookup_links(self, direction, link, values):
+        """
+        Looks up links in the link cache or in the links fetched for the
+        chunk by run_batch
+
+        Args:
+            direction: "to" or "from"
+            link: link definition
+            values: raw_data for "to" and link_data for "from" links
+        Returns:
+            link_query(list): list of (uuid, data) or None if the db has
+            to be queried
+        """
+        link_query = None
+        if self._use_cache:
+            if direction == "to":
+                link_query = self.link_cache.get_to_links(link, values)
+            else:
+                link_query = self.link_cache.get_from_links(link, values)
+        if link_query is None and (direction, link["name"]) in self._prefetched:
+            key = self._link_key(direction, link, values)
+            fetched_keys, rows_by_key = self._prefetched[(direction, link["name"])]
+            if key in fetched_keys:
+                link_query = [(uuid, dict(data))
+                              for uuid, data in rows_by_key.get(key, [])]
+        return link_query
+
+    def _link_key(self, direction, link, values):
+        if direction == "to":
+            return to_links_key(link, values,
+                                self.config.country_config["alert_id_length"])
+        return from_links_key(link, values)
+
+    def _prefetch_links(self, records):
+        """
+        Fetches the links for all the records in a chunk with one query
+        per link instead of one per record and link.
+
+        Only the links the link cache can not answer are fetched, and the
+        rows of keys the cache had evicted are put back into it. Links for
+        records created from "from" links are not known in advance and are
+        still queried one by one.
+
+        Args:
+            records: list of {"form": form, "data": data} dicts
+        Returns:
+            prefetched(dict): (direction, link name): (keys, rows_by_key)
+        """
+        keys = {}
+        for record in records:
+            data = record["data"]
+            if "raw_data" in data:
+                for link in self.links_by_type.get(data["type"], []):
+                    if link.get("from_condition"):
+                        column, expected = link["from_condition"].split(":")
+                        if data.get(column) != expected:
+                            continue
+                    self._add_prefetch_key(keys, "to", link, data["raw_data"])
+            elif len(data.get("link_data", {})) == 1:
+                link_name_ = list(data["link_data"].keys())[0]
+                link = self.links_by_name[link_name_]
+                link_data = data["link_data"][link["name"]][0]
+                if link.get("to_condition"):
+                    column, condition = link["to_condition"].split(":")
+                    if link_data.get(column) != condition:
+                        continue
+                self._add_prefetch_key(keys, "from", link, link_data)
+
+        prefetched = {}
+        for (direction, link_name), link_keys in keys.items():
+            rows_by_key = self._query_links_batch(
+                direction, self.links_by_name[link_name], link_keys)
+            prefetched[(direction, link_name)] = (link_keys, rows_by_key)
+            if self._use_cache:
+                # Put the keys the cache had evicted back into it
+                for key in link_keys:
+                    self.link_cache.fill((direction, link_name), key,
+                                         rows_by_key.get(key, []))
+        return prefetched
+
+    def _add_prefetch_key(self, keys, direction, link, values):
+        if self._use_cache:
+            if direction == "to":
+                cached = self.link_cache.get_to_links(link, values)
+            else:
+                cached = self.link_cache.get_from_links(link, values)
+            if cached is not None:
+                return
+        key = self._link_key(direction, link, values)
+        if key is not None:
+            keys.setdefault((direction, link["name"]), set()).add(key)
+
+    def _query_links_batch(self, direction, link, keys):
+        """
+        Queries the db for the rows matching any of the keys for a link
+
+        We select the same normalised values as the per record queries
+        compare on, filter them with a single IN over all the key tuples
+        and group the returned rows by key.
+
+        Args:
+            direction: "to" or "from"
+            link: link definition
+            keys: set of key tuples
+        Returns:
+            rows_by_key(dict): key: list of (uuid, data)
+        """
+        form_tables = model.form_tables(param_config=self.config)
+        id_length = self.config.country_config["alert_id_length"]
+        if direction == "to":
+            table = form_tables[link["to_form"]]
+        else:
+            table = form_tables[link["from_form"]]
+        key_columns = []
+        conditions = []
+        for from_column, to_column, method in link_columns(link):
+            if direction == "to":
+                column_text = table.data[to_column].astext
+            else:
+                column_text = table.data[from_column].astext
+            conditions.append(column_text != '')
+            if method == "match" or (method == "alert_match" and direction == "to"):
+                key_columns.append(column_text)
+            elif method == "lower_match":
+                key_columns.append(
+                    func.replace(func.lower(column_text), "-", "_"))
+            elif method == "alert_match":
+                key_columns.append(
+                    func.substring(column_text, 42 - id_length, id_length))
+            else:
+                key_columns.append(None)
+        if direction == "to" and link.get("to_condition"):
+            column, expected = link["to_condition"].split(":")
+            conditions.append(table.data[column].astext == expected)
+
+        positions = [i for i, c in enumerate(key_columns) if c is not None]
+        values = set()
+        for key in keys:
+            value = tuple(key[i] for i in positions)
+            if None not in value:
+                values.add(value)
+        if positions:
+            if not values:
+                return {}
+            selected = [key_columns[i] for i in positions]
+            if len(selected) == 1:
+                conditions.append(selected[0].in_([v[0] for v in values]))
+            else:
+                conditions.append(tuple_(*selected).in_(list(values)))
+        else:
+            selected = []
+
+        columns = [table.uuid, table.data] + selected
+        try:
+            link_query = self.session.query(*columns).filter(*conditions).all()
+        except Exception:
+            logger.exception("Failed to execute query. Retrying after rollback.")
+            self.session.rollback()
+            link_query = self.session.query(*columns).filter(*conditions).all()
+
+        rows_by_key = {}
+        for row in link_query:
+            key = [None] * len(key_columns)
+            for i, value in zip(positions, row[2:]):
+                key[i] = value
+            rows_by_key.setdefault(tuple(key), []).append((row[0], row[1]))
+        return rows_by_key
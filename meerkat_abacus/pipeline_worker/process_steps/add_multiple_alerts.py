@@ -4,22 +4,41 @@ from sqlalchemy import func, or_, and_
 from sqlalchemy.sql import text
 
 from meerkat_abacus.pipeline_worker.process_steps import ProcessingStep
-from meerkat_abacus.util.epi_week import epi_year_start_date
+from meerkat_abacus.pipeline_worker.threshold_counters import (
+    ThresholdCounters, threshold_alerts)
+from meerkat_abacus.pipeline_worker.alert_weekly_counts import (
+    weekly_counts, neighbour_weeks)
+from meerkat_abacus.util.epi_week import epi_year_start_date, get_calendar
 from meerkat_abacus import model
 from meerkat_abacus import util
 
 
 class AddMultipleAlerts(ProcessingStep):
 
-    def __init__(self, param_config, session):
+    def __init__(self, param_config, session, location_tree=None):
         self.step_name = "add_multiple_alerts"
         self.alerts = session.query(model.AggregationVariables).filter(
             model.AggregationVariables.alert == 1,
             model.AggregationVariables.alert_type != "indivdual").all()
 
-        self.locations = util.all_location_data(session)[0]
+        if location_tree is None:
+            location_tree = util.get_location_tree(session)
+        self.locations = location_tree.locations
         self.config = param_config
         self.session = session
+        self.threshold_counters = None
+        if param_config.threshold_counters:
+            self.threshold_counters = ThresholdCounters(
+                [a.id for a in self.alerts
+                 if a.alert_type and a.alert_type.split(":")[0] == "threshold"],
+                retain_days=param_config.threshold_counters_days)
+        self._chunk_refreshed = False
+        self.calendar = None
+        if param_config.alert_weekly_counts:
+            self.calendar = get_calendar(
+                param_config.country_config["epi_week"],
+                param_config.country_config.get("epi_week_53_strategy",
+                                                "leave_as_is"))
     
     @property
     def engine(self):
@@ -32,6 +51,29 @@ class AddMultipleAlerts(ProcessingStep):
     def start_step(self):
         super(AddMultipleAlerts, self).start_step()
         self.found_uuids = set([])
+        if self.threshold_counters is not None:
+            self.threshold_counters.refresh(self.session,
+                                            gaps=not self._chunk_refreshed)
+
+    def start_chunk(self):
+        if self.threshold_counters is not None:
+            self.threshold_counters.refresh(self.session)
+            self._chunk_refreshed = True
+
+    def end_chunk(self):
+        self._chunk_refreshed = False
+
+    def start_transaction(self):
+        if self.threshold_counters is not None:
+            self.threshold_counters.begin()
+
+    def commit_transaction(self):
+        if self.threshold_counters is not None:
+            self.threshold_counters.commit()
+
+    def rollback_transaction(self):
+        if self.threshold_counters is not None:
+            self.threshold_counters.rollback()
 
         
     def run(self, form, data):
@@ -41,6 +83,10 @@ class AddMultipleAlerts(ProcessingStep):
         
         """
         return_data = []
+        if self.threshold_counters is not None:
+            self.threshold_counters.add(
+                data["uuid"], data.get("type"), data.get("clinic"), data.get("date"),
+                data.get("epi_year"), data.get("epi_week"), data["variables"])
         if data["uuid"] not in self.found_uuids:
             for a in self.alerts:
                 var_id = a.id
@@ -52,7 +98,16 @@ class AddMultipleAlerts(ProcessingStep):
 
                 new_alerts = []
                 type_name = None
-                if alert_type == "threshold":
+                if (alert_type == "threshold" and
+                        self.threshold_counters is not None and
+                        self.threshold_counters.covers(data["date"])):
+                    new_alerts = threshold_alerts(self.threshold_counters,
+                                                  var_id,
+                                                  a.alert_type,
+                                                  data,
+                                                  self.session)
+                    type_name = "threshold"
+                elif alert_type == "threshold":
                     new_alerts = threshold(
                         var_id,
                         a.alert_type,
@@ -61,6 +116,14 @@ class AddMultipleAlerts(ProcessingStep):
                         self.session
                     )
                     type_name = "threshold"
+                elif alert_type == "double" and self.calendar is not None:
+                    new_alerts = double_double_counts(a.id,
+                                                      data["epi_week"],
+                                                      data["epi_year"],
+                                                      data["clinic"],
+                                                      self.engine,
+                                                      self.calendar)
+                    type_name = "threshold"
                 elif alert_type == "double":
                     new_alerts = double_double(a.id,
                                                data["epi_week"],
@@ -356,3 +419,58 @@ def double_double(var_id, week, year, clinic, engine):
             })
 
     return alerts
+
+
+def double_double_counts(var_id, week, year, clinic, engine, calendar):
+    """
+    Calculate double doubling alerts from the alert_weekly_counts table
+
+    Gives the same alerts as double_double, but reads the counts of the
+    five weeks around the week from alert_weekly_counts and only reads the
+    uuids from data for the week of an alert. The weeks before and after
+    are found with the epi week calendar, so the weeks around the start of
+    a year are right for years with 53 weeks.
+
+    Args:
+       var_id: variable id for alert
+       week: epi week
+       year: epi year
+       clinic: clinic id
+       engine: db engine
+       calendar: EpiWeekCalendar for the country
+
+    Returns:
+        alerts: list of alerts.
+    """
+    weeks = neighbour_weeks(calendar, year, week)
+    i = weeks.index((year, week))
+    connection = engine.connect()
+    try:
+        counts_by_week = weekly_counts(connection, var_id, clinic, weeks)
+        counts = {position - i: counts_by_week.get(w, 0)
+                  for position, w in enumerate(weeks)}
+        if sum(counts.values()) < 14:
+            return []
+
+        alerts = []
+        for first in [0, -1, -2]:
+            if counts.get(first, 0) > 1:
+                if (counts.get(first + 1, 0) >= 2 * counts.get(first, 0) and
+                        counts.get(first + 2, 0) >= 2 * counts.get(first + 1, 0)):
+                    alert_year, alert_week = weeks[i + first + 2]
+                    uuids = connection.execute(
+                        text("SELECT uuid FROM data WHERE clinic = :clinic "
+                             "AND variables ? :var_id AND epi_year = :epi_year "
+                             "AND epi_week = :epi_week"),
+                        clinic=clinic, var_id=var_id, epi_year=alert_year,
+                        epi_week=alert_week).fetchall()
+                    alerts.append({
+                        "clinic": clinic,
+                        "reason": var_id,
+                        "duration": 7,
+                        "uuids": [row[0] for row in uuids],
+                        "type": "threshold"
+                    })
+    finally:
+        connection.close()
+    return alerts
@@ -1,8 +1,8 @@
-from dateutil.parser import parse
 from sqlalchemy import and_
 from sqlalchemy.exc import OperationalError
 from meerkat_abacus.pipeline_worker.process_steps import ProcessingStep
 from meerkat_abacus import model, util
+from meerkat_abacus.util.datetime_helper import parse
 from meerkat_abacus import logger
 
 
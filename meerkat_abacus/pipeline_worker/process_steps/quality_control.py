@@ -2,16 +2,18 @@
 Main functionality for importing data into abacus
 """
 
-from dateutil.parser import parse
 import random
 from meerkat_abacus import util, logger
 from meerkat_abacus.util import data_types
+from meerkat_abacus.util.datetime_helper import parse
 from meerkat_abacus.pipeline_worker.process_steps import ProcessingStep
 from meerkat_abacus.util.epi_week import epi_week_for_date
 from meerkat_abacus.codes import to_codes
 
 
 class QualityControl(ProcessingStep):
+    cpu_only = True
+
     def __init__(self, param_config, session):
         """ Prepare arguments for quality_control
 
@@ -45,9 +47,7 @@ class QualityControl(ProcessingStep):
             quality_control_list = []
             if "quality_control" in param_config.country_config:
                 if form in param_config.country_config["quality_control"]:
-                    (variables, variable_forms, variable_tests,
-                     variables_group, variables_match) = to_codes.get_variables(session,
-                                                                                "import")
+                    variables = to_codes.get_variables(session, "import")[0]
                     if variables:
                         quality_control_list = [variables["import"][x][x]
                                     for x in variables["import"].keys() if variables["import"][x][x].variable.form == form]
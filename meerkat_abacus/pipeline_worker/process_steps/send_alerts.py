@@ -4,13 +4,15 @@ from meerkat_abacus import util
 
 class SendAlerts(ProcessingStep):
 
-    def __init__(self, param_config, session):
+    def __init__(self, param_config, session, location_tree=None):
         self.step_name = "send_alerts"
         alerts = session.query(model.AggregationVariables).filter(
             model.AggregationVariables.alert == 1)
 
         self.alert_variables = {a.id: a for a in alerts}
-        self.locations = util.all_location_data(session)[0]
+        if location_tree is None:
+            location_tree = util.get_location_tree(session)
+        self.locations = location_tree.locations
         self.config = param_config
         self.session = session
 
@@ -1,34 +1,52 @@
-from dateutil.parser import parse
 from datetime import datetime
 import copy
 
 from meerkat_abacus.pipeline_worker.process_steps import ProcessingStep
 from meerkat_abacus import util
 from meerkat_abacus.codes import to_codes
+from meerkat_abacus.codes.geometry import DistrictIndex
 from meerkat_abacus.util import data_types
+from meerkat_abacus.util.datetime_helper import parse
 from meerkat_abacus import logger
 
 
 class ToCodes(ProcessingStep):
+    cpu_only = True
 
-    def __init__(self, param_config, session):
+    def __init__(self, param_config, session, location_tree=None):
         self.step_name = "to_codes"
         self.config = param_config
         self.links_by_type, self.links_by_name = util.get_links(
             param_config.config_directory +
             param_config.country_config["links_file"])
-        self.locations = util.all_location_data(session)
+        if location_tree is None:
+            location_tree = util.get_location_tree(session)
+        self.location_tree = location_tree
+        self.locations = self.location_tree.location_data()
+        self.district_index = DistrictIndex(self.locations[0])
         self.data_types = {d["name"]: d for d in
                            data_types.data_types(param_config=self.config)}
         self.variables = {}
+        self.plans = {}
         for type_name, data_type in self.data_types.items():
             self.variables[type_name] = to_codes.get_variables(session,
                                                                match_on_form=data_type["type"])
+            self.plans[type_name] = to_codes.compile_variables(self.variables[type_name],
+                                                               data_type["type"])
         self.session = session
         self.alert_id_length = self.config.country_config["alert_id_length"]
 
+    def run_batch(self, records):
+        """
+        Looks up the districts for all the records located by gps
+        coordinates in one call and then codes the records one by one
+        """
+        self.district_index.preload(self._get_coordinates(records))
+        try:
+            return self.run_each(records)
+        finally:
+            self.district_index.clear_preloaded()
 
-        
     def run(self, form, data):
         return_rows = []
         data_type = self.data_types[data["type"]]
@@ -46,7 +64,10 @@ class ToCodes(ProcessingStep):
                 data_type["type"],
                 self.config.country_config["alert_data"],
                 set(linked_forms),
-                data_type["location"]
+                data_type["location"],
+                plan=self.plans[data_type["name"]],
+                district_index=self.district_index,
+                location_tree=self.location_tree
             )
             if location_data is None:
                 logger.warning("Missing loc data")
@@ -75,6 +96,24 @@ class ToCodes(ProcessingStep):
                                 "data": new_data})
         return return_rows
 
+    def _get_coordinates(self, records):
+        """
+        Returns the (lon, lat) of the records with in_geometry location
+        """
+        coordinates = []
+        for record in records:
+            data = record["data"]
+            data_type = self.data_types.get(data.get("type"))
+            if not data_type or "in_geometry" not in data_type["location"]:
+                continue
+            fields = data_type["location"].split("$")[1].split(",")
+            try:
+                coordinates.append((float(data["raw_data"][fields[0]]),
+                                    float(data["raw_data"][fields[1]])))
+            except (KeyError, TypeError, ValueError):
+                continue
+        return coordinates
+
     def _set_alert_id(self, uuid, variables_data):
         """
         Adds an alert id
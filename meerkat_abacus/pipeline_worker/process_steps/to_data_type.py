@@ -4,6 +4,7 @@ from meerkat_abacus.util import data_types
 
 
 class ToDataType(ProcessingStep):
+    cpu_only = True
 
     def __init__(self, param_config, session):
         self.step_name = "to_data_type"
@@ -11,39 +12,99 @@ class ToDataType(ProcessingStep):
         self.links_by_type, self.links_by_name = util.get_links(
             param_config.config_directory +
             param_config.country_config["links_file"])
+        self.routes = get_routes(
+            data_types.data_types(param_config=self.config),
+            self.links_by_type)
+        self.condition_columns = {
+            form: tuple(sorted({column for name, column, condition, link_name
+                                in routes if link_name is None and column}))
+            for form, routes in self.routes.items()}
         self.session = session
-        
+
     def run(self, form, data):
         """
+        Creates one data record for each data type the form record belongs
+        to, either as the main form or as a linked form.
+        """
+        return make_records(form, data, self._matching_routes(form, data))
+
+    def run_batch(self, records):
+        """
+        Partitions the chunk by form and by the values of the condition
+        columns, so the matching data types are worked out once for each
+        partition instead of once per record.
         """
-        return_data = []
-        # from nose.tools import set_trace; set_trace()
-        for data_type in data_types.data_types(param_config=self.config):
-            main_form = data_type["form"]
-            additional_forms = {}
-            for link in self.links_by_type.get(data_type["name"], []):
-                additional_forms[link["to_form"]] = link["name"]
-            d = {"type": data_type["name"],
-                 "original_form": form}
-            if form == main_form:
-                if check_data_type_condition(data_type, data):
-                    d["raw_data"] = data
-                else:
-                    continue
-            elif form in additional_forms.keys():
-                d["link_data"] = {additional_forms[form]: [data]}
-            else:
+        matches = {}
+        results = []
+        for record in records:
+            form, data = record["form"], record["data"]
+            try:
+                key = self._partition_key(form, data)
+                if key not in matches:
+                    matches[key] = self._matching_routes(form, data)
+                results.append(make_records(form, data, matches[key]))
+            except Exception as exception:
+                results.append(exception)
+        return results
+
+    def _partition_key(self, form, data):
+        if not data:
+            return (form, None)
+        return (form, tuple(map(data.get,
+                                self.condition_columns.get(form, ()))))
+
+    def _matching_routes(self, form, data):
+        matched = []
+        for route in self.routes.get(form, []):
+            type_name, column, condition, link_name = route
+            if (link_name is None and column and data and
+                    data.get(column) != condition):
                 continue
-            return_data.append({"form": "data",
-                                "data": d})
-
-        return return_data
-
-    
-def check_data_type_condition(data_type, data):
-    if data_type["db_column"] and data:
-        if data.get(data_type["db_column"]) == data_type["condition"]:
-            return True
-    else:
-        return True
-    return False
+            matched.append(route)
+        return matched
+
+
+def get_routes(data_types, links_by_type):
+    """
+    Returns a routing table from form name to the data types a record
+    of the form can belong to
+
+    Each route is a tuple (type name, db_column, condition, link name).
+    Routes for the main form of a data type have link name None, routes
+    for a linked form have the name of the link and no condition. The
+    routes for each form are in the order of the data types.
+
+    Args:
+        data_types: list of data types
+        links_by_type: dict of data type name: links
+    Returns:
+        routes(dict): form name: list of routes
+    """
+    routes = {}
+    for data_type in data_types:
+        additional_forms = {}
+        for link in links_by_type.get(data_type["name"], []):
+            additional_forms[link["to_form"]] = link["name"]
+        main_form = data_type["form"]
+        routes.setdefault(main_form, []).append(
+            (data_type["name"], data_type["db_column"],
+             data_type["condition"], None))
+        for form, link_name in additional_forms.items():
+            if form != main_form:
+                routes.setdefault(form, []).append(
+                    (data_type["name"], None, None, link_name))
+    return routes
+
+
+def make_records(form, data, routes):
+    return_data = []
+    for type_name, column, condition, link_name in routes:
+        d = {"type": type_name,
+             "original_form": form}
+        if link_name is None:
+            d["raw_data"] = data
+        else:
+            d["link_data"] = {link_name: [data]}
+        return_data.append({"form": "data",
+                            "data": d})
+    return return_data
@@ -1,5 +1,21 @@
+import io
+import itertools
+import json
+
+from geoalchemy2 import Geometry
+from sqlalchemy import ARRAY, DateTime, JSON, MetaData
+from sqlalchemy.sql import text
+
 from meerkat_abacus.pipeline_worker.process_steps import ProcessingStep
+from meerkat_abacus.pipeline_worker.alert_weekly_counts import (
+    double_alert_variables, remove_counts, add_counts)
 from meerkat_abacus import model
+from meerkat_abacus import logger
+
+# Numbers for the names of the upsert staging tables
+_staging_ids = itertools.count()
+# (db url, table name) of the tables we have found the unique index on
+_checked_indexes = set()
 
 
 class WriteToDb(ProcessingStep):
@@ -19,10 +35,24 @@ class WriteToDb(ProcessingStep):
         }
         config["form_to_table"].update(model.form_tables(param_config))
         config["raw_data_forms"] = param_config.country_config["tables"]
+        config["writer"] = param_config.db_writer
+        config["write_mode"] = param_config.db_write_mode
+        # Where to remove a record from when it is upserted into a table
+        config["move_from"] = {
+            model.Data: model.DisregardedData,
+            model.DisregardedData: model.Data
+        }
         self.config = config
         self.session = session
+        # Variables we keep the alert_weekly_counts of
+        self.count_variables = []
+        if param_config.alert_weekly_counts:
+            self.count_variables = double_alert_variables(session)
         self.data_to_write = {}
         self.data_to_delete = {}
+        self.data_positions = {}
+        # Number of chunks that were written with INSERT as COPY failed
+        self.copy_fallbacks = 0
 
     @property
     def engine(self):
@@ -35,22 +65,106 @@ class WriteToDb(ProcessingStep):
 
     def _update_engine(self):
         self.config['engine'] = self._engine
+
     def end_step(self, n):
         conn = self.config["engine"].connect()
-        for table in self.data_to_delete.keys():
-            for condition, uuids in self.data_to_delete[table].items():
-                conn.execute(table.__table__.delete().where(
-                    table.__table__.c.uuid.in_(uuids)).where(
-                        getattr(
-                            table.__table__.c, self.config["delete"][table]) ==
-                        condition))
-
-        for table in self.data_to_write.keys():
-            conn.execute(table.__table__.insert(), self.data_to_write[table])
+        copy = self.config["writer"] == "copy"
+        try:
+            self._write_chunk(conn, copy=copy)
+        except Exception:
+            if not copy:
+                raise
+            self.copy_fallbacks += 1
+            logger.warning(
+                f"Writing with COPY failed, using INSERT "
+                f"({self.copy_fallbacks} times so far)", exc_info=True)
+            self._write_chunk(conn)
+        finally:
+            conn.close()
         self.data_to_write = {}
         self.data_to_delete = {}
+        self.data_positions = {}
 
         super(WriteToDb, self).end_step(n)
+
+    def _write_chunk(self, conn, copy=False):
+        """
+        Writes the chunk, in one transaction if we use COPY, upserts or
+        keep the alert_weekly_counts
+
+        If the pipeline already runs the chunk in a transaction we use a
+        savepoint so a failed COPY does not roll back the whole chunk.
+        """
+        if (copy or self.config["write_mode"] == "upsert" or
+                self.count_variables):
+            if conn.in_transaction():
+                transaction = conn.begin_nested()
+            else:
+                transaction = conn.begin()
+            with transaction:
+                self._write(conn, copy=copy)
+        else:
+            self._write(conn)
+
+    def _write(self, conn, copy=False):
+        """
+        Writes the new records and replaces the existing ones
+
+        In the default "delete_insert" mode we delete the records that
+        are replaced and then insert all the records. In "upsert" mode
+        the data and disregardedData records are upserted instead.
+
+        The data records that are replaced are subtracted from the
+        alert_weekly_counts before they are written, and the new data
+        records are added after.
+
+        Args:
+            conn: db connection
+            copy: write with COPY instead of INSERT
+        """
+        upsert = self.config["write_mode"] == "upsert"
+        if self.count_variables:
+            remove_counts(conn, self.count_variables,
+                          self._replaced_data_records(upsert))
+        if not upsert:
+            for table in self.data_to_delete.keys():
+                for condition, uuids in self.data_to_delete[table].items():
+                    conn.execute(table.__table__.delete().where(
+                        table.__table__.c.uuid.in_(uuids)).where(
+                            getattr(
+                                table.__table__.c, self.config["delete"][table]) ==
+                            condition))
+
+        for table in self.data_to_write.keys():
+            if upsert and table in self.data_to_delete:
+                upsert_rows(conn, table.__table__, self.data_to_write[table],
+                            self.config["move_from"][table].__table__,
+                            copy=copy)
+            elif copy:
+                copy_rows(conn, table.__table__, self.data_to_write[table])
+            else:
+                conn.execute(table.__table__.insert(),
+                             self.data_to_write[table])
+        if self.count_variables:
+            add_counts(conn, self.count_variables,
+                       self.data_to_write.get(model.Data, []))
+
+    def _replaced_data_records(self, upsert):
+        """
+        Returns a dict of type: uuids of the data records that will be
+        deleted or replaced by the chunk
+
+        When upserting, records written to disregardedData are also
+        moved out of data.
+        """
+        tables = [model.Data]
+        if upsert:
+            tables.append(model.DisregardedData)
+        records = {}
+        for table in tables:
+            for condition, uuids in self.data_to_delete.get(table, {}).items():
+                records.setdefault(condition, []).extend(uuids)
+        return records
         
     def run(self, form, data):
         """
@@ -64,6 +178,7 @@ class WriteToDb(ProcessingStep):
         else:
             insert_data = data
             
+        key = None
         if form in self.config["delete"]:
             uuid = data["uuid"]
             other_condition = data[self.config["delete"][form]]
@@ -71,12 +186,19 @@ class WriteToDb(ProcessingStep):
             self.data_to_delete.setdefault(table, {})
             self.data_to_delete[table].setdefault(other_condition, [])
             self.data_to_delete[table][other_condition].append(uuid)
+            key = (table, uuid, other_condition)
             
         if data:
             if "id" in data:
                 del data["id"]
             self.data_to_write.setdefault(table, [])
-            self.data_to_write[table].append(insert_data)
+            if key in self.data_positions:
+                # Only keep the last version of a record in a chunk
+                self.data_to_write[table][self.data_positions[key]] = insert_data
+            else:
+                if key is not None:
+                    self.data_positions[key] = len(self.data_to_write[table])
+                self.data_to_write[table].append(insert_data)
         return [{"form": form,
                  "data": data}]
 
@@ -88,3 +210,179 @@ def get_uuid(data, form, config):
         uuid_field = config["country_config"]["tables_uuid"].get(form, uuid_field)
     return data[uuid_field]
 
+
+def copy_rows(conn, table, rows):
+    """
+    Writes rows to table with COPY FROM STDIN in CSV format
+
+    This is much faster than an INSERT with many rows for large
+    numbers of rows. Rows are copied in groups with the same columns,
+    so a column that is missing from a row gets its default value as
+    with INSERT. A JSON value of None is written as JSON null, like
+    INSERT does, and not as NULL.
+
+    Args:
+        conn: SQLAlchemy connection
+        table: SQLAlchemy Table
+        rows: list of dicts of column name: value
+    """
+    if not rows:
+        return
+    groups = {}
+    for row in rows:
+        groups.setdefault(frozenset(row.keys()), []).append(row)
+    names = set().union(*groups.keys())
+    unknown = names - set(table.columns.keys())
+    if unknown:
+        raise ValueError(f"Unknown columns {sorted(unknown)} for {table.name}")
+    for names, group in groups.items():
+        _copy_group(conn, table, names, group)
+
+
+def _copy_group(conn, table, names, rows):
+    columns = [c for c in table.columns if c.name in names]
+    converters = [(c.name, _copy_converter(c.type), isinstance(c.type, JSON))
+                  for c in columns]
+
+    buffer = io.StringIO()
+    for row in rows:
+        values = []
+        for name, converter, is_json in converters:
+            value = row[name]
+            if value is None and not is_json:
+                # An unquoted empty value is NULL in CSV format
+                values.append("")
+            else:
+                values.append('"' + converter(value).replace('"', '""') + '"')
+        buffer.write(",".join(values))
+        buffer.write("\n")
+    buffer.seek(0)
+
+    quote = conn.dialect.identifier_preparer.quote
+    statement = "COPY {} ({}) FROM STDIN WITH (FORMAT csv)".format(
+        quote(table.name), ", ".join(quote(c.name) for c in columns))
+    cursor = conn.connection.cursor()
+    try:
+        cursor.copy_expert(statement, buffer)
+    finally:
+        cursor.close()
+
+
+def upsert_rows(conn, table, rows, move_from=None, copy=False):
+    """
+    Inserts rows into table and updates the existing rows with the same
+    uuid and type.
+
+    The rows are loaded into a temporary staging table and then written
+    with a single INSERT ... ON CONFLICT (uuid, type) DO UPDATE. The rows
+    must not have the same record twice, WriteToDb only keeps the last
+    version of a record in a chunk. Must be called in a transaction, the
+    staging table is dropped at commit. Each call gets its own staging
+    table, as the pipeline can write more than once in a chunk
+    transaction.
+
+    Args:
+        conn: SQLAlchemy connection in a transaction
+        table: SQLAlchemy Table with a unique index on (uuid, type)
+        rows: list of dicts of column name: value
+        move_from: table to delete the upserted records from, used to move
+                   records between data and disregarded_data
+        copy: load the staging table with COPY instead of INSERT
+    """
+    if not rows:
+        return
+    check_unique_index(conn, table)
+    quote = conn.dialect.identifier_preparer.quote
+    staging = table.tometadata(
+        MetaData(), name="staging_{}_{}".format(table.name, next(_staging_ids)))
+    conn.execute(
+        "CREATE TEMP TABLE {} (LIKE {} INCLUDING DEFAULTS) ON COMMIT DROP".format(
+            quote(staging.name), quote(table.name)))
+    if copy:
+        copy_rows(conn, staging, rows)
+    else:
+        conn.execute(staging.insert(), rows)
+
+    names = set()
+    for row in rows:
+        names.update(row.keys())
+    columns = [quote(c.name) for c in table.columns if c.name in names]
+    updates = ["{0} = EXCLUDED.{0}".format(c) for c in columns
+               if c not in ("uuid", "type")]
+    if updates:
+        on_conflict = "DO UPDATE SET " + ", ".join(updates)
+    else:
+        on_conflict = "DO NOTHING"
+    conn.execute(
+        "INSERT INTO {table} ({columns}) "
+        "SELECT {columns} FROM {staging} "
+        "ON CONFLICT (uuid, type) {on_conflict}".format(
+            table=quote(table.name), columns=", ".join(columns),
+            staging=quote(staging.name), on_conflict=on_conflict))
+    if move_from is not None:
+        conn.execute(
+            "DELETE FROM {0} USING {1} WHERE {0}.uuid = {1}.uuid "
+            "AND {0}.type = {1}.type".format(quote(move_from.name),
+                                             quote(staging.name)))
+
+
+def check_unique_index(conn, table):
+    """
+    Raises a RuntimeError if the unique index on (uuid, type) of table
+    is missing in the db
+
+    The index is in the model, but create_all does not add indexes to
+    tables that already exist. database_setup.add_unique_indexes creates
+    them for those dbs when UNIQUE_INDEX_MIGRATION is set.
+    """
+    key = (str(conn.engine.url), table.name)
+    if key in _checked_indexes:
+        return
+    index = model.unique_index(table)
+    found = index is not None and conn.execute(
+        text("SELECT 1 FROM pg_indexes WHERE tablename = :table "
+             "AND indexname = :index"),
+        table=table.name, index=index.name).scalar()
+    if not found:
+        raise RuntimeError(
+            f"{table.name} has no unique index on (uuid, type), set "
+            "UNIQUE_INDEX_MIGRATION=True and run the database setup to "
+            "create it")
+    _checked_indexes.add(key)
+
+
+def _copy_converter(column_type):
+    """
+    Returns a function that turns a value into text that postgres
+    can read for a column of column_type
+    """
+    if isinstance(column_type, JSON):
+        return lambda value: json.dumps(value, default=_json_default)
+    if isinstance(column_type, ARRAY):
+        return _array_literal
+    if isinstance(column_type, DateTime):
+        return lambda value: value.isoformat() if hasattr(value, "isoformat") else str(value)
+    if isinstance(column_type, Geometry):
+        # WKBElements or hex encoded (E)WKB strings as in the Data rows
+        return lambda value: value.desc if hasattr(value, "desc") else str(value)
+    return str
+
+
+def _json_default(value):
+    """
+    Writes the dates in JSON values as ISO 8601 text
+    """
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _array_literal(values):
+    elements = []
+    for value in values:
+        if value is None:
+            elements.append("NULL")
+        else:
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+            elements.append('"' + value + '"')
+    return "{" + ",".join(elements) + "}"
@@ -1,16 +1,46 @@
 import cProfile
 
 
+from celery.signals import (worker_process_init, worker_process_shutdown,
+                            worker_shutdown)
 from sqlalchemy.orm import sessionmaker, scoped_session
-from sqlalchemy import create_engine
+from meerkat_abacus.pipeline_worker.connections import ConnectionManager
 from meerkat_abacus.pipeline_worker.pipeline import Pipeline
 
 from meerkat_abacus.config import config as config_
 from meerkat_abacus.pipeline_worker.celery_app import app
+from meerkat_abacus.util import spool
 from meerkat_abacus import logger
 
 
 pipeline = None
+connections = ConnectionManager(config_.DATABASE_URL,
+                                pool_size=config_.db_pool_size,
+                                max_overflow=config_.db_max_overflow,
+                                pool_recycle=config_.db_pool_recycle,
+                                pool_timeout=config_.db_pool_timeout)
+
+
+@worker_process_init.connect
+def reset_worker(**kwargs):
+    """
+    Gives each forked celery worker process its own connection pool
+    """
+    global pipeline
+    connections.reset()
+    pipeline = None
+
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def close_pipeline(**kwargs):
+    """
+    Stops the forked processes of the pipeline when the celery worker
+    process stops. worker_shutdown covers the solo pool, which runs the
+    tasks in the main process.
+    """
+    if pipeline is not None:
+        pipeline.close()
 
 
 def configure_worker():
@@ -18,7 +48,7 @@ def configure_worker():
     # db_uri = conf['db_uri']
     global engine
     logger.info("Worker setup")
-    engine = create_engine(config_.DATABASE_URL)#, pool_pre_ping=True)
+    engine = connections.engine
 
     global session
     session = scoped_session(sessionmaker(autocommit=False,
@@ -31,12 +61,31 @@ def configure_worker():
 
 @app.task(bind=True, name="processing_tasks.process_data")
 def process_data(self, data_rows):
+    """
+    Runs a chunk through the pipeline
+
+    data_rows is either the list of records or a reference to a chunk in
+    the spool. The chunk is not retried, so the file is removed once the
+    chunk is processed or has failed.
+    """
     if pipeline is None:
         configure_worker()
     logger.info("STARTING task")
-    engine.dispose()
-    pipeline.process_chunk(data_rows)
-    logger.info("ENDING task")
+    reference = None
+    if spool.is_reference(data_rows):
+        reference = data_rows
+    try:
+        if reference is not None:
+            data_rows = spool.read_chunk(reference, config_.spool_directory)
+        with connections.connect() as connection:
+            pipeline.process_chunk(data_rows, connection=connection)
+    except Exception:
+        logger.exception("Processing the chunk failed", exc_info=True)
+        raise
+    finally:
+        if reference is not None:
+            spool.remove_chunk(reference, config_.spool_directory)
+    logger.info(f"ENDING task, db connections: {connections.metrics()}")
 
 
 @app.task(name="processing_tasks.test_up")
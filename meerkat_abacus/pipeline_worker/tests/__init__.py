@@ -10,6 +10,7 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from meerkat_abacus import model
 from meerkat_abacus.pipeline_worker.pipeline import Pipeline
+from meerkat_abacus.pipeline_worker.process_steps import DoNothing
 from meerkat_abacus.consumer.database_setup import create_db
 from meerkat_abacus.config import config as param_config
 
@@ -75,6 +76,224 @@ class TestPipeline(unittest.TestCase):
         self.assertEqual(results[0].form, "test-form")
         self.assertEqual(results[0].error, "KeyError: 'Test Error'")
 
-            
+    @mock.patch.object(Pipeline, "handle_exception")
+    def test_process_chunk_batch(self, handle_exception_mock):
+        param_config.country_config["pipeline"] = ["do_nothing"]
+        engine = mock.MagicMock()
+        session = mock.MagicMock()
+        pipeline = Pipeline(engine, session, param_config)
+        step = BatchDoNothing(session)
+        pipeline.pipeline = [step, step]
+
+        data = []
+        for i in range(10):
+            data.append({"form": "test-form",
+                         "data": {"some-data": i}})
+        after_data = pipeline.process_chunk(data)
+        self.assertEqual(step.n_batches, 2)
+        self.assertEqual([d["data"]["some-data"] for d in after_data],
+                         [0, 2, 4, 6, 8])
+        # Odd records fail in the first step
+        self.assertEqual(handle_exception_mock.call_count, 5)
+        failed_record, exception, failed_step = handle_exception_mock.call_args[0]
+        self.assertEqual(failed_record["data"]["some-data"], 9)
+        self.assertIsInstance(exception, KeyError)
+
+    @mock.patch("meerkat_abacus.pipeline_worker.pipeline.event")
+    @mock.patch("meerkat_abacus.pipeline_worker.pipeline.Session")
+    def test_process_chunk_transaction(self, session_mock, event_mock):
+        param_config.country_config["pipeline"] = ["do_nothing"]
+        engine = mock.MagicMock()
+        session = mock.MagicMock()
+        pipeline = Pipeline(engine, session, param_config)
+        step = BatchDoNothing(session)
+        pipeline.pipeline = [step]
+        data = [{"form": "test-form", "data": {"some-data": i}}
+                for i in range(4)]
+        param_config.chunk_transaction = True
+        try:
+            after_data = pipeline.process_chunk(data)
+        finally:
+            param_config.chunk_transaction = False
+        self.assertEqual(len(after_data), 2)
+
+        # Failures and monitoring are written in the chunk transaction
+        chunk_session = session_mock.return_value
+        session.add.assert_not_called()
+        session.commit.assert_not_called()
+        written = chunk_session.add_all.call_args[0][0]
+        self.assertEqual([type(w) for w in written],
+                         [model.StepFailiure, model.StepFailiure,
+                          model.StepMonitoring])
+        engine.connect.return_value.begin.return_value.commit.assert_called_once_with()
+        self.assertIs(step.session, session)
+        self.assertIs(pipeline.session, session)
+        self.assertIsNone(step.monitoring_buffer)
+
+        # The steps' caches are rolled back with a failed chunk
+        chunk_session.commit.side_effect = ValueError("Commit failed")
+        param_config.chunk_transaction = True
+        try:
+            with mock.patch.object(step, "rollback_transaction") as rollback, \
+                    mock.patch.object(step, "commit_transaction") as commit:
+                with self.assertRaises(ValueError):
+                    pipeline.process_chunk(data)
+        finally:
+            param_config.chunk_transaction = False
+        rollback.assert_called_once_with()
+        commit.assert_not_called()
+        engine.connect.return_value.begin.return_value.rollback.assert_called_once_with()
+
+    @mock.patch("meerkat_abacus.pipeline_worker.pipeline.Session")
+    def test_process_chunk_streaming(self, session_mock):
+        param_config.country_config["pipeline"] = ["do_nothing"]
+        engine = mock.MagicMock()
+        session = mock.MagicMock()
+        pipeline = Pipeline(engine, session, param_config)
+        first_step = BatchDoNothing(session)
+        last_step = DoNothing(session)
+        pipeline.pipeline = [first_step, last_step]
+        data = [{"form": "test-form", "data": {"some-data": i}}
+                for i in range(250)]
+        param_config.streaming_pipeline = True
+        param_config.stream_batch_size = 20
+        try:
+            after_data = pipeline.process_chunk(data)
+        finally:
+            param_config.streaming_pipeline = False
+        self.assertEqual([d["data"]["some-data"] for d in after_data],
+                         list(range(0, 250, 2)))
+        self.assertEqual(first_step.n_batches, 13)
+        self.assertEqual(first_step.n_chunks, 1)
+
+        # Failures and monitoring are written with the sessions of the stages
+        session.add.assert_not_called()
+        stage_session = session_mock.return_value
+        failures = [c[0][0] for c in stage_session.add.call_args_list
+                    if isinstance(c[0][0], model.StepFailiure)]
+        self.assertEqual(len(failures), 125)
+        self.assertIs(first_step.session, session)
+        self.assertEqual([d["step"] for d in pipeline.queue_depths],
+                         ["do_nothing", "do_nothing"])
+        self.assertGreaterEqual(pipeline.queue_depths[0]["max"], 1)
+
+    @mock.patch("meerkat_abacus.pipeline_worker.pipeline.Session")
+    def test_process_chunk_streaming_error(self, session_mock):
+        param_config.country_config["pipeline"] = ["do_nothing"]
+        session = mock.MagicMock()
+        pipeline = Pipeline(mock.MagicMock(), session, param_config)
+        failing_step = DoNothing(session)
+        failing_step.end_step = mock.MagicMock(side_effect=ValueError("Flush"))
+        pipeline.pipeline = [DoNothing(session), failing_step,
+                             DoNothing(session)]
+        data = [{"form": "test-form", "data": {"some-data": i}}
+                for i in range(100)]
+        param_config.streaming_pipeline = True
+        param_config.stream_batch_size = 5
+        try:
+            with self.assertRaises(ValueError):
+                pipeline.process_chunk(data)
+        finally:
+            param_config.streaming_pipeline = False
+        self.assertIs(failing_step.session, session)
+
+        # A step that fails at the end of the chunk fails the chunk
+        failing_step = DoNothing(session)
+        failing_step.end_chunk = mock.MagicMock(side_effect=ValueError("End"))
+        pipeline.pipeline = [DoNothing(session), failing_step,
+                             DoNothing(session)]
+        param_config.streaming_pipeline = True
+        try:
+            with self.assertRaises(ValueError):
+                pipeline.process_chunk(data)
+        finally:
+            param_config.streaming_pipeline = False
+
+    def test_process_chunk_connection(self):
+        param_config.country_config["pipeline"] = ["do_nothing"]
+        engine = mock.MagicMock()
+        connection = mock.MagicMock()
+        pipeline = Pipeline(engine, mock.MagicMock(), param_config)
+        step = EngineDoNothing(pipeline.session)
+        step.engine = engine
+        pipeline.pipeline = [DoNothing(pipeline.session), step]
+        data = [{"form": "test-form", "data": {"some-data": i}}
+                for i in range(3)]
+        after_data = pipeline.process_chunk(data, connection=connection)
+        self.assertEqual(len(after_data), 3)
+        self.assertEqual(step.engines, [connection] * 3)
+        self.assertIs(step.engine, engine)
+        engine.connect.assert_not_called()
+
+    def test_process_chunk_parallel(self):
+        param_config.country_config["pipeline"] = ["do_nothing"]
+        data = [{"form": "test-form", "data": {"some-data": i}}
+                for i in range(101)]
+        results = []
+        for workers in [0, 3]:
+            session = mock.MagicMock()
+            pipeline = Pipeline(mock.MagicMock(), session, param_config)
+            pipeline.pipeline = [DoNothing(session), BatchDoNothing(session),
+                                 DoNothing(session)]
+            if workers:
+                pipeline._start_pool(workers)
+                self.assertIsNotNone(pipeline.pool)
+            try:
+                after_data = pipeline.process_chunk(list(data))
+            finally:
+                pipeline.close()
+            failures = [c[0][0] for c in session.add.call_args_list
+                        if isinstance(c[0][0], model.StepFailiure)]
+            results.append(([d["data"]["some-data"] for d in after_data],
+                            [(f.step_name, f.error) for f in failures]))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[1][0], list(range(0, 101, 2)))
+        self.assertEqual(len(results[1][1]), 50)
+
+    def test_parallel_workers(self):
+        param_config.country_config["pipeline"] = ["do_nothing"]
+        param_config.parallel_workers = 2
+        try:
+            # The pool is only started when a chunk needs it
+            pipeline = Pipeline(mock.MagicMock(), mock.MagicMock(),
+                                param_config)
+            self.assertIsNone(pipeline.pool)
+            with mock.patch("multiprocessing.current_process") as process:
+                process.return_value.daemon = True
+                with self.assertRaises(ValueError):
+                    Pipeline(mock.MagicMock(), mock.MagicMock(), param_config)
+        finally:
+            param_config.parallel_workers = 0
+
+
+class BatchDoNothing(DoNothing):
+    """ Batch version of DoNothing that fails for odd records """
+    n_batches = 0
+    n_chunks = 0
+
+    def start_chunk(self):
+        self.n_chunks += 1
+
+    def run(self, form, data):
+        if data["some-data"] % 2 == 1:
+            raise KeyError("Test Error")
+        return super().run(form, data)
+
+    def run_batch(self, records):
+        self.n_batches += 1
+        return self.run_each(records)
+
+
+class EngineDoNothing(DoNothing):
+    """ DoNothing that records the engine it runs with """
+    def __init__(self, session):
+        super().__init__(session)
+        self.engines = []
+
+    def run(self, form, data):
+        self.engines.append(self.engine)
+        return super().run(form, data)
+
+
 if __name__ == "__main__":
     unittest.main()
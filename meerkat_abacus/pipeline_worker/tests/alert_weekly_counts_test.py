@@ -0,0 +1,87 @@
+import unittest
+from unittest import mock
+
+from sqlalchemy.dialects import postgresql
+
+from meerkat_abacus.config import config
+from meerkat_abacus.pipeline_worker import alert_weekly_counts
+from meerkat_abacus.pipeline_worker.process_steps.write_to_db import WriteToDb
+from meerkat_abacus.util.epi_week import EpiWeekCalendar
+
+
+class AlertWeeklyCountsTest(unittest.TestCase):
+    """
+    Test the maintenance of the alert_weekly_counts table
+    """
+
+    def test_neighbour_weeks(self):
+        calendar = EpiWeekCalendar("day:0")
+        self.assertEqual(
+            alert_weekly_counts.neighbour_weeks(calendar, 2017, 10),
+            [(2017, 8), (2017, 9), (2017, 10), (2017, 11), (2017, 12)])
+        # Epi year 2018 has 53 weeks
+        self.assertEqual(
+            alert_weekly_counts.neighbour_weeks(calendar, 2018, 52),
+            [(2018, 50), (2018, 51), (2018, 52), (2018, 53), (2019, 1)])
+        self.assertEqual(
+            alert_weekly_counts.neighbour_weeks(calendar, 2019, 1),
+            [(2018, 52), (2018, 53), (2019, 1), (2019, 2), (2019, 3)])
+
+        calendar = EpiWeekCalendar("day:0", "include_in_1")
+        self.assertEqual(
+            alert_weekly_counts.neighbour_weeks(calendar, 2018, 52),
+            [(2018, 50), (2018, 51), (2018, 52), (2019, 1), (2019, 2)])
+
+    def test_add_counts(self):
+        conn = mock.MagicMock()
+        rows = [{"uuid": "a", "clinic": 1, "epi_year": 2017, "epi_week": 3,
+                 "variables": {"cmd_1": 1, "tot_1": 1}},
+                {"uuid": "b", "clinic": 1, "epi_year": 2017, "epi_week": 3,
+                 "variables": {"cmd_1": 1}},
+                {"uuid": "c", "clinic": 2, "epi_year": 2017, "epi_week": 3,
+                 "variables": {"cmd_1": 1, "cmd_2": 1}},
+                {"uuid": "d", "clinic": None, "epi_year": 2017, "epi_week": 3,
+                 "variables": {"cmd_1": 1}},
+                {"uuid": "e", "clinic": 1, "epi_year": 2017, "epi_week": 3,
+                 "variables": {"tot_1": 1}}]
+        alert_weekly_counts.add_counts(conn, ["cmd_1", "cmd_2"], rows)
+        statement = conn.execute.call_args[0][0]
+        compiled = statement.compile(dialect=postgresql.dialect())
+        self.assertIn("ON CONFLICT (variable, clinic, epi_year, epi_week) "
+                      "DO UPDATE SET count = (alert_weekly_counts.count + "
+                      "excluded.count)", str(compiled))
+        params = compiled.params
+        values = [(params[f"variable_m{i}"], params[f"clinic_m{i}"],
+                   params[f"count_m{i}"]) for i in range(3)]
+        self.assertEqual(values, [("cmd_1", 1, 2), ("cmd_1", 2, 1),
+                                  ("cmd_2", 2, 1)])
+
+        conn = mock.MagicMock()
+        alert_weekly_counts.add_counts(conn, ["cmd_1"], rows[3:])
+        conn.execute.assert_not_called()
+
+    def test_write_to_db(self):
+        with mock.patch(
+                "meerkat_abacus.pipeline_worker.process_steps.write_to_db."
+                "double_alert_variables", return_value=["cmd_1"]), \
+                mock.patch.object(config, "alert_weekly_counts", True):
+            step = WriteToDb(config, mock.MagicMock())
+        step.run("data", {"uuid": "a", "type": "case", "clinic": 1,
+                          "epi_year": 2017, "epi_week": 3,
+                          "variables": {"cmd_1": 1}})
+        step.run("disregardedData", {"uuid": "b", "type": "case",
+                                     "variables": {"cmd_1": 1}})
+        self.assertEqual(step._replaced_data_records(False), {"case": ["a"]})
+        self.assertEqual(step._replaced_data_records(True),
+                         {"case": ["a", "b"]})
+
+        conn = mock.MagicMock()
+        conn.dialect = postgresql.dialect()
+        step.config["write_mode"] = "delete_insert"
+        step._write(conn)
+        calls = conn.execute.call_args_list
+        # The old records are subtracted first and the new ones added last
+        self.assertIs(calls[0][0][0], alert_weekly_counts.REMOVE_COUNTS)
+        self.assertEqual(calls[0][1], {"variables": ["cmd_1"], "type": "case",
+                                       "uuids": ["a"]})
+        self.assertEqual(calls[-1][0][0].table.name, "alert_weekly_counts")
@@ -0,0 +1,75 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from meerkat_abacus.config import config
+from meerkat_abacus.util.config_registry import ConfigRegistry
+
+
+class ConfigRegistryTest(unittest.TestCase):
+    """
+    Test the cache of parsed config files
+    """
+
+    def setUp(self):
+        self.registry = ConfigRegistry(check_interval=0)
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "types.csv")
+        self._write("name,form\ncase,demo_case\nvisit,demo_case\n"
+                    "alert,demo_alert\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, text, mtime=None):
+        with open(self.path, "w") as f:
+            f.write(text)
+        if mtime:
+            os.utime(self.path, ns=(mtime, mtime))
+
+    def test_data_types(self):
+        data_types = self.registry.data_types(config)
+        self.assertEqual([d["type"] for d in data_types],
+                         ["case", "register", "visit"])
+        by_form = self.registry.data_types_by_form(config)
+        self.assertEqual([d["type"] for d in by_form["demo_case"]],
+                         ["case", "visit"])
+        self.assertIs(self.registry.data_types(config), data_types)
+
+    def test_reload_on_change(self):
+        rows = self.registry.read_csv(self.path)
+        self.assertEqual(len(rows), 3)
+        self.assertIs(self.registry.read_csv(self.path), rows)
+
+        self._write("name,form\ncase,demo_case\n", mtime=10 ** 9)
+        rows = self.registry.read_csv(self.path)
+        self.assertEqual(rows, [{"name": "case", "form": "demo_case"}])
+
+        self.registry.invalidate()
+        self.assertIsNot(self.registry.read_csv(self.path), rows)
+
+    def test_check_interval(self):
+        registry = ConfigRegistry(check_interval=3600)
+        rows = registry.read_csv(self.path)
+        self._write("name,form\n", mtime=10 ** 9)
+        self.assertIs(registry.read_csv(self.path), rows)
+
+    def test_links_and_exclusions(self):
+        links_by_type, links_by_name = self.registry.links(
+            config.config_directory + config.country_config["links_file"])
+        self.assertIn("alert_investigation", links_by_name)
+        self.assertEqual([l["name"] for l in links_by_type["Case"]],
+                         ["alert_investigation", "return_visit"])
+
+        exclusions = self.registry.exclusion_set("demo_case", config)
+        self.assertIn("uuid:exclusion_list_filtered_1", exclusions)
+        self.assertEqual(self.registry.exclusion_set("demo_alert", config),
+                         frozenset())
+
+    def test_codes(self):
+        param_config = mock.MagicMock()
+        param_config.config_directory = self.directory + "/"
+        param_config.country_config = {"codes_file": "types"}
+        self.assertEqual(len(self.registry.codes(param_config)), 3)
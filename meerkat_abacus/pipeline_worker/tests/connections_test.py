@@ -0,0 +1,62 @@
+import os
+import tempfile
+import unittest
+
+from sqlalchemy.pool import QueuePool
+
+from meerkat_abacus.pipeline_worker.connections import ConnectionManager
+
+
+class ConnectionManagerTest(unittest.TestCase):
+    """
+    Test the connection pool of the worker processes
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        url = "sqlite:///" + os.path.join(self.directory.name, "test.db")
+        self.manager = ConnectionManager(url, pool_size=2, max_overflow=0)
+        # sqlite does not use a QueuePool for files by default
+        self.manager.engine_args["poolclass"] = QueuePool
+
+    def tearDown(self):
+        self.manager.engine.dispose()
+        self.directory.cleanup()
+
+    def test_connect(self):
+        engine = self.manager.engine
+        for i in range(3):
+            with self.manager.connect() as connection:
+                self.assertEqual(connection.execute("select 1").scalar(), 1)
+        self.assertIs(self.manager.engine, engine)
+        metrics = self.manager.metrics()
+        self.assertEqual(metrics["acquisitions"], 3)
+        self.assertGreater(metrics["max_acquisition_time"], 0)
+        self.assertGreaterEqual(metrics["max_acquisition_time"],
+                                metrics["mean_acquisition_time"])
+        self.assertIn("Pool size: 2", metrics["pool"])
+
+    def test_reset_after_fork(self):
+        engine = self.manager.engine
+        self.manager.reset()
+        self.assertIs(self.manager.engine, engine)
+
+        # Pretend the engine was created in the parent process
+        self.manager._pid = -1
+        with self.manager.connect():
+            pass
+        self.manager._pid = -1
+        self.manager.reset()
+        self.assertIsNot(self.manager.engine, engine)
+        self.assertEqual(self.manager._inherited_engines[0], engine)
+        self.assertEqual(self.manager.acquisitions, 0)
+
+    def test_connection_from_other_process(self):
+        engine = self.manager.engine
+        connection = engine.connect()
+        dbapi_connection = connection.connection.connection
+        connection.connection._connection_record.info["pid"] = -1
+        connection.close()
+        with self.manager.connect() as connection:
+            self.assertIsNot(connection.connection.connection,
+                             dbapi_connection)
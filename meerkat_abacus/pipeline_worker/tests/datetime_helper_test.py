@@ -0,0 +1,54 @@
+import unittest
+from datetime import datetime, timezone
+
+from dateutil.parser import parse as dateutil_parse
+
+from meerkat_abacus.util.datetime_helper import parse, parse_known_format
+
+
+class ParseTest(unittest.TestCase):
+    """
+    Test that the fast date parsing gives the same dates as dateutil
+    """
+    samples = [
+        "2017-01-17T00:51:15.470615",
+        "2017-01-17T00:51:15",
+        "2017-01-17",
+        "2017-01-17 00:51",
+        "2017-01-16T18:57:29.481Z",
+        "2017-01-16T18:57:29+03:00",
+        "Jan 17, 2017",
+        "Jan 17, 2017 12:51:15 AM",
+        "Jan 17, 2017 12:51:15 PM",
+        "Feb 3, 2017 4:05:09 pm",
+        "17-Jan-2017",
+        "17-Jan-2017 12:57:29",
+        "17-Jan-2017 18:57:29",
+        "January 17th 2017",
+        "17/01/2017",
+    ]
+
+    def test_same_as_dateutil(self):
+        for sample in self.samples:
+            expected = dateutil_parse(sample)
+            result = parse(sample)
+            self.assertEqual(result, expected, sample)
+            self.assertEqual(result.tzinfo is None, expected.tzinfo is None,
+                             sample)
+
+    def test_known_formats(self):
+        self.assertEqual(parse_known_format("Jan 17, 2017 1:05:03 PM"),
+                         datetime(2017, 1, 17, 13, 5, 3))
+        self.assertEqual(parse_known_format("2017-01-16T18:57:29.481Z"),
+                         datetime(2017, 1, 16, 18, 57, 29, 481000,
+                                  tzinfo=timezone.utc))
+        # Left to dateutil
+        self.assertEqual(parse_known_format("17/01/2017"), None)
+        self.assertEqual(parse_known_format("2017-W03-1"), None)
+
+    def test_errors(self):
+        for value in ["", "not a date", "Jan 17, 2017 13:05:03 PM"]:
+            with self.assertRaises(ValueError):
+                parse(value)
+        with self.assertRaises(TypeError):
+            parse(None)
@@ -0,0 +1,57 @@
+import unittest
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from meerkat_abacus.util import epi_week
+from meerkat_abacus.util.epi_week import EpiWeekCalendar
+
+
+class EpiWeekCalendarTest(unittest.TestCase):
+    """
+    Test the epi week calendar against the epi week functions
+    """
+    custom_config = {2016: datetime(2016, 1, 2),
+                     2017: datetime(2016, 12, 31),
+                     2018: datetime(2017, 12, 30)}
+
+    def _dates(self):
+        start = datetime(2016, 1, 2)
+        return [start + timedelta(days=i, hours=i % 24) for i in range(0, 1000, 3)]
+
+    def test_custom_config(self):
+        calendar = EpiWeekCalendar(self.custom_config)
+        self.assertEqual(calendar.epi_week(datetime(2016, 12, 30)), (2016, 52))
+        self.assertEqual(calendar.epi_week(datetime(2016, 12, 31)), (2017, 1))
+        self.assertEqual(calendar.epi_week(datetime(2017, 1, 7)), (2017, 2))
+        with self.assertRaises(ValueError):
+            calendar.epi_week(datetime(2015, 6, 1))
+        self.assertEqual(epi_week.epi_year_by_date(datetime(2017, 12, 30),
+                                                   epi_config=self.custom_config),
+                         2018)
+
+    def test_same_as_epi_week_for_date(self):
+        for epi_config in ["international", "day:2", self.custom_config]:
+            for strategy in ["leave_as_is", "include_in_52", "include_in_1"]:
+                param_config = {"epi_week": epi_config,
+                                "epi_week_53_strategy": strategy}
+                expected = [epi_week.epi_week_for_date(date, param_config=param_config)
+                            for date in self._dates()]
+                calendar = EpiWeekCalendar(epi_config, strategy)
+                self.assertEqual([calendar.epi_week(date) for date in self._dates()],
+                                 expected)
+                years, weeks = calendar.epi_weeks(
+                    np.array(self._dates(), dtype="datetime64[ns]"))
+                self.assertEqual(list(zip(years.tolist(), weeks.tolist())),
+                                 expected)
+
+    def test_epi_weeks_series(self):
+        dates = pd.Series(self._dates()[:3], index=["a", "b", "c"])
+        years, weeks = epi_week.epi_weeks_for_dates(
+            dates, param_config={"epi_week": "international"})
+        self.assertEqual(list(years.index), ["a", "b", "c"])
+        self.assertEqual(list(weeks), [1, 1, 2])
+        with self.assertRaises(ValueError):
+            EpiWeekCalendar(self.custom_config).epi_weeks(
+                [datetime(2015, 1, 1)])
@@ -0,0 +1,61 @@
+import unittest
+
+from meerkat_abacus import model
+from meerkat_abacus.codes.geometry import DistrictIndex
+from geoalchemy2.shape import from_shape
+from shapely.geometry import Point, Polygon
+
+
+class DistrictIndexTest(unittest.TestCase):
+    """
+    Test finding the district for a point
+    """
+
+    def setUp(self):
+        self.locations = {
+            1: model.Locations(name="Demo", id=1),
+            2: model.Locations(name="Region 1", parent_location=1, id=2),
+            4: model.Locations(
+                name="District 1", parent_location=2,
+                level="district", id=4,
+                area=from_shape(Polygon([(0, 0), (0, 0.4), (0.2, 0.4),
+                                         (0.2, 0), (0, 0)]))),
+            5: model.Locations(
+                name="District 2", parent_location=2,
+                level="district", id=5,
+                area=from_shape(Polygon([(0.2, 0.4), (0.4, 0.4), (0.4, 0),
+                                         (0.2, 0), (0.2, 0.4)]))),
+            # Overlaps District 1, the first district should win
+            6: model.Locations(
+                name="District 3", parent_location=2,
+                level="district", id=6,
+                area=from_shape(Polygon([(0, 0), (0, 1), (1, 1),
+                                         (1, 0), (0, 0)]))),
+            7: model.Locations(
+                name="District without area", parent_location=2,
+                level="district", id=7)
+        }
+        self.index = DistrictIndex(self.locations)
+
+    def test_find(self):
+        self.assertEqual(len(self.index), 3)
+        self.assertEqual(self.index.find(Point(0.1, 0.1)), 4)
+        self.assertEqual(self.index.find(Point(0.3, 0.1)), 5)
+        self.assertEqual(self.index.find(Point(0.5, 0.5)), 6)
+        self.assertEqual(self.index.find(Point(2, 2)), None)
+
+    def test_find_many(self):
+        coordinates = [(0.1, 0.1), (2, 2), (0.3, 0.1), (0.5, 0.5), (0.1, 0.1)]
+        self.assertEqual(self.index.find_many(coordinates),
+                         [4, None, 5, 6, 4])
+        self.assertEqual(self.index.find_many([]), [])
+
+        self.index.preload(coordinates)
+        self.assertEqual(self.index.find(Point(0.3, 0.1)), 5)
+        self.index.clear_preloaded()
+        self.assertEqual(self.index.find(Point(0.3, 0.1)), 5)
+
+    def test_no_districts(self):
+        index = DistrictIndex({1: self.locations[1]})
+        self.assertEqual(index.find(Point(0.1, 0.1)), None)
+        self.assertEqual(index.find_many([(0.1, 0.1)]), [None])
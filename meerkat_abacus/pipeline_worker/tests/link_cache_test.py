@@ -0,0 +1,243 @@
+import unittest
+from unittest import mock
+
+from meerkat_abacus import model
+from meerkat_abacus.config import config
+from meerkat_abacus.pipeline_worker.link_cache import (
+    LinkCache, IdTracker, as_text)
+
+
+class LinkCacheTest(unittest.TestCase):
+    """
+    Test the in-memory link index
+    """
+    links = [
+        {"name": "alert_investigation",
+         "to_form": "demo_alert",
+         "from_form": "demo_case",
+         "from_column": "meta/instanceID",
+         "to_column": "pt./alert_id",
+         "method": "alert_match"},
+        {"name": "return_visit",
+         "to_form": "demo_case",
+         "from_form": "demo_case",
+         "from_column": "pid;icd_code",
+         "to_column": "pid;icd_code",
+         "method": "lower_match;match",
+         "to_condition": "visit:return"}
+    ]
+
+    def setUp(self):
+        self.cache = LinkCache(self.links, model.form_tables(config),
+                               alert_id_length=4)
+
+    def _refresh(self, rows):
+        session = mock.MagicMock()
+        query = session.query.return_value.filter.return_value
+        query.order_by.return_value.yield_per.return_value = rows
+        self.cache.refresh(session)
+
+    def test_as_text(self):
+        self.assertEqual(as_text("a"), "a")
+        self.assertEqual(as_text(None), None)
+        self.assertEqual(as_text(1), "1")
+        self.assertEqual(as_text(True), "true")
+
+    def test_to_links(self):
+        self._refresh([
+            (1, "a", {"pid": "AB-1", "icd_code": "A01", "visit": "return"}),
+            (2, "b", {"pid": "ab_1", "icd_code": "A01", "visit": "return"}),
+            (3, "c", {"pid": "ab_1", "icd_code": "A01", "visit": "new"}),
+            (4, "d", {"pid": "", "icd_code": "A01", "visit": "return"}),
+            (5, "e", {"pt./alert_id": "abcd"})
+        ])
+        link = self.links[1]
+        result = self.cache.get_to_links(link, {"pid": "Ab-1",
+                                                "icd_code": "A01"})
+        self.assertEqual([uuid for uuid, data in result], ["a", "b"])
+        self.assertEqual(
+            self.cache.get_to_links(link, {"pid": "Ab-1", "icd_code": "A02"}),
+            [])
+        # Missing column, needs the db query
+        self.assertEqual(self.cache.get_to_links(link, {"pid": "Ab-1"}),
+                         None)
+
+        link = self.links[0]
+        result = self.cache.get_to_links(
+            link, {"meta/instanceID": "uuid:1234abcd"})
+        self.assertEqual(result, [("e", {"pt./alert_id": "abcd"})])
+
+    def test_from_links(self):
+        uuid = "uuid:" + "a" * 32 + "1234"
+        self._refresh([(1, "a", {"meta/instanceID": uuid})])
+        link = self.links[0]
+        result = self.cache.get_from_links(link, {"pt./alert_id": "1234"})
+        self.assertEqual(result, [("a", {"meta/instanceID": uuid})])
+        self.assertEqual(self.cache.get_from_links(link, {}), [])
+
+        # Returned data can be changed without changing the cache
+        result[0][1]["clinic_type"] = "Primary"
+        result = self.cache.get_from_links(link, {"pt./alert_id": "1234"})
+        self.assertEqual(result, [("a", {"meta/instanceID": uuid})])
+
+    def test_refresh(self):
+        self._refresh([(1, "a", {"pid": "1", "icd_code": "A01",
+                                 "visit": "return"})])
+        self.assertEqual(len(self.cache), 2)
+        # Rows we have already seen are not added again
+        self._refresh([(1, "a", {"pid": "1", "icd_code": "A01",
+                                 "visit": "return"}),
+                       (2, "b", {"pid": "1", "icd_code": "A01",
+                                 "visit": "return"})])
+        result = self.cache.get_to_links(self.links[1], {"pid": "1",
+                                                         "icd_code": "A01"})
+        self.assertEqual([uuid for uuid, data in result], ["a", "b"])
+        self.assertEqual(self.cache.trackers["demo_case"].high_water, 2)
+
+    def test_refresh_without_gaps(self):
+        self._refresh([(1, "a", {"pid": "1"}), (3, "c", {"pid": "3"})])
+        tracker = self.cache.trackers["demo_case"]
+        self.assertEqual(list(tracker.gaps), [2])
+        session = mock.MagicMock()
+        self.cache.refresh(session, gaps=False)
+        condition = session.query.return_value.filter.call_args[0][0]
+        self.assertNotIn("IN", str(condition))
+        # The gaps are kept for the next full refresh
+        self.assertEqual(list(tracker.gaps), [2])
+
+    def test_eviction(self):
+        self.cache.max_rows = 4
+        self._refresh([(i, str(i), {"pid": str(i), "icd_code": "A01",
+                                    "visit": "return"})
+                       for i in range(1, 4)])
+        self.assertLessEqual(len(self.cache), 4)
+        link = self.links[1]
+        index = ("to", link["name"])
+        # Evicted keys go to the db, keys that are not in the index do not
+        self.assertEqual(
+            self.cache.get_to_links(link, {"pid": "1", "icd_code": "A01"}),
+            None)
+        self.assertEqual(
+            self.cache.get_to_links(link, {"pid": "9", "icd_code": "A01"}),
+            [])
+        result = self.cache.get_to_links(link, {"pid": "3", "icd_code": "A01"})
+        self.assertEqual([uuid for uuid, data in result], ["3"])
+
+        # New keys are still cached after an eviction
+        self._refresh([(4, "4", {"pid": "4", "icd_code": "A01",
+                                 "visit": "return"})])
+        result = self.cache.get_to_links(link, {"pid": "4", "icd_code": "A01"})
+        self.assertEqual([uuid for uuid, data in result], ["4"])
+
+        # A new row of an evicted key is not added on its own
+        self._refresh([(5, "5", {"pid": "1", "icd_code": "A01",
+                                 "visit": "return"})])
+        self.assertEqual(
+            self.cache.get_to_links(link, {"pid": "1", "icd_code": "A01"}),
+            None)
+
+        # Rows read from the db for an evicted key are put back
+        rows = [("1", {"pid": "1"}), ("5", {"pid": "1"})]
+        self.cache.fill(index, ("1", "A01"), rows)
+        result = self.cache.get_to_links(link, {"pid": "1", "icd_code": "A01"})
+        self.assertEqual([uuid for uuid, data in result], ["1", "5"])
+        # Keys that were not evicted are not changed
+        self.cache.fill(index, ("4", "A01"), [])
+        result = self.cache.get_to_links(link, {"pid": "4", "icd_code": "A01"})
+        self.assertEqual([uuid for uuid, data in result], ["4"])
+
+    def test_fill_then_refresh(self):
+        self.cache.max_rows = 4
+        self._refresh([(i, str(i), {"pid": str(i), "icd_code": "A01",
+                                    "visit": "return"})
+                       for i in range(1, 4)])
+        link = self.links[1]
+        index = ("to", link["name"])
+        self.assertIn((index, ("1", "A01")), self.cache.evicted)
+        # Row 4 was inserted after the refresh, fill reads it from the db
+        # and the next refresh reads it again
+        row = {"pid": "1", "icd_code": "A01", "visit": "return"}
+        self.cache.fill(index, ("1", "A01"), [("1", row), ("4", row)])
+        self._refresh([(4, "4", row)])
+        result = self.cache.get_to_links(link, {"pid": "1", "icd_code": "A01"})
+        self.assertEqual([uuid for uuid, data in result], ["1", "4"])
+
+    def test_evicted_keys_bounded(self):
+        self.cache.max_rows = 4
+        self._refresh([(i, str(i), {"pid": str(i), "icd_code": "A01",
+                                    "visit": "return"})
+                       for i in range(1, 10)])
+        self.assertLessEqual(len(self.cache.evicted), 4)
+        link = self.links[1]
+        index = ("to", link["name"])
+        self.assertNotIn(index, self.cache.complete)
+        # The incomplete index sends the keys it does not have to the db
+        self.assertEqual(
+            self.cache.get_to_links(link, {"pid": "1", "icd_code": "A01"}),
+            None)
+        self.assertEqual(
+            self.cache.get_to_links(link, {"pid": "99", "icd_code": "A01"}),
+            None)
+        # and caches them when they are read from the db
+        self.cache.fill(index, ("99", "A01"), [])
+        self.assertEqual(
+            self.cache.get_to_links(link, {"pid": "99", "icd_code": "A01"}),
+            [])
+
+    def test_rollback(self):
+        row = {"pid": "1", "icd_code": "A01", "visit": "return"}
+        self._refresh([(1, "a", row)])
+        link = self.links[1]
+        self.cache.begin()
+        # Rows of a transaction that is rolled back
+        self._refresh([(2, "b", row),
+                       (3, "c", {"pid": "2", "icd_code": "A01",
+                                 "visit": "return"})])
+        self.cache.rollback()
+        result = self.cache.get_to_links(link, {"pid": "1", "icd_code": "A01"})
+        self.assertEqual([uuid for uuid, data in result], ["a"])
+        self.assertEqual(
+            self.cache.get_to_links(link, {"pid": "2", "icd_code": "A01"}),
+            [])
+        self.assertEqual(len(self.cache), 2)
+        # The ids are read again when they are committed
+        self.assertEqual(self.cache.trackers["demo_case"].high_water, 1)
+        self.cache.begin()
+        self._refresh([(2, "b", row)])
+        self.cache.commit()
+        result = self.cache.get_to_links(link, {"pid": "1", "icd_code": "A01"})
+        self.assertEqual([uuid for uuid, data in result], ["a", "b"])
+
+
+class IdTrackerTest(unittest.TestCase):
+    """
+    Test that we only read the rows we have not seen
+    """
+
+    def test_gaps(self):
+        tracker = IdTracker(gap_timeout=300, max_gaps=5)
+        for row_id in [1, 2, 4]:
+            self.assertTrue(tracker.add(row_id))
+        self.assertEqual(list(tracker.gaps), [3])
+        self.assertFalse(tracker.add(2))
+        # A row that committed late
+        self.assertTrue(tracker.add(3))
+        self.assertFalse(tracker.add(3))
+        self.assertEqual(list(tracker.gaps), [])
+
+        self.assertTrue(tracker.add(20))
+        self.assertEqual(list(tracker.gaps), [15, 16, 17, 18, 19])
+        self.assertTrue(tracker.add(22))
+        tracker.expire()
+        self.assertEqual(list(tracker.gaps), [16, 17, 18, 19, 21])
+
+        tracker.gap_timeout = 0
+        tracker.expire()
+        self.assertEqual(list(tracker.gaps), [])
+
+    def test_condition(self):
+        tracker = IdTracker()
+        tracker.add(1)
+        tracker.add(3)
+        condition = tracker.condition(model.Data.id)
+        self.assertEqual(str(condition), "data.id > :id_1 OR data.id IN (:id_2)")
@@ -0,0 +1,75 @@
+import unittest
+
+from meerkat_abacus import model
+from meerkat_abacus.codes.location_tree import LocationTree
+from geoalchemy2.shape import from_shape
+from shapely.geometry import Point
+
+
+class LocationTreeTest(unittest.TestCase):
+    """
+    Test the precomputed location hierarchy
+    """
+
+    def setUp(self):
+        self.locations = {
+            1: model.Locations(name="Demo", id=1),
+            2: model.Locations(name="Region 1", parent_location=1,
+                               level="region", id=2),
+            3: model.Locations(name="Region 2", parent_location=1,
+                               level="region", id=3),
+            4: model.Locations(name="District 1", parent_location=2,
+                               level="district", id=4),
+            5: model.Locations(name="District 2", parent_location=3,
+                               level="district", id=5),
+            6: model.Locations(name="Clinic 1", parent_location=4, id=6,
+                               deviceid="1,2", clinic_type="Primary",
+                               other={"a": "b"},
+                               point_location=from_shape(Point(0.1, 0.1))),
+            7: model.Locations(name="Clinic 2", parent_location=5, id=7,
+                               deviceid="3"),
+            8: model.Locations(name="Clinic with no district",
+                               parent_location=2, id=8, deviceid="x-4")}
+        self.tree = LocationTree(self.locations, devices={"1": ["tag"]})
+
+    def test_levels(self):
+        self.assertEqual(self.tree.regions, {2, 3})
+        self.assertEqual(self.tree.districts, {4, 5})
+        self.assertEqual(self.tree.by_deviceid,
+                         {"1": 6, "2": 6, "3": 7, "x-4": 8})
+        locations, by_deviceid, zones, regions, districts, devices = (
+            self.tree.location_data())
+        self.assertEqual((zones, regions, districts), ([], [2, 3], [4, 5]))
+
+    def test_ancestry(self):
+        ancestry = self.tree.ancestry[6]
+        self.assertEqual(
+            (ancestry["district"], ancestry["region"], ancestry["zone"]),
+            (4, 2, 1))
+        self.assertEqual(ancestry["clinic_type"], "Primary")
+        self.assertEqual(ancestry["other"], {"a": "b"})
+        self.assertEqual(ancestry["geolocation"],
+                         self.locations[6].point_location.desc)
+        ancestry = self.tree.ancestry[8]
+        self.assertEqual(
+            (ancestry["district"], ancestry["region"], ancestry["zone"]),
+            (None, 2, 1))
+        self.assertEqual(self.tree.ancestry[1]["region"], None)
+
+    def test_clinic_by_deviceid(self):
+        self.assertEqual(self.tree.clinic_by_deviceid("2"), 6)
+        self.assertEqual(self.tree.clinic_by_deviceid("4", prefix="x-"), 8)
+        self.assertEqual(self.tree.clinic_by_deviceid("4"), None)
+
+    def test_is_child(self):
+        def walk(parent, child):
+            while child is not None:
+                if child == parent:
+                    return True
+                child = self.locations[child].parent_location
+            return False
+        for parent in self.locations:
+            for child in self.locations:
+                self.assertEqual(self.tree.is_child(parent, child),
+                                 walk(parent, child), (parent, child))
+        self.assertEqual(self.tree.is_child(1, 99), None)
@@ -0,0 +1,63 @@
+import os
+import tempfile
+import time
+import unittest
+
+from meerkat_abacus.util import spool
+
+
+class SpoolTest(unittest.TestCase):
+    """
+    Test writing chunks to the spool and reading them back
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.spool_directory = os.path.join(self.directory.name, "spool")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        data = [{"form": "demo_case",
+                 "data": {"index": i, "name": "\u00e5\u00df\n", "empty": None}}
+                for i in range(100)]
+        reference = spool.write_chunk(data, self.spool_directory)
+        self.assertTrue(spool.is_reference(reference))
+        self.assertFalse(spool.is_reference(data))
+        self.assertEqual(reference["records"], 100)
+        self.assertEqual(os.listdir(self.spool_directory),
+                         [reference["spool_file"]])
+        self.assertEqual(spool.read_chunk(reference, self.spool_directory),
+                         data)
+        spool.remove_chunk(reference, self.spool_directory)
+        self.assertEqual(os.listdir(self.spool_directory), [])
+        spool.remove_chunk(reference, self.spool_directory)
+
+    def test_sweep(self):
+        old = spool.write_chunk([{"form": "a", "data": {}}],
+                                self.spool_directory)
+        new = spool.write_chunk([{"form": "a", "data": {}}],
+                                self.spool_directory)
+        tmp_path = os.path.join(self.spool_directory, "chunk-crashed.json.gz.tmp")
+        open(tmp_path, "w").close()
+        other_path = os.path.join(self.spool_directory, "other")
+        open(other_path, "w").close()
+        an_hour_ago = time.time() - 3600
+        for path in [os.path.join(self.spool_directory, old["spool_file"]),
+                     tmp_path, other_path]:
+            os.utime(path, (an_hour_ago, an_hour_ago))
+        self.assertEqual(spool.sweep(self.spool_directory, 600), 2)
+        self.assertEqual(sorted(os.listdir(self.spool_directory)),
+                         sorted([new["spool_file"], "other"]))
+        self.assertEqual(spool.sweep(os.path.join(self.directory.name, "no"),
+                                     600), 0)
+
+    def test_invalid_reference(self):
+        reference = spool.write_chunk([{"form": "a", "data": {}}],
+                                      self.spool_directory)
+        with self.assertRaises(ValueError):
+            spool.read_chunk({"spool_file": "../" + reference["spool_file"],
+                              "records": 1}, self.spool_directory)
+        with self.assertRaises(ValueError):
+            spool.read_chunk(dict(reference, records=2), self.spool_directory)
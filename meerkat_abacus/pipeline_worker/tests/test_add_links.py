@@ -220,3 +220,62 @@ class TestAddLinks(unittest.TestCase):
                          "3")
         self.assertEqual(results[0]["data"]["link_data"]["return_visit"][1]["id"],
                          "2")
+
+    @patch.object(add_links.util, 'get_links',
+                  return_value=test_links3)
+    def test_link_cache(self, get_links_mock):
+        config.country_config["alert_id_length"] = 1
+        al = add_links.AddLinks(config, self.session)
+        self.assertIsNotNone(al.link_cache)
+        existing_data = [{
+            "uuid": "b",
+            "data": {
+                "visit_date": "2017-01-17T05:38:33.482144",
+                "link_id": "AA",
+                "visit": "return",
+                "id": "2"
+            }
+        }]
+        table = model.form_tables(config)["demo_case"]
+        con = self.engine.connect()
+        con.execute(table.__table__.insert(), existing_data)
+        con.close()
+        records = [{"form": "data",
+                    "data": {"type": "Case",
+                             "original_form": "demo_case",
+                             "raw_data": {"link_id": "aA"}}},
+                   {"form": "data",
+                    "data": {"type": "Case",
+                             "original_form": "demo_case",
+                             "raw_data": {"link_id": "bb"}}}]
+        results = al.run_batch(records)
+        # The row is in both the "to" and the "from" index of the link
+        self.assertEqual(len(al.link_cache), 2)
+        self.assertEqual(results[0][0]["data"]["link_data"],
+                         {"return_visit": [existing_data[0]["data"]]})
+        self.assertEqual(results[1][0]["data"]["link_data"], {})
+
+    @patch.object(add_links.util, 'get_links',
+                  return_value=test_links2)
+    def test_batch_links_without_cache(self, get_links_mock):
+        config.link_cache = False
+        try:
+            al = add_links.AddLinks(config, self.session)
+        finally:
+            config.link_cache = True
+        existing_data = [{"uuid": "a", "data": {"alert_id": "1"}},
+                         {"uuid": "b", "data": {"alert_id": "2"}}]
+        table = model.form_tables(config)["demo_alert"]
+        con = self.engine.connect()
+        con.execute(table.__table__.insert(), existing_data)
+        con.close()
+        records = [{"form": "data",
+                    "data": {"type": "Case",
+                             "original_form": "demo_case",
+                             "raw_data": {"alert_id": alert_id}}}
+                   for alert_id in ["2", "1", "3"]]
+        results = al.run_batch(records)
+        self.assertEqual([r[0]["data"]["link_data"] for r in results],
+                         [{"alert_investigation": [{"alert_id": "2"}]},
+                          {"alert_investigation": [{"alert_id": "1"}]},
+                          {}])
@@ -58,3 +58,28 @@ class TestToDataType(unittest.TestCase):
         result = tdt.run(data_5["form"], data_5["data"])
         self.assertEqual(result, [])
 
+
+    def test_run_batch(self):
+        tdt = to_data_type.ToDataType(config, self.session)
+        records = [{"form": "demo_case", "data": {"intro./visit": "new"}},
+                   {"form": "demo_case", "data": {"intro./visit": "return"}},
+                   {"form": "demo_alert", "data": {"intro./visit": "new"}},
+                   {"form": "demo_case", "data": {"intro./visit": "new",
+                                                  "pt./pid": "2"}},
+                   {"form": "demo_does_not_exisit", "data": {}}]
+        results = tdt.run_batch(records)
+        self.assertEqual(results,
+                         [tdt.run(r["form"], r["data"]) for r in records])
+        self.assertEqual(results[3][0]["data"]["raw_data"],
+                         records[3]["data"])
+        # Records in the same partition get their own data records
+        self.assertIsNot(results[0][0]["data"], results[3][0]["data"])
+
+    def test_routes(self):
+        tdt = to_data_type.ToDataType(config, self.session)
+        self.assertEqual(tdt.routes["demo_alert"],
+                         [("Case", None, None, "alert_investigation")])
+        self.assertEqual([route[0] for route in tdt.routes["demo_case"]],
+                         ["Case", "Visit"])
+        self.assertEqual(tdt.condition_columns["demo_case"],
+                         ("intro./visit",))
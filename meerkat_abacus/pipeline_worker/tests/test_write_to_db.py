@@ -0,0 +1,168 @@
+import itertools
+import unittest
+from unittest import mock
+from datetime import datetime
+
+from sqlalchemy.dialects import postgresql
+
+from meerkat_abacus import model
+from meerkat_abacus.config import config
+from meerkat_abacus.pipeline_worker.process_steps import write_to_db
+from meerkat_abacus.pipeline_worker.process_steps.write_to_db import (
+    WriteToDb, copy_rows, upsert_rows)
+
+
+class TestCopyRows(unittest.TestCase):
+    """
+    Test the text we send to postgres with COPY
+    """
+
+    def setUp(self):
+        self.conn = mock.MagicMock()
+        self.conn.dialect = postgresql.dialect()
+        self.cursor = self.conn.connection.cursor.return_value
+        self.copied = []
+        self.cursor.copy_expert.side_effect = (
+            lambda statement, f: self.copied.append((statement, f.read())))
+
+    def test_copy_data_rows(self):
+        rows = [{"uuid": "a", "type": "case",
+                 "date": datetime(2017, 1, 2),
+                 "variables": {"tot_1": 1, "a": "x\"y",
+                               "d": datetime(2017, 1, 3)},
+                 "case_type": ["mh", "a\"b"],
+                 "clinic": 4,
+                 "district": None,
+                 "geolocation": "0101000000000000000000F03F0000000000000040"},
+                {"uuid": "b", "type": "case", "clinic_type": ""},
+                {"uuid": "c", "type": "case", "clinic_type": "Primary"}]
+        copy_rows(self.conn, model.Data.__table__, rows)
+        statement, text = self.copied[0]
+        self.assertEqual(
+            statement,
+            'COPY data (uuid, type, date, district, clinic, '
+            'case_type, variables, geolocation) FROM STDIN WITH (FORMAT csv)')
+        self.assertEqual(
+            text,
+            '"a","case","2017-01-02T00:00:00",,"4",'
+            '"{""mh"",""a\\""b""}",'
+            '"{""tot_1"": 1, ""a"": ""x\\""y"", ""d"": ""2017-01-03T00:00:00""}",'
+            '"0101000000000000000000F03F0000000000000040"\n')
+        # Rows with other columns are copied separately, so the columns
+        # they do not have get their default values
+        statement, text = self.copied[1]
+        self.assertEqual(
+            statement,
+            'COPY data (uuid, type, clinic_type) FROM STDIN WITH (FORMAT csv)')
+        # Empty strings are quoted
+        self.assertEqual(text, '"b","case",""\n"c","case","Primary"\n')
+        self.assertEqual(len(self.copied), 2)
+        self.assertEqual(self.cursor.close.call_count, 2)
+
+    def test_copy_json_none(self):
+        rows = [{"uuid": "a", "type": "case", "variables": None,
+                 "clinic": None}]
+        copy_rows(self.conn, model.Data.__table__, rows)
+        statement, text = self.copied[0]
+        # JSON null as with INSERT, NULL for other columns
+        self.assertEqual(text, '"a","case",,"null"\n')
+
+    def test_unknown_column(self):
+        with self.assertRaises(ValueError):
+            copy_rows(self.conn, model.Data.__table__, [{"not_a_column": 1}])
+
+    def test_no_rows(self):
+        copy_rows(self.conn, model.Data.__table__, [])
+        self.assertEqual(self.copied, [])
+
+
+class TestUpsert(unittest.TestCase):
+    """
+    Test the upsert mode of WriteToDb
+    """
+
+    def test_upsert_rows(self):
+        conn = mock.MagicMock()
+        conn.dialect = postgresql.dialect()
+        rows = [{"uuid": "a", "type": "case", "variables": {"tot_1": 1}}]
+        with mock.patch.object(write_to_db, "_staging_ids",
+                               itertools.count()):
+            upsert_rows(conn, model.Data.__table__, rows,
+                        model.DisregardedData.__table__)
+        statements = [c[0][0] for c in conn.execute.call_args_list]
+        self.assertIn("pg_indexes", str(statements[0]))
+        self.assertEqual(conn.execute.call_args_list[0][1],
+                         {"table": "data", "index": "data_uuid_type"})
+        self.assertEqual(
+            statements[1],
+            "CREATE TEMP TABLE staging_data_0 (LIKE data INCLUDING DEFAULTS) "
+            "ON COMMIT DROP")
+        self.assertEqual(statements[2].table.name, "staging_data_0")
+        self.assertEqual(conn.execute.call_args_list[2][0][1], rows)
+        self.assertEqual(
+            statements[3],
+            "INSERT INTO data (uuid, type, variables) "
+            "SELECT uuid, type, variables FROM staging_data_0 "
+            "ON CONFLICT (uuid, type) DO UPDATE SET "
+            "variables = EXCLUDED.variables")
+        self.assertEqual(
+            statements[4],
+            "DELETE FROM disregarded_data USING staging_data_0 "
+            "WHERE disregarded_data.uuid = staging_data_0.uuid "
+            "AND disregarded_data.type = staging_data_0.type")
+        self.assertEqual(len(statements), 5)
+
+    def test_missing_unique_index(self):
+        conn = mock.MagicMock()
+        conn.dialect = postgresql.dialect()
+        conn.execute.return_value.scalar.return_value = None
+        rows = [{"uuid": "a", "type": "case", "variables": {}}]
+        with self.assertRaises(RuntimeError):
+            upsert_rows(conn, model.Data.__table__, rows)
+        self.assertEqual(len(conn.execute.call_args_list), 1)
+
+    def test_last_record_wins(self):
+        step = WriteToDb(config, mock.MagicMock())
+        step.run("data", {"uuid": "a", "type": "case", "variables": {"a": 1}})
+        step.run("data", {"uuid": "b", "type": "case", "variables": {}})
+        step.run("data", {"uuid": "a", "type": "case", "variables": {"a": 2}})
+        step.run("data", {"uuid": "a", "type": "visit", "variables": {}})
+        rows = step.data_to_write[model.Data]
+        self.assertEqual(
+            [(r["uuid"], r["type"], r["variables"]) for r in rows],
+            [("a", "case", {"a": 2}), ("b", "case", {}), ("a", "visit", {})])
+
+    def test_write_modes(self):
+        step = WriteToDb(config, mock.MagicMock())
+        step.run("data", {"uuid": "a", "type": "case", "variables": {}})
+        conn = mock.MagicMock()
+        conn.dialect = postgresql.dialect()
+        step.config["write_mode"] = "upsert"
+        step._write(conn)
+        statements = [str(c[0][0]) for c in conn.execute.call_args_list]
+        self.assertFalse(any(s.startswith("DELETE FROM data") for s in statements))
+        self.assertTrue(any(s.startswith("INSERT INTO data") for s in statements))
+
+        conn = mock.MagicMock()
+        step.config["write_mode"] = "delete_insert"
+        step._write(conn)
+        statements = [str(c[0][0].compile(dialect=postgresql.dialect()))
+                      for c in conn.execute.call_args_list]
+        self.assertTrue(statements[0].startswith("DELETE FROM data"))
+        self.assertTrue(statements[-1].startswith("INSERT INTO data"))
+
+    def test_copy_fallback(self):
+        step = WriteToDb(config, mock.MagicMock())
+        step.engine = mock.MagicMock()
+        step.config["writer"] = "copy"
+        step.monitoring_buffer = []
+        step.start_step()
+        step.run("data", {"uuid": "a", "type": "case", "variables": {}})
+        with mock.patch.object(step, "_write_chunk",
+                               side_effect=[ValueError("copy"), None]) as write, \
+                mock.patch("meerkat_abacus.pipeline_worker.process_steps."
+                           "write_to_db.logger") as logger:
+            step.end_step(1)
+        self.assertEqual(step.copy_fallbacks, 1)
+        self.assertEqual(write.call_args_list[1][1], {})
+        logger.warning.assert_called_once()
@@ -0,0 +1,175 @@
+import unittest
+from unittest import mock
+from datetime import datetime, timedelta
+
+from meerkat_abacus.pipeline_worker.threshold_counters import (
+    ThresholdCounters, threshold_alerts)
+
+
+class ThresholdCountersTest(unittest.TestCase):
+    """
+    Test the in-memory threshold alert counts
+    """
+
+    def setUp(self):
+        self.counters = ThresholdCounters(["cmd_1"])
+
+    def _refresh(self, rows):
+        session = mock.MagicMock()
+        query = session.query.return_value.filter.return_value
+        query.order_by.return_value.yield_per.return_value = rows
+        self.counters.refresh(session)
+
+    def _session(self, uuids, value=1):
+        session = mock.MagicMock()
+        query = session.query.return_value.filter.return_value
+        query.order_by.return_value = [(uuid, value) for uuid in uuids]
+        return session
+
+    def test_refresh(self):
+        rows = [
+            (1, "a", "case", 1, datetime(2017, 6, 10, 9), 2017, 23, {"cmd_1": 1}),
+            (2, "b", "case", 1, datetime(2017, 6, 10, 12), 2017, 23, {"cmd_1": 1}),
+            (3, "c", "case", 1, datetime(2017, 6, 11), 2017, 24, {"cmd_1": 1}),
+            (4, "d", "case", 2, datetime(2017, 6, 10), 2017, 23, {"cmd_1": 1})
+        ]
+        self._refresh(rows)
+        self.assertEqual(self.counters.tracker.high_water, 4)
+        self.assertEqual(
+            self.counters.day_count("cmd_1", 1, datetime(2017, 6, 10)), (2, 2))
+        self.assertEqual(
+            self.counters.week_count("cmd_1", 1, 2017, 23), (2, 2))
+        self.assertEqual(
+            self.counters.week_count("cmd_1", 2, 2017, 23), (1, 1))
+
+        # Rows already counted are not counted again
+        self._refresh(rows)
+        self.assertEqual(
+            self.counters.day_count("cmd_1", 1, datetime(2017, 6, 10)), (2, 2))
+
+        # A record written again without the variable is no longer counted
+        self._refresh([(5, "a", "case", 1, datetime(2017, 6, 10, 9), 2017, 23,
+                        None),
+                       (6, "e", "case", 1, datetime(2017, 6, 10), 2017, 23,
+                        None)])
+        self.assertEqual(
+            self.counters.day_count("cmd_1", 1, datetime(2017, 6, 10)), (1, 1))
+        self.assertNotIn(("e", "case"), self.counters.contributions)
+
+    def test_add_replaces(self):
+        self.counters.add("a", "case", 1, datetime(2017, 6, 10), 2017, 23,
+                          {"cmd_1": 1})
+        self.counters.add("a", "case", 1, datetime(2017, 6, 10), 2017, 23,
+                          {"cmd_1": 1})
+        self.assertEqual(
+            self.counters.day_count("cmd_1", 1, datetime(2017, 6, 10)), (1, 1))
+
+        # The record moves to another day
+        self.counters.add("a", "case", 1, datetime(2017, 6, 12), 2017, 24,
+                          {"cmd_1": 1})
+        self.assertEqual(
+            self.counters.day_count("cmd_1", 1, datetime(2017, 6, 10)), (0, 0))
+        self.assertEqual(
+            self.counters.week_count("cmd_1", 1, 2017, 24), (1, 1))
+
+        # The record no longer has the variable
+        self.counters.add("a", "case", 1, datetime(2017, 6, 12), 2017, 24,
+                          {"cmd_2": 1})
+        self.assertEqual(self.counters.daily, {})
+        self.assertEqual(self.counters.weekly, {})
+        self.assertEqual(self.counters.contributions, {})
+        self.assertEqual(self.counters.days, {})
+
+    def test_rollback(self):
+        self.counters.add("a", "case", 1, datetime(2017, 6, 10), 2017, 23,
+                          {"cmd_1": 1})
+        self.counters.begin()
+        self._refresh([
+            (1, "a", "case", 2, datetime(2017, 6, 10), 2017, 23, {"cmd_1": 1}),
+            (2, "b", "case", 1, datetime(2017, 6, 10), 2017, 23, {"cmd_1": 1})
+        ])
+        self.assertEqual(
+            self.counters.day_count("cmd_1", 1, datetime(2017, 6, 10)), (1, 1))
+        self.counters.rollback()
+        self.assertEqual(
+            self.counters.day_count("cmd_1", 1, datetime(2017, 6, 10)), (1, 1))
+        self.assertEqual(
+            self.counters.day_count("cmd_1", 2, datetime(2017, 6, 10)), (0, 0))
+        self.assertEqual(set(self.counters.contributions), {("a", "case")})
+        self.assertEqual(self.counters.tracker.high_water, 0)
+
+    def test_prune(self):
+        counters = ThresholdCounters(["cmd_1"], retain_days=10)
+        start = datetime(2017, 6, 1)
+        for i in range(20):
+            counters.add(str(i), "case", 1, start + timedelta(days=i), 2017,
+                         22 + i // 7, {"cmd_1": 1})
+        counters.prune()
+        newest = start + timedelta(days=19)
+        self.assertEqual(counters.cutoff, newest - timedelta(days=10))
+        self.assertEqual(len(counters.contributions), 11)
+        self.assertEqual(min(counters.days), counters.cutoff)
+        self.assertEqual(counters.day_count("cmd_1", 1, start), (0, 0))
+        self.assertEqual(sum(n for total, n in counters.daily.values()), 11)
+        # Records before the window are not counted
+        counters.add("old", "case", 1, start, 2017, 22, {"cmd_1": 1})
+        self.assertNotIn(("old", "case"), counters.contributions)
+
+        self.assertTrue(counters.covers(newest))
+        self.assertTrue(counters.covers(counters.cutoff + timedelta(days=7)))
+        self.assertFalse(counters.covers(counters.cutoff + timedelta(days=6)))
+
+        # Dates in the future do not move the window
+        counters.add("future", "case", 1, datetime(2100, 1, 1), 2100, 1,
+                     {"cmd_1": 1})
+        self.assertLessEqual(counters.newest, datetime.now())
+
+    def test_threshold_alerts(self):
+        for uuid in ["a", "b", "c"]:
+            self.counters.add(uuid, "case", 1, datetime(2017, 6, 10), 2017, 23,
+                              {"cmd_1": 1})
+        data = {"uuid": "c", "clinic": 1, "clinic_type": "Primary",
+                "date": datetime(2017, 6, 10), "epi_year": 2017,
+                "epi_week": 23, "variables": {"cmd_1": 1}}
+
+        session = self._session(["a", "b", "c"])
+        alerts = threshold_alerts(self.counters, "cmd_1", "threshold:3,5",
+                                  data, session)
+        self.assertEqual(alerts, [{"clinic": 1, "reason": "cmd_1",
+                                   "duration": 1, "uuids": ["a", "b", "c"],
+                                   "type": "threshold"}])
+
+        alerts = threshold_alerts(self.counters, "cmd_1", "threshold:2,3",
+                                  data, session)
+        self.assertEqual([a["duration"] for a in alerts], [1, 7])
+
+        # Nothing is read from the db if no limit is reached
+        session = self._session(["a", "b", "c"])
+        alerts = threshold_alerts(self.counters, "cmd_1", "threshold:4,5",
+                                  data, session)
+        self.assertEqual(alerts, [])
+        session.query.assert_not_called()
+
+        # The limits are checked again with the records in the db, one of
+        # the counted records has been deleted
+        session = self._session(["a", "c"])
+        alerts = threshold_alerts(self.counters, "cmd_1", "threshold:3,5",
+                                  data, session)
+        self.assertEqual(alerts, [])
+
+    def test_threshold_alerts_hospital(self):
+        for uuid in ["a", "b"]:
+            self.counters.add(uuid, "case", 1, datetime(2017, 6, 10), 2017, 23,
+                              {"cmd_1": 2})
+        data = {"uuid": "b", "clinic": 1, "clinic_type": "Hospital",
+                "date": datetime(2017, 6, 10), "epi_year": 2017,
+                "epi_week": 23, "variables": {"cmd_1": 2}}
+        session = self._session(["a", "b"], value=2)
+        alerts = threshold_alerts(self.counters, "cmd_1",
+                                  "threshold:3,10,2,5", data, session)
+        self.assertEqual([a["duration"] for a in alerts], [1])
+
+        data["clinic_type"] = "Primary"
+        alerts = threshold_alerts(self.counters, "cmd_1",
+                                  "threshold:3,10,2,5", data, session)
+        self.assertEqual(alerts, [])
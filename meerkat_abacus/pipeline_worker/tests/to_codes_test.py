@@ -1,7 +1,7 @@
 import unittest
 
 from meerkat_abacus import model
-from meerkat_abacus.codes.to_codes import to_code
+from meerkat_abacus.codes.to_codes import to_code, compile_variables
 from meerkat_abacus.codes.variable import Variable
 from geoalchemy2.shape import from_shape
 from shapely.geometry import Polygon
@@ -260,5 +260,51 @@ class ToCodeTest(unittest.TestCase):
                                'alert_reason': 2})
         self.assertEqual(disregard, True)
 
+    def test_priority(self):
+        """
+        Checking that variables with higher priority order overwrite
+        the ones with lower priority in the same group
+        """
+        agg_variables = [
+            model.AggregationVariables(
+                id="gen_1", id_pk=11, method="match", db_column="gender",
+                condition="female", category=["gender"], form="form1",
+                calculation_group="gender", calculation_priority="2"),
+            model.AggregationVariables(
+                id="gen_2", id_pk=12, method="not_null", db_column="gender",
+                condition="", category=["gender"], form="form1",
+                calculation_group="gender", calculation_priority="1")
+        ]
+        variables = {"case": {"gender": {}}}
+        variables_forms = {}
+        variables_test = {}
+        variables_groups = {"gender": []}
+        for av in agg_variables:
+            variables["case"]["gender"][av.id_pk] = Variable(av)
+            variables_forms[av.id_pk] = "form1"
+            variables_test[av.id_pk] = variables["case"]["gender"][av.id_pk].test
+            variables_groups["gender"].append(av.id_pk)
+        all_variables = (variables, variables_forms, variables_test,
+                         variables_groups, {})
+        plan = compile_variables(all_variables, "case")
+        groups, column_index = plan
+        self.assertEqual(len(groups), 1)
+        self.assertEqual(groups[0][0], True)
+
+        row = {"form1": {"gender": "female", "deviceid": "1"},
+               "original_form": "form1"}
+        for p in [None, plan]:
+            var, category, ret_loc, disregard = to_code(
+                row, all_variables, self.all_locations, "case",
+                self.alert_data, self.mul_forms, "deviceid", plan=p)
+            self.assertEqual(var, {"gen_2": 1})
+            self.assertEqual(category, {"gender": "gen_2"})
+
+        row["form1"]["gender"] = "male"
+        var, category, ret_loc, disregard = to_code(
+            row, all_variables, self.all_locations, "case",
+            self.alert_data, self.mul_forms, "deviceid", plan=plan)
+        self.assertEqual(var, {"gen_2": 1})
+
 if __name__ == "__main__":
     unittest.main()
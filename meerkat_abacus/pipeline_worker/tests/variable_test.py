@@ -161,7 +161,20 @@ class VariableTest(unittest.TestCase):
         variable = Variable(agg_variable)
         row = {"A": "2", "B": "6"}
         with self.assertRaises(NameError):
-            variable.test(row)      
+            variable.test(row)
+
+        # One column name is part of the other
+        agg_variable = model.AggregationVariables(
+            id=4,
+            method="calc",
+            condition="None",
+            calculation="weight / height_weight",
+            db_column="weight,height_weight")
+        variable = Variable(agg_variable)
+        row = {"weight": "8", "height_weight": "2"}
+        self.assertEqual(variable.test(row),
+                         {"applicable": True,
+                          "value": 4})
 
     def test_match(self):
         agg_variable = model.AggregationVariables(
@@ -0,0 +1,316 @@
+"""
+In-memory counts of the records behind the threshold alerts
+
+"""
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy import case
+from sqlalchemy.dialects.postgresql import array
+
+from meerkat_abacus import model
+from meerkat_abacus import logger
+from meerkat_abacus.pipeline_worker.link_cache import IdTracker
+
+
+class ThresholdCounters:
+    """
+    Keeps the number of records with each threshold alert variable by
+    clinic and day and by clinic and epi week
+
+    For each (variable, clinic, day) and (variable, clinic, epi_year,
+    epi_week) we keep the sum of the variable and the number of records,
+    so checking if a record's day or week can be over the limits is two
+    dict lookups. The db is only queried for the records of a day or week
+    that is over the limits, and the limits are checked again against
+    them, see threshold_alerts.
+
+    The counts are loaded from the data table by refresh, which only reads
+    the rows we have not seen, see IdTracker. This picks up the rows
+    written by the other workers as well. Records can also be added
+    directly with add.
+
+    We remember what each (uuid, type) added, so a record that is written
+    again replaces its old counts instead of being counted twice. Records
+    that are deleted or moved to disregarded_data are not subtracted, so
+    the counts can be too high until the record's day leaves the window.
+
+    Only the days from retain_days before the newest date we have seen are
+    kept, older counts are pruned. covers tells if the counts of a date
+    are complete.
+
+    As in LinkCache, begin, commit and rollback undo the counts of rows
+    read in a transaction that was rolled back.
+
+    Args:
+        var_ids: ids of the threshold alert variables
+        retain_days: number of days to keep counts for
+        gap_timeout: seconds to keep looking for rows that committed out
+            of order
+    """
+    def __init__(self, var_ids, retain_days=60, gap_timeout=300):
+        self.var_ids = set(var_ids)
+        self.retain_days = retain_days
+        self.daily = {}
+        self.weekly = {}
+        # (uuid, type): (day, list of (counts, key, value))
+        self.contributions = {}
+        # day: set of (uuid, type) with contributions for the day
+        self.days = {}
+        self.newest = None
+        self.cutoff = None
+        self.tracker = IdTracker(gap_timeout)
+        self._journal = None
+
+    def begin(self):
+        """
+        Starts recording the changes to the counts so they can be undone
+        """
+        self._journal = {
+            "records": {},
+            "state": (self.newest, self.cutoff, self.tracker.high_water,
+                      OrderedDict(self.tracker.gaps))}
+
+    def commit(self):
+        """
+        Keeps the changes since begin
+        """
+        self._journal = None
+
+    def rollback(self):
+        """
+        Undoes the changes since begin
+        """
+        journal = self._journal
+        if journal is None:
+            return
+        self._journal = None
+        for record, contribution in journal["records"].items():
+            self._remove(record)
+            if contribution is None:
+                continue
+            day, new = contribution
+            for counts, key, value in new:
+                total, n = counts.get(key, (0, 0))
+                counts[key] = (total + value, n + 1)
+            self.contributions[record] = contribution
+            self.days.setdefault(day, set()).add(record)
+        (self.newest, self.cutoff, self.tracker.high_water,
+         self.tracker.gaps) = journal["state"]
+
+    def refresh(self, session, gaps=True):
+        """
+        Loads the data rows that are not yet counted from the db
+
+        Args:
+            session: db session
+            gaps: also look for the rows that committed out of order, with
+                False we only read the rows above the highest id we have
+                read
+        """
+        if not self.var_ids:
+            return
+        # All the new rows are read so the ids we track have no gaps, but
+        # we only fetch the variables of the rows that have one of ours
+        has_variable = model.Data.variables.has_any(array(sorted(self.var_ids)))
+        query = session.query(
+            model.Data.id, model.Data.uuid, model.Data.type,
+            model.Data.clinic, model.Data.date, model.Data.epi_year,
+            model.Data.epi_week,
+            case([(has_variable, model.Data.variables)])).filter(
+                self.tracker.condition(model.Data.id, gaps)
+            ).order_by(model.Data.id).yield_per(10000)
+        n = 0
+        for row_id, uuid, type_, clinic, date, epi_year, epi_week, variables in query:
+            if not self.tracker.add(row_id):
+                continue
+            if variables is None and (uuid, type_) not in self.contributions:
+                continue
+            n += 1
+            self.add(uuid, type_, clinic, date, epi_year, epi_week,
+                     variables or {})
+        if gaps:
+            self.tracker.expire()
+        self.prune()
+        if n:
+            logger.info(f"Threshold counters: loaded {n} rows")
+
+    def add(self, uuid, type_, clinic, date, epi_year, epi_week, variables):
+        """
+        Counts a data record, replacing what it added before
+        """
+        day = None
+        if date is not None:
+            day = date_to_day(date)
+            self._advance(day)
+        new = []
+        if day is not None and clinic is not None and self._in_window(day):
+            for var_id in self.var_ids.intersection(variables):
+                value = variables[var_id]
+                if not isinstance(value, (int, float)):
+                    value = 1
+                new.append((self.daily, (var_id, clinic, day), value))
+                if epi_year is not None and epi_week is not None:
+                    new.append((self.weekly,
+                                (var_id, clinic, epi_year, epi_week), value))
+        self._remove((uuid, type_))
+        for counts, key, value in new:
+            total, n = counts.get(key, (0, 0))
+            counts[key] = (total + value, n + 1)
+        if new:
+            self.contributions[(uuid, type_)] = (day, new)
+            self.days.setdefault(day, set()).add((uuid, type_))
+
+    def prune(self):
+        """
+        Removes the counts of the days before the window
+        """
+        if self.cutoff is None:
+            return
+        for day in [day for day in self.days if day < self.cutoff]:
+            for record in list(self.days[day]):
+                self._remove(record)
+
+    def covers(self, date):
+        """
+        Returns True if we have all the counts for the day and epi week
+        of date
+        """
+        return (self.cutoff is None or
+                date_to_day(date) - timedelta(days=7) >= self.cutoff)
+
+    def day_count(self, var_id, clinic, date):
+        """
+        Returns the (sum, number of records) for the day of date
+        """
+        return self.daily.get((var_id, clinic, date_to_day(date)), (0, 0))
+
+    def week_count(self, var_id, clinic, epi_year, epi_week):
+        """
+        Returns the (sum, number of records) for the epi week
+        """
+        return self.weekly.get((var_id, clinic, epi_year, epi_week), (0, 0))
+
+    def _remove(self, record):
+        if (self._journal is not None and
+                record not in self._journal["records"]):
+            self._journal["records"][record] = self.contributions.get(record)
+        day, old = self.contributions.pop(record, (None, []))
+        for counts, key, value in old:
+            total, n = counts[key]
+            if n == 1:
+                del counts[key]
+            else:
+                counts[key] = (total - value, n - 1)
+        if old:
+            self.days[day].discard(record)
+            if not self.days[day]:
+                del self.days[day]
+
+    def _advance(self, day):
+        # Dates in the future do not move the window
+        newest = min(day, date_to_day(datetime.now()))
+        if self.newest is None or newest > self.newest:
+            self.newest = newest
+            self.cutoff = newest - timedelta(days=self.retain_days)
+
+    def _in_window(self, day):
+        return self.cutoff is None or day >= self.cutoff
+
+
+def date_to_day(date):
+    """
+    Returns the date as a datetime at midnight
+    """
+    return datetime(date.year, date.month, date.day)
+
+
+def threshold_alerts(counters, var_id, alert_type, data, session):
+    """
+    Calculate threshold alerts for the day and epi week of a record
+
+    Gives the same alerts as add_multiple_alerts.threshold does for the
+    day and week of the record. The counts from counters are only used to
+    skip the days and weeks that are under the limits. For the others we
+    read the records from the db and check the limits again, as the counts
+    can include records that have since been deleted.
+
+    Args:
+       counters: ThresholdCounters with the record counted
+       var_id: variable id for alert
+       alert_type: "threshold:daily,weekly" or
+            "threshold:daily,weekly,hospital_daily,hospital_weekly"
+       data: the data record
+       session: Db session
+
+    Returns:
+        alerts: list of alerts.
+    """
+    limits = [int(x) for x in alert_type.split(":")[1].split(",")]
+    hospital_limits = None
+    if len(limits) == 4:
+        hospital_limits = limits[2:]
+        limits = limits[:2]
+    if hospital_limits and data.get("clinic_type") == "Hospital":
+        count_limits = hospital_limits
+    else:
+        count_limits = limits
+    clinic = data["clinic"]
+    alerts = []
+
+    total, n = counters.day_count(var_id, clinic, data["date"])
+    if total >= limits[0] and n >= count_limits[0]:
+        day = date_to_day(data["date"])
+        uuids = _uuids_over_limits(
+            session, var_id, clinic, limits[0], count_limits[0],
+            model.Data.date >= day,
+            model.Data.date < day + timedelta(days=1))
+        if uuids:
+            alerts.append({
+                "clinic": clinic,
+                "reason": var_id,
+                "duration": 1,
+                "uuids": uuids,
+                "type": "threshold"
+            })
+
+    epi_year = data.get("epi_year")
+    epi_week = data.get("epi_week")
+    if epi_year is not None and epi_week is not None:
+        total, n = counters.week_count(var_id, clinic, epi_year, epi_week)
+        if total >= limits[1] and n >= count_limits[1]:
+            uuids = _uuids_over_limits(
+                session, var_id, clinic, limits[1], count_limits[1],
+                model.Data.epi_year == epi_year,
+                model.Data.epi_week == epi_week)
+            if uuids:
+                alerts.append({
+                    "clinic": clinic,
+                    "reason": var_id,
+                    "duration": 7,
+                    "uuids": uuids,
+                    "type": "threshold"
+                })
+    return alerts
+
+
+def _uuids_over_limits(session, var_id, clinic, limit, count_limit,
+                       *conditions):
+    """
+    Returns the uuids of the records with var_id that match conditions if
+    their sum is at least limit and there are at least count_limit of
+    them, otherwise an empty list
+    """
+    query = session.query(model.Data.uuid,
+                          model.Data.variables[var_id]).filter(
+        model.Data.variables.has_key(var_id),
+        model.Data.clinic == clinic,
+        *conditions).order_by(model.Data.date)
+    uuids = []
+    total = 0
+    for uuid, value in query:
+        uuids.append(uuid)
+        total += value if isinstance(value, (int, float)) else 1
+    if total >= limit and len(uuids) >= count_limit:
+        return uuids
+    return []
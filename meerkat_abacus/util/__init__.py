@@ -21,6 +21,8 @@ from jinja2 import Environment, FileSystemLoader, select_autoescape
 from meerkat_abacus.model import Locations, AggregationVariables, Devices, form_tables
 from meerkat_abacus.config import config
 from meerkat_abacus import logger
+from meerkat_abacus.util.config_registry import registry
+from meerkat_abacus.codes.location_tree import LocationTree
 import meerkat_libs as libs
 
 country_config = config.country_config
@@ -63,6 +65,9 @@ def is_child(parent, child, locations):
 
     if child == parent or parent == 1:
         return True
+    result = _location_tree_for(locations).is_child(parent, child)
+    if result is not None:
+        return result
     loc_id = child
 
     while loc_id != 1:
@@ -72,6 +77,22 @@ def is_child(parent, child, locations):
     return False
 
 
+_is_child_cache = (None, None)
+
+
+def _location_tree_for(locations):
+    """
+    Returns a LocationTree for the locations dict, the last tree is cached
+    so is_child only labels the locations once
+    """
+    global _is_child_cache
+    cached_locations, tree = _is_child_cache
+    if cached_locations is not locations:
+        tree = LocationTree(locations)
+        _is_child_cache = (locations, tree)
+    return tree
+
+
 def get_db_engine(db_url=config.DATABASE_URL):
     """
     Returns a db engine and session
@@ -106,17 +127,17 @@ def field_to_list(row, key):
 
 def get_links(file_path):
     """
-    Returns links indexed by type
+    Returns links indexed by type and by name
 
+    The links are copies of the cached ones, so callers can change them
+    without changing the links of the other callers.
     """
-    links = read_csv(file_path)
-    links_by_type = {}
-    links_by_name = {}
-    for l in links:
-        links_by_type.setdefault(l["type"], [])
-        links_by_type[l["type"]].append(l)
-        links_by_name[l["name"]] = l
-    return links_by_type, links_by_name
+    links_by_type, links_by_name = registry.links(file_path)
+    copies = {id(link): dict(link)
+              for links in links_by_type.values() for link in links}
+    return ({link_type: [copies[id(link)] for link in links]
+             for link_type, links in links_by_type.items()},
+            {name: copies[id(link)] for name, link in links_by_name.items()})
 
 
 def all_location_data(session):
@@ -130,12 +151,21 @@ def all_location_data(session):
     Returns:
         locations(tuple): (loction_dict,loc_by_deviceid, regions, districts)
     """
-    locations = get_locations(session)
-    locations_by_deviceid = get_locations_by_deviceid(session)
-    zones, regions, districts = get_zones_regions_districts(session)
+    return get_location_tree(session).location_data()
+
 
-    devices = get_device_tags(session)
-    return (locations, locations_by_deviceid, zones, regions, districts, devices)
+def get_location_tree(session):
+    """
+    Returns a LocationTree with all the locations and device tags
+
+    Args:
+        session: db session
+
+    Returns:
+        location_tree(LocationTree)
+    """
+    return LocationTree(get_locations(session),
+                        devices=get_device_tags(session))
 
 
 def get_variables(session):
@@ -347,15 +377,7 @@ def get_exclusion_list(session, form):
         session: db session
         form: which form to get the exclusion list for
     """
-    exclusion_lists = config.country_config.get("exclusion_lists", {})
-    ret = []
-
-    for exclusion_list_file in exclusion_lists.get(form, []):
-        exclusion_list = read_csv(config.config_directory + exclusion_list_file)
-        for uuid_to_be_removed in exclusion_list:
-            ret.append(uuid_to_be_removed["uuid"])
-
-    return ret
+    return list(registry.exclusion_set(form))
 
 
 def read_csv_file(filename, param_config=config):
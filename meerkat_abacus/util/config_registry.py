@@ -0,0 +1,132 @@
+"""
+Process-wide cache of the parsed country config files
+
+The data types, links, codes and exclusion list csv-files are read in the
+per-record hot path of several processing steps. The registry parses each
+file once and keeps indexed views of it. A file is parsed again when its
+modification time changes, so config changes are still picked up by a
+running worker.
+"""
+import csv
+import os
+import threading
+import time
+
+from meerkat_abacus.config import config
+
+
+class ConfigRegistry:
+    """
+    Keeps parsed config files in memory
+
+    Each cached view is stored with the modification times of the files it
+    was built from. We check the modification times at most once every
+    check_interval seconds, so a lookup is normally a dictionary lookup.
+
+    Args:
+        check_interval: seconds between checks of the file mtimes
+    """
+    def __init__(self, check_interval=1.0):
+        self.check_interval = check_interval
+        self._entries = {}
+        self._lock = threading.RLock()
+
+    def invalidate(self):
+        """ Drops all cached files """
+        with self._lock:
+            self._entries.clear()
+
+    def read_csv(self, file_path):
+        """
+        Returns the rows of a csv file as a list of dicts
+
+        The rows are shared with other callers and should not be changed.
+        """
+        return self._get(("csv", file_path), [file_path],
+                         lambda: list(_read_csv(file_path)))
+
+    def data_types(self, param_config=config):
+        """ Returns the data types in the types_file """
+        return self.read_csv(param_config.config_directory +
+                             param_config.country_config["types_file"])
+
+    def data_types_by_form(self, param_config=config):
+        """ Returns a dict of form name: list of data types for the form """
+        file_path = (param_config.config_directory +
+                     param_config.country_config["types_file"])
+
+        def build():
+            by_form = {}
+            for data_type in self.read_csv(file_path):
+                by_form.setdefault(data_type["form"], []).append(data_type)
+            return by_form
+        return self._get(("data_types_by_form", file_path), [file_path],
+                         build)
+
+    def links(self, file_path):
+        """
+        Returns the links in file_path as (links_by_type, links_by_name)
+        """
+        def build():
+            links_by_type = {}
+            links_by_name = {}
+            for link in self.read_csv(file_path):
+                links_by_type.setdefault(link["type"], []).append(link)
+                links_by_name[link["name"]] = link
+            return links_by_type, links_by_name
+        return self._get(("links", file_path), [file_path], build)
+
+    def codes(self, param_config=config):
+        """ Returns the rows of all the codes files """
+        country_config = param_config.country_config
+        if "coding_list" in country_config:
+            files = [param_config.config_directory + "variable_codes/" + name
+                     for name in country_config["coding_list"]]
+        else:
+            files = [param_config.config_directory +
+                     country_config["codes_file"] + ".csv"]
+
+        def build():
+            return [row for file_path in files
+                    for row in self.read_csv(file_path)]
+        return self._get(("codes",) + tuple(files), files, build)
+
+    def exclusion_set(self, form, param_config=config):
+        """ Returns the set of uuids excluded for a form """
+        files = [param_config.config_directory + file_name
+                 for file_name in param_config.country_config.get(
+                         "exclusion_lists", {}).get(form, [])]
+
+        def build():
+            return frozenset(row["uuid"] for file_path in files
+                             for row in self.read_csv(file_path))
+        return self._get(("exclusion",) + tuple(files), files, build)
+
+    def _get(self, key, files, build):
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None:
+            checked, mtimes, value = entry
+            if now - checked < self.check_interval:
+                return value
+            if _mtimes(files) == mtimes:
+                self._entries[key] = (now, mtimes, value)
+                return value
+        with self._lock:
+            mtimes = _mtimes(files)
+            value = build()
+            self._entries[key] = (now, mtimes, value)
+        return value
+
+
+def _mtimes(files):
+    return tuple(os.stat(file_path).st_mtime_ns for file_path in files)
+
+
+def _read_csv(file_path):
+    with open(file_path, "r", encoding='utf-8', errors="replace") as f:
+        for row in csv.DictReader(f):
+            yield row
+
+
+registry = ConfigRegistry()
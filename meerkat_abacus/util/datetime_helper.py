@@ -1,8 +1,91 @@
+"""
+Date formats and fast date parsing
+
+dateutil.parser.parse is slow as it tries to guess the format of every
+string. parse tries the formats we see in ODK data first, caches the
+result for each string and only falls back to dateutil for strings in
+other formats.
+"""
 import datetime
+import re
+from functools import lru_cache
+
+from dateutil.parser import parse as dateutil_parse
 
 SUBMISSION_DATE_FORMAT = "%b %d, %Y %H:%M:%S %p"
 PSQL_SUBMISSION_DATE_FORMAT = "Mon DD, YYYY HH:MI:SS AM"
 PSQL_VISIT_DATE_FORMAT = "Mon DD, YYYY"
 
+# A list of the valid datestring formats
+allowed_formats = [
+    '%b %d, %Y',
+    '%d-%b-%Y',
+    '%Y-%m-%d',
+    '%d-%b-%Y %I:%M:%S',
+    '%d-%b-%Y %H:%M:%S',
+    '%b %d, %Y %I:%M:%S %p',
+    '%Y-%m-%dT%H:%M:%S.%f',
+    '%Y-%m-%dT%H:%M:%S.%fZ',
+    '%Y-%m-%dT%H:%M:%S'
+]
+
+# Strings fromisoformat and dateutil agree on. fromisoformat also accepts
+# e.g. week dates, which dateutil does not.
+ISO_DATE = re.compile(r"\d{4}-\d{2}-\d{2}"
+                      r"([T ]\d{2}(:\d{2}(:\d{2}(\.\d{1,6})?)?)?)?"
+                      r"(Z|[+-]\d{2}:\d{2})?$")
+
+# The ODK formats in allowed_formats. strptime reads 12 as 0 for %I
+# without %p, where dateutil reads it as 12, so we leave those formats
+# to the %H variants. SUBMISSION_DATE_FORMAT has the same problem the
+# other way round, strptime ignores %p with %H. Submission dates are
+# parsed with '%b %d, %Y %I:%M:%S %p' instead.
+KNOWN_FORMATS = [date_format for date_format in allowed_formats
+                 if "%I" not in date_format or "%p" in date_format]
+
+
 def strptime(date_string):
-    return datetime.datetime.strptime(date_string, SUBMISSION_DATE_FORMAT)
\ No newline at end of file
+    return datetime.datetime.strptime(date_string, SUBMISSION_DATE_FORMAT)
+
+
+def parse(date_string):
+    """
+    Parses a date string in the same way as dateutil.parser.parse
+
+    Args:
+        date_string: string to parse
+    Returns:
+        date(datetime)
+    """
+    if not isinstance(date_string, str):
+        return dateutil_parse(date_string)
+    return _parse(date_string)
+
+
+@lru_cache(maxsize=65536)
+def _parse(date_string):
+    date = parse_known_format(date_string)
+    if date is None:
+        date = dateutil_parse(date_string)
+    return date
+
+
+def parse_known_format(date_string):
+    """
+    Returns the date for date_string if it is in one of the formats we
+    know, otherwise None
+    """
+    if ISO_DATE.match(date_string):
+        try:
+            return datetime.datetime.fromisoformat(date_string)
+        except ValueError:
+            pass
+    for date_format in KNOWN_FORMATS:
+        try:
+            date = datetime.datetime.strptime(date_string, date_format)
+        except ValueError:
+            continue
+        if date_format.endswith("Z"):
+            date = date.replace(tzinfo=datetime.timezone.utc)
+        return date
+    return None
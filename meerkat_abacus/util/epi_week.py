@@ -1,7 +1,12 @@
+from bisect import bisect_right
 from collections import defaultdict
+from functools import lru_cache
 
 from datetime import datetime, timedelta
 
+import numpy as np
+import pandas as pd
+
 from meerkat_abacus.config import config
 country_config = config.country_config
 
@@ -17,6 +22,10 @@ def __handle_epi_week_53(epi_year,
     }[epi_week_53_strategy](epi_year)
 
 
+# Names starting with two underscores are mangled inside a class body
+_handle_epi_week_53 = __handle_epi_week_53
+
+
 def epi_week_for_date(date, param_config=country_config):
     """
     Calculate epi week for given date.
@@ -27,19 +36,178 @@ def epi_week_for_date(date, param_config=country_config):
         date
     Returns tuple epi_year, epi_week
     """
-    # We don't support timezone info in date comparison
-    # TODO: .replace(tzinfo=None) should be moved to a common meerkat dateparser
-    date = date.replace(tzinfo=None)
-    _epi_config = param_config["epi_week"]
-    _epi_week_53_strategy=param_config.get("epi_week_53_strategy",
-                                           "leave_as_is")
-    _epi_year_start_date = epi_year_start_date(date, epi_config=_epi_config)
-    _epi_year = epi_year_by_date(date, epi_config=_epi_config)
-    _epi_week_number = (date - _epi_year_start_date).days // 7 + 1
-    if _epi_week_number in [0, 53]:
-        _epi_year, _epi_week_number = __handle_epi_week_53(epi_year=_epi_year,
-                                                           epi_week_53_strategy=_epi_week_53_strategy)
-    return _epi_year, _epi_week_number
+    return get_calendar(param_config["epi_week"],
+                        param_config.get("epi_week_53_strategy",
+                                         "leave_as_is")).epi_week(date)
+
+
+def epi_weeks_for_dates(dates, param_config=country_config):
+    """
+    Calculate epi years and weeks for many dates in one call
+
+    Args:
+        dates: numpy datetime64 array, pandas Series or list of dates
+    Returns tuple epi_years, epi_weeks as numpy arrays, or as Series with
+    the index of dates if dates is a Series
+    """
+    return get_calendar(param_config["epi_week"],
+                        param_config.get("epi_week_53_strategy",
+                                         "leave_as_is")).epi_weeks(dates)
+
+
+class EpiWeekCalendar:
+    """
+    Calculates epi weeks for one epi week config
+
+    Gives the same results as the functions in this module, but the year
+    start dates are only worked out once. For a dict config we keep the
+    start dates sorted and find the epi year with bisect. Results for
+    single dates are kept in an LRU cache, as most records in a chunk are
+    from a few days.
+
+    Args:
+        epi_config: "international", "day:<weekday>" or dict of
+                    year: start date
+        epi_week_53_strategy: how to number the days after week 52
+        cache_size: number of dates to cache
+    """
+    def __init__(self, epi_config, epi_week_53_strategy="leave_as_is",
+                 cache_size=4096):
+        self.epi_config = epi_config
+        self.epi_week_53_strategy = epi_week_53_strategy
+        self._year_starts = {}
+        if isinstance(epi_config, dict):
+            items = sorted(epi_config.items(), key=lambda item: item[1])
+            self._custom_starts = [start for year, start in items]
+            # The largest year starting on or before each start date, as
+            # looping over the config in reverse year order returns
+            self._custom_years = []
+            for year, start in items:
+                if self._custom_years:
+                    year = max(year, self._custom_years[-1])
+                self._custom_years.append(year)
+        self.epi_week = lru_cache(maxsize=cache_size)(self._epi_week)
+
+    def year_start(self, year):
+        """ Returns the start of epi week 1 in the calendar year """
+        start = self._year_starts.get(year)
+        if start is None:
+            start = epi_year_start_date_by_year(year, epi_config=self.epi_config)
+            self._year_starts[year] = start
+        return start
+
+    def custom_year(self, date):
+        """
+        Returns (epi_year, start date) for a dict config
+        """
+        i = bisect_right(self._custom_starts, date)
+        if i == 0:
+            raise ValueError("Could not compute epi year for date {!r}".format(date))
+        epi_year = self._custom_years[i - 1]
+        return epi_year, self.epi_config[epi_year]
+
+    def _epi_week(self, date):
+        # We don't support timezone info in date comparison
+        date = date.replace(tzinfo=None)
+        epi_config = self.epi_config
+        if isinstance(epi_config, dict):
+            epi_year, start = self.custom_year(date)
+        elif epi_config == "international" or "day" not in epi_config:
+            epi_year, start = date.year, datetime(date.year, 1, 1)
+        else:
+            start = self.year_start(date.year)
+            if "day:" in epi_config and date < start:
+                epi_year = date.year - 1
+            else:
+                epi_year = date.year
+        epi_week = (date - start).days // 7 + 1
+        if epi_week in [0, 53]:
+            epi_year, epi_week = _handle_epi_week_53(
+                epi_year=epi_year,
+                epi_week_53_strategy=self.epi_week_53_strategy)
+        return epi_year, epi_week
+
+    def epi_weeks(self, dates):
+        """
+        Calculates the epi years and weeks for an array of dates
+
+        Args:
+            dates: numpy datetime64 array, pandas Series or list of dates
+        Returns tuple epi_years, epi_weeks as numpy arrays, or as Series
+        with the index of dates if dates is a Series
+        """
+        index = pd.DatetimeIndex(dates)
+        if index.tz is not None:
+            index = index.tz_localize(None)
+        if index.hasnans:
+            raise ValueError("Could not compute epi year for missing dates")
+        days = index.values.astype("datetime64[D]")
+        years = index.year.values.astype(np.int64)
+        epi_config = self.epi_config
+        if isinstance(epi_config, dict):
+            positions = np.searchsorted(
+                np.array(self._custom_starts, dtype="datetime64[ns]"),
+                index.values, side="right") - 1
+            if len(positions) and positions.min() < 0:
+                raise ValueError("Could not compute epi year for dates before {!r}".format(
+                    self._custom_starts[0]))
+            epi_years = np.array(self._custom_years, dtype=np.int64)[positions]
+            start_days = np.array(
+                [self.epi_config[year] for year in self._custom_years],
+                dtype="datetime64[D]")[positions]
+        elif epi_config == "international" or "day" not in epi_config:
+            epi_years = years
+            start_days = (years - 1970).astype("datetime64[Y]").astype("datetime64[D]")
+        else:
+            unique_years = np.unique(years)
+            year_starts = np.array([self.year_start(int(year)) for year in unique_years],
+                                   dtype="datetime64[D]")
+            start_days = year_starts[np.searchsorted(unique_years, years)]
+            epi_years = years
+            if "day:" in epi_config:
+                epi_years = np.where(days < start_days, years - 1, years)
+        epi_weeks = (days - start_days).astype(np.int64) // 7 + 1
+        epi_years, epi_weeks = self._handle_epi_week_53(epi_years, epi_weeks)
+        if isinstance(dates, pd.Series):
+            return (pd.Series(epi_years, index=dates.index),
+                    pd.Series(epi_weeks, index=dates.index))
+        return epi_years, epi_weeks
+
+    def _handle_epi_week_53(self, epi_years, epi_weeks):
+        week_53 = (epi_weeks == 0) | (epi_weeks == 53)
+        if not week_53.any():
+            return epi_years, epi_weeks
+        strategy = self.epi_week_53_strategy
+        if strategy == "include_in_52":
+            epi_weeks = np.where(week_53, 52, epi_weeks)
+        elif strategy == "include_in_1":
+            epi_years = np.where(week_53, epi_years + 1, epi_years)
+            epi_weeks = np.where(week_53, 1, epi_weeks)
+        elif strategy == "leave_as_is":
+            epi_weeks = np.where(week_53, 53, epi_weeks)
+        else:
+            raise KeyError(strategy)
+        return epi_years, epi_weeks
+
+
+@lru_cache(maxsize=16)
+def _get_calendar(config_key, epi_week_53_strategy):
+    kind, value = config_key
+    if kind == "dict":
+        value = dict(value)
+    return EpiWeekCalendar(value, epi_week_53_strategy)
+
+
+def get_calendar(epi_config=country_config["epi_week"],
+                 epi_week_53_strategy="leave_as_is"):
+    """
+    Returns the cached EpiWeekCalendar for an epi week config
+    """
+    if isinstance(epi_config, dict):
+        config_key = ("dict", tuple(epi_config.items()))
+    else:
+        config_key = ("str", epi_config)
+    return _get_calendar(config_key, epi_week_53_strategy)
 
 
 def epi_year_start_date(date, epi_config=country_config["epi_week"]):
@@ -174,7 +342,4 @@ def __epi_year_start_date_for_weekday_config(year, weekday_config):
 
 
 def __get_epi_week_for_custom_config(date, dict_config):
-    for epi_year, epi_year_start_datetime in reversed(sorted(dict_config.items())):
-        if date >= epi_year_start_datetime:
-            return epi_year, epi_year_start_datetime
-    raise ValueError("Could not compute epi year for date {!r}".format(date))
+    return get_calendar(dict_config).custom_year(date)
@@ -0,0 +1,115 @@
+"""
+Spool of data chunks shared by the consumer and the pipeline workers
+
+Instead of sending a chunk of records in the task message, the consumer
+writes the chunk to a compressed file in the spool directory and sends a
+small reference to it. The worker reads the chunk from the file and
+removes the file once the chunk is processed or has failed. The spool
+directory has to be shared by the consumer and the workers, e.g. a docker
+volume. Files left behind by a crashed consumer or a lost task are removed
+by sweep.
+
+"""
+import gzip
+import json
+import os
+import time
+import uuid
+
+
+def write_chunk(data, spool_directory):
+    """
+    Writes a chunk of records to the spool
+
+    The file is written under a temporary name and renamed when it is
+    complete, so a worker never reads a half written chunk.
+
+    Args:
+        data: list of records
+        spool_directory: path to the spool
+    Returns:
+        reference: dict with the name of the file and number of records
+    """
+    os.makedirs(spool_directory, exist_ok=True)
+    file_name = f"chunk-{uuid.uuid4().hex}.json.gz"
+    path = os.path.join(spool_directory, file_name)
+    with gzip.open(path + ".tmp", "wt", encoding="utf-8",
+                   compresslevel=1) as f:
+        for record in data:
+            f.write(json.dumps(record, separators=(",", ":")))
+            f.write("\n")
+    os.replace(path + ".tmp", path)
+    return {"spool_file": file_name, "records": len(data)}
+
+
+def is_reference(task_data):
+    """
+    Returns True if task_data is a reference to a chunk in the spool
+    """
+    return isinstance(task_data, dict) and "spool_file" in task_data
+
+
+def read_chunk(reference, spool_directory):
+    """
+    Reads the records of the chunk a reference points to
+
+    Args:
+        reference: dict returned by write_chunk
+        spool_directory: path to the spool
+    Returns:
+        data: list of records
+    """
+    path = os.path.join(spool_directory, _file_name(reference))
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        data = [json.loads(line) for line in f]
+    if len(data) != reference["records"]:
+        raise ValueError(f"Expected {reference['records']} records in "
+                         f"{path}, found {len(data)}")
+    return data
+
+
+def remove_chunk(reference, spool_directory):
+    """
+    Removes a processed chunk from the spool
+    """
+    path = os.path.join(spool_directory, _file_name(reference))
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def sweep(spool_directory, max_age):
+    """
+    Removes the chunks and half written files older than max_age seconds
+
+    Args:
+        spool_directory: path to the spool
+        max_age: age in seconds of the files to remove
+    Returns:
+        removed: number of files removed
+    """
+    try:
+        entries = list(os.scandir(spool_directory))
+    except FileNotFoundError:
+        return 0
+    cutoff = time.time() - max_age
+    removed = 0
+    for entry in entries:
+        if not entry.name.startswith("chunk-") or not entry.is_file():
+            continue
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+def _file_name(reference):
+    # Only files directly in the spool directory
+    file_name = os.path.basename(reference["spool_file"])
+    if file_name != reference["spool_file"]:
+        raise ValueError(f"Invalid spool file {reference['spool_file']}")
+    return file_name